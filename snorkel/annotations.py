@@ -1,6 +1,9 @@
 import numpy as np
 from pandas import DataFrame, Series
 import scipy.sparse as sparse
+import signal
+from collections import defaultdict
+from six import string_types
 from sqlalchemy.sql import bindparam, select
 
 from .features import get_span_feats
@@ -47,12 +50,18 @@ class csr_AnnotationMatrix(sparse.csr_matrix):
 
     def get_key(self, session, j):
         """Return the AnnotationKey object corresponding to column j"""
+        # Matrices computed in memory (see Annotator.apply) index new keys by
+        # name, as they were never inserted into the DB
+        if isinstance(self.col_index[j], string_types):
+            return self.annotation_key_cls(name=self.col_index[j])
         return session.query(self.annotation_key_cls)\
                 .filter(self.annotation_key_cls.id == self.col_index[j]).one()
 
     def get_col_index(self, key):
         """Return the cow index of the AnnotationKey"""
-        return self.key_index[key.id]
+        if key.id in self.key_index:
+            return self.key_index[key.id]
+        return self.key_index[key.name]
 
     def _get_sliced_indexes(self, s, axis, index, inv_index):
         """
@@ -146,21 +155,50 @@ except:
             return None
 
 
+class FailedAnnotation(object):
+    """
+    Placeholder emitted by an annotation generator in place of a value when
+    the underlying function raised an exception or ran out of time. It is
+    stored as 0 (i.e. an abstain for labels) and counted per key in
+    Annotator.error_counts.
+    """
+    def __init__(self, timeout=False):
+        self.timeout = timeout
+
+
 class Annotator(UDFRunner):
     """Abstract class for annotating candidates and persisting these annotations to DB"""
+    matrix_class = csr_AnnotationMatrix
+
     def __init__(self, annotation_class, annotation_key_class, f_gen):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
+
+        # Counts of FailedAnnotations per key name from the last apply() call;
+        # this dict is shared with the reducing UDFs, which fill it
+        self.error_counts         = defaultdict(int)
         super(Annotator, self).__init__(AnnotatorUDF,
                                         annotation_class=annotation_class,
                                         annotation_key_class=annotation_key_class,
-                                        f_gen=f_gen)
+                                        f_gen=f_gen,
+                                        error_counts=self.error_counts)
 
     def apply(self, split=0, key_group=0, replace_key_set=True, cids_query=None,
-        **kwargs):
+        persist=True, **kwargs):
+        """
+        Annotates the candidates in the given split (or cids_query) and returns
+        the resulting annotation matrix.
+
+        If persist=False, the annotations are not written to the DB; instead
+        they are collected in memory and assembled directly into the returned
+        matrix. New keys (replace_key_set=True) then index the matrix columns
+        by name, while for replace_key_set=False only annotations with keys
+        already in key_group are kept, indexed by their ids.
+        """
         # If we are replacing the key set, make sure the reducer key id cache is cleared!
-        if replace_key_set:
+        if replace_key_set and persist:
             self.reducer.key_cache = {}
+        self.error_counts.clear()
 
         # Get the cids based on the split, and also the count
         SnorkelSession = new_sessionmaker()
@@ -174,15 +212,73 @@ class Annotator(UDFRunner):
         cids       = cids_query.all()
         cids_count = len(cids)
 
+        # If not persisting, the reducer appends to annotations instead of
+        # inserting into the DB, so there is nothing to clear either
+        annotations = None
+        if not persist:
+            annotations = []
+            kwargs['clear'] = False
+
         # Run the Annotator
         super(Annotator, self).apply(cids, split=split, key_group=key_group,
             replace_key_set=replace_key_set, cids_query=cids_query,
-            count=cids_count, **kwargs)
+            count=cids_count, annotations=annotations, **kwargs)
+        if self.error_counts:
+            print("Stored %s failed annotations as 0 for %s keys; see error_counts." % (
+                sum(self.error_counts.values()), len(self.error_counts)))
 
         # Load the matrix
+        if not persist:
+            return self.build_matrix(session, cids, annotations,
+                key_group=key_group, replace_key_set=replace_key_set)
         return self.load_matrix(session, split=split, cids_query=cids_query,
             key_group=key_group)
 
+    def build_matrix(self, session, cids, annotations, key_group=0,
+        replace_key_set=True):
+        """
+        Assembles (candidate id, key name, value) tuples collected in memory
+        into an annotation matrix with the same row ordering as load_matrix.
+        """
+        cid_to_row = {}
+        row_to_cid = {}
+        for cid in sorted(set(cid for cid, in cids)):
+            row_to_cid[len(cid_to_row)] = cid
+            cid_to_row[cid] = len(cid_to_row)
+
+        # Columns are either new keys, in order of first appearance (as DB ids
+        # would be assigned), or the existing keys of key_group
+        name_to_col = {}
+        kid_to_col  = {}
+        col_to_kid  = {}
+        if replace_key_set:
+            for _, key_name, _ in annotations:
+                if key_name not in name_to_col:
+                    col_to_kid[len(name_to_col)] = key_name
+                    name_to_col[key_name] = len(name_to_col)
+            kid_to_col = name_to_col
+        else:
+            keys_query = session.query(self.annotation_key_class.id,
+                self.annotation_key_class.name)\
+                .filter(self.annotation_key_class.group == key_group)\
+                .order_by(self.annotation_key_class.id)
+            for kid, key_name in keys_query.all():
+                col_to_kid[len(name_to_col)] = kid
+                kid_to_col[kid] = len(name_to_col)
+                name_to_col[key_name] = len(name_to_col)
+
+        rows, cols, vals = [], [], []
+        for cid, key_name, value in annotations:
+            if value != 0 and key_name in name_to_col:
+                rows.append(cid_to_row[cid])
+                cols.append(name_to_col[key_name])
+                vals.append(int(value))
+        X = sparse.coo_matrix((np.array(vals, dtype=np.int64), (rows, cols)),
+            shape=(len(cid_to_row), len(name_to_col)))
+        return self.matrix_class(X.tocsr(), candidate_index=cid_to_row,
+            row_index=row_to_cid, annotation_key_cls=self.annotation_key_class,
+            key_index=kid_to_col, col_index=col_to_kid)
+
     def clear(self, session, split=0, key_group=0, replace_key_set=True,
         cids_query=None, **kwargs):
         """
@@ -217,9 +313,12 @@ class Annotator(UDFRunner):
 
 
 class AnnotatorUDF(UDF):
-    def __init__(self, annotation_class, annotation_key_class, f_gen, **kwargs):
+    def __init__(self, annotation_class, annotation_key_class, f_gen,
+        error_counts=None, **kwargs):
         self.annotation_class     = annotation_class
         self.annotation_key_class = annotation_key_class
+        self.error_counts         = error_counts if error_counts is not None \
+                                        else defaultdict(int)
 
         # AnnotatorUDF relies on a *generator function* which yields annotations
         # given a candidate input
@@ -250,14 +349,25 @@ class AnnotatorUDF(UDF):
                 seen.add((cid, key_name))
                 yield cid, key_name, value
 
-    def reduce(self, y, clear, key_group, replace_key_set, **kwargs):
+    def reduce(self, y, clear, key_group, replace_key_set, annotations=None,
+        **kwargs):
         """
         Inserts Annotations into the database.
         For Annotations with unseen AnnotationKeys (in key_group, if not None), either adds these
         AnnotationKeys if create_new_keyset is True, else skips these Annotations.
+        If a list annotations is provided, appends to it instead of using the database.
         """
         cid, key_name, value = y
 
+        # Failed annotations are counted, then stored as 0
+        if isinstance(value, FailedAnnotation):
+            self.error_counts[key_name] += 1
+            value = 0
+
+        if annotations is not None:
+            annotations.append((cid, key_name, value))
+            return
+
         # Prepares queries
         # Annoation updating only needs to be done if clear=False
         if not clear:
@@ -323,6 +433,53 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
     Returns the annotations corresponding to a split of candidates with N members
     and an AnnotationKey group with M distinct keys as an N x M CSR sparse matrix.
     """
+    cids, kid_to_col, col_to_kid = _matrix_index(annotation_key_class, session,
+        split=split, cids_query=cids_query, key_group=key_group,
+        key_names=key_names)
+
+    # NOTE: This is much faster as it allows us to skip the join (which for some reason is
+    # unreasonably slow) by relying on our symbol tables from above; however this will get slower with
+    # The total number of annotations in DB which is weird behavior...
+    q = session.query(annotation_class.candidate_id, annotation_class.key_id, annotation_class.value)
+    q = q.order_by(annotation_class.candidate_id)
+
+    Xr = _build_matrix(matrix_class, annotation_key_class, cids, kid_to_col,
+        col_to_kid, q.all(), zero_one)
+    return np.squeeze(Xr.toarray()) if load_as_array else Xr
+
+
+def iter_matrix_chunks(matrix_class, annotation_key_class, annotation_class,
+    session, chunk_size=10000, split=0, cids_query=None, key_group=0,
+    key_names=None, zero_one=False):
+    """
+    Iterates over the annotation matrix of load_matrix in chunks of (at most)
+    chunk_size candidates, each returned as a chunk_size x M CSR sparse matrix
+    with the same columns, so that only one chunk is held in memory at a time.
+    """
+    cids, kid_to_col, col_to_kid = _matrix_index(annotation_key_class, session,
+        split=split, cids_query=cids_query, key_group=key_group,
+        key_names=key_names)
+
+    for start in range(0, len(cids), chunk_size):
+        chunk = cids[start:start + chunk_size]
+
+        # Candidate ids are sorted, so query the chunk's range of ids rather
+        # than a (possibly very long) list of them
+        q = session.query(annotation_class.candidate_id, annotation_class.key_id, annotation_class.value)
+        q = q.filter(annotation_class.candidate_id >= chunk[0])
+        q = q.filter(annotation_class.candidate_id <= chunk[-1])
+        yield _build_matrix(matrix_class, annotation_key_class, chunk,
+            kid_to_col, col_to_kid, q.all(), zero_one)
+
+
+def _matrix_index(annotation_key_class, session, split=0, cids_query=None,
+    key_group=0, key_names=None):
+    """
+    Returns the rows and columns of the annotation matrix of load_matrix and
+    iter_matrix_chunks: the sorted, distinct candidate ids of the split (or
+    cids_query), and the maps between the ids of the AnnotationKeys of
+    key_group (optionally only those named in key_names) and the columns.
+    """
     cid_query = cids_query or session.query(Candidate.id)\
                                      .filter(Candidate.split == split)
     cid_query = cid_query.order_by(Candidate.id)
@@ -333,18 +490,12 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
         keys_query = keys_query.filter(annotation_key_class.name.in_(frozenset(key_names)))
     keys_query = keys_query.order_by(annotation_key_class.id)
 
-    # First, we query to construct the row index map
-    cid_to_row = {}
-    row_to_cid = {}
+    # The candidate ids are sorted, so duplicates are adjacent
+    cids = []
     for cid, in cid_query.all():
-        if cid not in cid_to_row:
-            j = len(cid_to_row)
-
-            # Create both mappings
-            cid_to_row[cid] = j
-            row_to_cid[j]   = cid
+        if len(cids) == 0 or cid != cids[-1]:
+            cids.append(cid)
 
-    # Second, we query to construct the column index map
     kid_to_col = {}
     col_to_kid = {}
     for kid, in keys_query.all():
@@ -354,34 +505,43 @@ def load_matrix(matrix_class, annotation_key_class, annotation_class, session,
             # Create both mappings
             kid_to_col[kid] = j
             col_to_kid[j]   = kid
+    return cids, kid_to_col, col_to_kid
 
-    # Create sparse matrix in LIL format for incremental construction
-    X = sparse.lil_matrix((len(cid_to_row), len(kid_to_col)), dtype=np.int64)
 
-    # NOTE: This is much faster as it allows us to skip the above join (which for some reason is
-    # unreasonably slow) by relying on our symbol tables from above; however this will get slower with
-    # The total number of annotations in DB which is weird behavior...
-    q = session.query(annotation_class.candidate_id, annotation_class.key_id, annotation_class.value)
-    q = q.order_by(annotation_class.candidate_id)
+def _build_matrix(matrix_class, annotation_key_class, cids, kid_to_col,
+    col_to_kid, annotations, zero_one=False):
+    """
+    Assembles (candidate id, key id, value) tuples into an annotation matrix
+    with a row per candidate id in cids, skipping the tuples of other
+    candidates or keys
+    """
+    cid_to_row = dict((cid, i) for i, cid in enumerate(cids))
+    row_to_cid = dict(enumerate(cids))
 
-    # Iteratively construct row index and output sparse matrix
-    for cid, kid, val in q.all():
+    rows, cols, vals = [], [], []
+    for cid, kid, val in annotations:
         if cid in cid_to_row and kid in kid_to_col:
             # Optionally restricts val range to {0,1}, mapping -1 -> 0
             if zero_one:
                 val = 1 if val == 1 else 0
-            X[cid_to_row[cid], kid_to_col[kid]] = int(val)
-
-    # Return as an AnnotationMatrix
-    Xr = matrix_class(X, candidate_index=cid_to_row, row_index=row_to_cid,
+            if val != 0:
+                rows.append(cid_to_row[cid])
+                cols.append(kid_to_col[kid])
+                vals.append(int(val))
+    X = sparse.coo_matrix((np.array(vals, dtype=np.int64), (rows, cols)),
+        shape=(len(cids), len(kid_to_col)))
+    return matrix_class(X.tocsr(), candidate_index=cid_to_row, row_index=row_to_cid,
                         annotation_key_cls=annotation_key_class, key_index=kid_to_col, col_index=col_to_kid)
-    return np.squeeze(Xr.toarray()) if load_as_array else Xr
 
 
 def load_label_matrix(session, **kwargs):
     return load_matrix(csr_LabelMatrix, LabelKey, Label, session, **kwargs)
 
 
+def iter_label_matrix_chunks(session, **kwargs):
+    return iter_matrix_chunks(csr_LabelMatrix, LabelKey, Label, session, **kwargs)
+
+
 def load_feature_matrix(session, **kwargs):
     return load_matrix(csr_AnnotationMatrix, FeatureKey, Feature, session, **kwargs)
 
@@ -390,14 +550,82 @@ def load_gold_labels(session, annotator_name, **kwargs):
     return load_matrix(csr_LabelMatrix, GoldLabelKey, GoldLabel, session, key_names=[annotator_name], **kwargs)
 
 
+class LFTimeoutError(BaseException):
+    """
+    Raised when the LFs exceed their wall-clock budget for a candidate. Like
+    KeyboardInterrupt, it does not derive from Exception, so that it is not
+    caught by the except Exception clauses of LFs.
+    """
+    pass
+
+
+def _raise_lf_timeout(signum, frame):
+    raise LFTimeoutError()
+
+
+def apply_lfs_isolated(lfs, c, fault_tolerant=True, timeout=None):
+    """
+    Applies a list of labeling functions to a candidate c, returning a list of
+    (LF name, label) pairs in which failed LFs have a FailedAnnotation as label.
+
+    :param fault_tolerant: If True, exceptions raised by an LF are caught;
+        otherwise they are re-raised
+    :param timeout: Optional wall-clock budget in seconds for applying all the
+        LFs to c. The LF running when the budget expires and all LFs after it
+        are marked as failed. Uses SIGALRM, so only available on Unix and from
+        the main thread of a process.
+    """
+    labels = []
+    if timeout is not None:
+        handler = signal.signal(signal.SIGALRM, _raise_lf_timeout)
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    try:
+        for lf in lfs:
+            try:
+                label = lf(c)
+            except Exception:
+                if not fault_tolerant:
+                    raise
+                label = FailedAnnotation()
+            labels.append((lf.__name__, label))
+
+        # Disarms the timer, which may also expire after the last LF returned,
+        # in which case there are no LFs left to mark as failed below
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+    except LFTimeoutError:
+        for lf in lfs[len(labels):]:
+            labels.append((lf.__name__, FailedAnnotation(timeout=True)))
+    finally:
+        if timeout is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, handler)
+    return labels
+
+
 class LabelAnnotator(Annotator):
     """Apply labeling functions to the candidates, generating Label annotations
 
     :param lfs: A _list_ of labeling functions (LFs)
+    :param fault_tolerant: If True, an LF raising an exception on a candidate
+        is recorded as an abstain rather than aborting the run. Per-LF error
+        counts are available in error_counts after apply(). Requires lfs.
+    :param timeout: Optional per-candidate wall-clock budget (in seconds) for
+        applying all LFs; LFs still running or not yet run when it expires are
+        recorded as abstains and counted in error_counts. Requires lfs.
     """
-    def __init__(self, lfs=None, label_generator=None):
-        if lfs is not None:
+    matrix_class = csr_LabelMatrix
+
+    def __init__(self, lfs=None, label_generator=None, fault_tolerant=False,
+        timeout=None):
+        if lfs is not None and (fault_tolerant or timeout is not None):
+            lfs = list(lfs)
+            labels = lambda c : apply_lfs_isolated(lfs, c,
+                fault_tolerant=fault_tolerant, timeout=timeout)
+        elif lfs is not None:
             labels = lambda c : [(lf.__name__, lf(c)) for lf in lfs]
+        elif fault_tolerant or timeout is not None:
+            raise ValueError("fault_tolerant and timeout require the lfs kwarg.")
         elif label_generator is not None:
             labels = lambda c : label_generator(c)
         else:
@@ -411,6 +639,10 @@ class LabelAnnotator(Annotator):
                 # mapped correctly
                 if type(label) == int:
                     yield lf_key, label
+                # Failed LFs are passed through to be counted and stored as
+                # abstains by the reducer
+                elif isinstance(label, FailedAnnotation):
+                    yield lf_key, label
                 # None is a protected LF output value corresponding to 0,
                 # representing LF abstaining
                 elif label is None:
@@ -0,0 +1,300 @@
+"""
+End-to-end benchmark of the Snorkel pipeline on a synthetic corpus.
+
+Runs the document -> sentence -> candidate -> label -> marginals pipeline,
+i.e., RuleBasedParser with CorpusParser, CandidateExtractor, LabelAnnotator,
+load_label_matrix, GenerativeModel and save_marginals, on a corpus generated
+by SyntheticDocPreprocessor, without tutorial data, CoreNLP or spaCy models.
+For each stage it reports the throughput and the number of statements
+executed against the database, i.e., DB round trips.
+
+The stages clear the existing contexts, candidates, labels and training
+marginals, so use a dedicated database. As the database is configured from
+SNORKELDB when snorkel is imported, benchmark_pipeline runs against the
+configured database, and the command line runs each database given in its
+own process, e.g.:
+
+    python -m snorkel.benchmark --db sqlite:///benchmark.db \\
+        postgresql://localhost/snorkel_benchmark --output pipeline.json
+"""
+from __future__ import division, print_function
+
+from .annotations import LabelAnnotator, load_label_matrix, save_marginals
+from .candidates import CandidateExtractor, Ngrams
+from .learning import GenerativeModel
+from .learning.benchmark import read_benchmark, write_benchmark
+from .matchers import DictionaryMatch
+from .models import Document, Sentence, candidate_subclass
+from .models.meta import SnorkelSession, snorkel_conn_string
+from .parser import CorpusParser, DocPreprocessor, RuleBasedParser, Tokenizer
+from collections import OrderedDict
+from pandas import DataFrame
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from time import time
+import numpy as np
+import re
+
+BenchmarkPair = candidate_subclass('BenchmarkPair', ['person', 'organization'])
+
+
+class SyntheticDocPreprocessor(DocPreprocessor):
+    """
+    Generates a synthetic corpus of Documents, each with sentences_per_doc
+    newline-separated sentences relating a person and an organization, e.g.:
+
+        person3 w17 w204 yes2 w9 org41 w88 .
+
+    Each sentence has a hidden binary label, and contains the keyword of LF k
+    (yesk or nok, see synthetic_lfs) with probability coverage, agreeing with
+    the label with probability accuracies[k].
+
+    :param n_docs: number of Documents
+    :param n_lfs: number of LFs whose keywords to include
+    :param words_per_sentence: number of filler words per sentence
+    :param n_entities: number of distinct persons and organizations
+    """
+    def __init__(self, n_docs=100, sentences_per_doc=10, n_lfs=10,
+        coverage=0.3, words_per_sentence=10, n_entities=100, seed=0):
+        super(SyntheticDocPreprocessor, self).__init__(None,
+            max_docs=n_docs)
+        self.sentences_per_doc = sentences_per_doc
+        self.n_lfs = n_lfs
+        self.coverage = coverage
+        self.words_per_sentence = words_per_sentence
+        self.n_entities = n_entities
+        self.seed = seed
+        self.accuracies = np.random.RandomState(seed).uniform(0.6, 0.9, n_lfs)
+
+    @property
+    def persons(self):
+        return ['person%d' % i for i in range(self.n_entities)]
+
+    @property
+    def organizations(self):
+        return ['org%d' % i for i in range(self.n_entities)]
+
+    def generate(self):
+        rng = np.random.RandomState(self.seed)
+        for i in range(int(self.max_docs)):
+            name = 'synthetic%d' % i
+            doc = Document(name=name, stable_id=self.get_stable_id(name),
+                meta={'synthetic': True})
+            sentences = [self._sentence(rng)
+                for _ in range(self.sentences_per_doc)]
+            yield doc, '\n'.join(sentences)
+
+    def _sentence(self, rng):
+        y = rng.rand() < 0.5
+        words = ['w%d' % w for w in
+            rng.randint(1000, size=self.words_per_sentence)]
+        for k in np.flatnonzero(rng.rand(self.n_lfs) < self.coverage):
+            correct = rng.rand() < self.accuracies[k]
+            words.insert(rng.randint(len(words) + 1),
+                ('yes%d' if y == correct else 'no%d') % k)
+        # The person comes first, and the organization after it
+        a, b = sorted(rng.choice(len(words) + 1, 2, replace=False))
+        words.insert(b, 'org%d' % rng.randint(self.n_entities))
+        words.insert(a, 'person%d' % rng.randint(self.n_entities))
+        return ' '.join(words + ['.'])
+
+
+class PatternTokenizer(Tokenizer):
+    """
+    Splits a string into the matches of a regular expression, with their
+    character offsets, e.g., words for r'\\S+' or lines for r'[^\\n]+'
+    """
+    def __init__(self, pattern=r'\S+'):
+        super(PatternTokenizer, self).__init__()
+        self.pattern = re.compile(pattern)
+
+    def apply(self, s):
+        return [(m.group(), m.start()) for m in self.pattern.finditer(s)]
+
+
+def synthetic_lfs(n_lfs=10):
+    """
+    Returns the LFs of a corpus generated by SyntheticDocPreprocessor, where
+    LF k labels a BenchmarkPair 1 if its sentence contains yesk, and -1 if
+    it contains nok
+    """
+    def keyword_lf(k):
+        yes, no = 'yes%d' % k, 'no%d' % k
+
+        def lf(c):
+            words = c.get_parent().words
+            return 1 if yes in words else -1 if no in words else 0
+        lf.__name__ = 'LF_keyword_%d' % k
+        return lf
+    return [keyword_lf(k) for k in range(n_lfs)]
+
+
+class StatementCounter(object):
+    """
+    Counts the statements executed by any SQLAlchemy Engine, i.e., the DB
+    round trips, while in a with block. Statements executed by UDF processes,
+    with parallelism > 1, are not counted.
+    """
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+        executemany):
+        self.count += 1
+
+    def __enter__(self):
+        self.count = 0
+        event.listen(Engine, 'before_cursor_execute', self)
+        return self
+
+    def __exit__(self, *args):
+        event.remove(Engine, 'before_cursor_execute', self)
+
+
+def benchmark_pipeline(n_docs=100, sentences_per_doc=10, n_lfs=10,
+    coverage=0.3, n_max=3, epochs=10, parallelism=None, seed=0, output=None,
+    verbose=False):
+    """
+    Benchmarks the stages of the pipeline on a synthetic corpus against the
+    configured database.
+
+    :param n_docs: number of Documents, see SyntheticDocPreprocessor
+    :param sentences_per_doc: number of Sentences per Document
+    :param n_lfs: number of LFs
+    :param coverage: probability of each LF labeling each candidate
+    :param n_max: n_max of the Ngrams candidate spaces
+    :param epochs: epochs for GenerativeModel.train
+    :param parallelism: parallelism of the UDFs, which requires Postgres
+    :param output: if set, path to write the results to as JSON, or as CSV if
+        it ends with .csv, see snorkel.learning.benchmark.write_benchmark
+    :return: a DataFrame with a row per stage, with the number of items
+        processed (e.g., candidates), the seconds taken, the throughput in
+        items per second, and the DB round trips
+    """
+    session = SnorkelSession()
+    corpus = SyntheticDocPreprocessor(n_docs=n_docs,
+        sentences_per_doc=sentences_per_doc, n_lfs=n_lfs, coverage=coverage,
+        seed=seed)
+    parser = RuleBasedParser(tokenizer=PatternTokenizer(r'\S+'),
+        sent_boundary=PatternTokenizer(r'[^\n]+'))
+    extractor = CandidateExtractor(BenchmarkPair,
+        [Ngrams(n_max=n_max), Ngrams(n_max=n_max)],
+        [DictionaryMatch(d=corpus.persons),
+            DictionaryMatch(d=corpus.organizations)])
+    labeler = LabelAnnotator(lfs=synthetic_lfs(n_lfs))
+    gen_model = GenerativeModel(lf_propensity=True, seed=seed)
+    state = {}
+
+    def parse():
+        CorpusParser(parser=parser).apply(corpus, parallelism=parallelism,
+            progress_bar=False)
+        return session.query(Document).count(), 'documents'
+
+    def extract():
+        sentences = session.query(Sentence).all()
+        extractor.apply(sentences, split=0, parallelism=parallelism,
+            progress_bar=False)
+        return len(sentences), 'sentences'
+
+    def label():
+        L = labeler.apply(split=0, parallelism=parallelism,
+            progress_bar=False)
+        return L.shape[0], 'candidates'
+
+    def load():
+        state['L'] = load_label_matrix(session, split=0)
+        return state['L'].shape[0], 'candidates'
+
+    def train():
+        gen_model.train(state['L'], epochs=epochs)
+        return state['L'].shape[0] * epochs, 'candidate epochs'
+
+    def marginals():
+        state['marginals'] = gen_model.marginals(state['L'])
+        return state['L'].shape[0], 'candidates'
+
+    def save():
+        save_marginals(session, state['L'], state['marginals'])
+        return state['L'].shape[0], 'candidates'
+
+    db = snorkel_conn_string.split(':', 1)[0]
+    results = []
+    for stage, f in (('parse', parse), ('extract', extract),
+        ('label', label), ('load_label_matrix', load), ('train', train),
+        ('marginals', marginals), ('save_marginals', save)):
+        with StatementCounter() as counter:
+            t = time()
+            n_items, units = f()
+            seconds = time() - t
+        results.append(OrderedDict([
+            ('db', db),
+            ('operation', stage),
+            ('items', n_items),
+            ('units', units),
+            ('seconds', seconds),
+            ('throughput', n_items / seconds if seconds > 0 else np.inf),
+            ('round_trips', counter.count),
+            ('round_trips_per_item', counter.count / max(n_items, 1)),
+        ]))
+        if verbose:
+            print("%s: %d %s in %.3fs, %.1f/s, %d round trips" % (stage,
+                n_items, units, seconds, results[-1]['throughput'],
+                counter.count))
+    session.close()
+
+    results = DataFrame(results)
+    if output is not None:
+        write_benchmark(results, output)
+    return results
+
+
+if __name__ == '__main__':
+    import argparse
+    import os
+    import pandas as pd
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    parser = argparse.ArgumentParser(description="Benchmarks the Snorkel "
+        "pipeline end to end on a synthetic corpus.")
+    parser.add_argument('--db', nargs='+', help="connection strings of the "
+        "databases to benchmark, each in its own process, instead of the "
+        "one configured by SNORKELDB")
+    parser.add_argument('--n_docs', type=int, default=100)
+    parser.add_argument('--sentences_per_doc', type=int, default=10)
+    parser.add_argument('--n_lfs', type=int, default=10)
+    parser.add_argument('--coverage', type=float, default=0.3)
+    parser.add_argument('--n_max', type=int, default=3)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--parallelism', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='pipeline_benchmark.json')
+    args = parser.parse_args()
+
+    if not args.db:
+        benchmark_pipeline(n_docs=args.n_docs,
+            sentences_per_doc=args.sentences_per_doc, n_lfs=args.n_lfs,
+            coverage=args.coverage, n_max=args.n_max, epochs=args.epochs,
+            parallelism=args.parallelism, seed=args.seed, output=args.output,
+            verbose=True)
+        sys.exit(0)
+
+    # Reruns this module for each database, with the other arguments
+    argv = []
+    for name, value in sorted(vars(args).items()):
+        if name not in ('db', 'output') and value is not None:
+            argv += ['--' + name, str(value)]
+    results, tmp_dir = [], tempfile.mkdtemp()
+    try:
+        for i, db in enumerate(args.db):
+            output = os.path.join(tmp_dir, '%d.json' % i)
+            print("Benchmarking %s" % db)
+            subprocess.check_call([sys.executable, '-m', 'snorkel.benchmark']
+                + argv + ['--output', output],
+                env=dict(os.environ, SNORKELDB=db))
+            results.append(read_benchmark(output))
+    finally:
+        shutil.rmtree(tmp_dir)
+    write_benchmark(pd.concat(results, ignore_index=True), args.output)
@@ -0,0 +1,302 @@
+"""
+Storage and lightweight inference for trained generative models.
+
+A model saved with snorkel.learning.GenerativeModel.save is a directory with
+a JSON metadata file, including the LF names, and an uncompressed NumPy .npz
+archive holding the LF weights as dense vectors and the dependency weights as
+CSR arrays, which is memory-mapped when loading.
+
+This module only depends on NumPy and SciPy, and lives outside of
+snorkel.learning so that saved models can be loaded and applied with
+GenerativeModelInference without importing numbskull or TensorFlow.
+"""
+import json
+import numpy as np
+import os
+import scipy.sparse as sparse
+import struct
+import zipfile
+
+GENERATIVE_MODEL_FORMAT = 'snorkel.GenerativeModel'
+GENERATIVE_MODEL_FORMAT_VERSION = 1
+
+METADATA_FILE = 'metadata.json'
+WEIGHTS_FILE = 'weights.npz'
+
+OPTIONAL_NAMES = ('lf_prior', 'lf_propensity', 'lf_class_propensity')
+DEP_NAMES = ('dep_similar', 'dep_fixing', 'dep_reinforcing', 'dep_exclusive')
+
+
+class GenerativeModelWeights(object):
+    """
+    The weights of a generative model over n LFs, with the dependency weights
+    stored as n x n CSR matrices.
+    """
+    def __init__(self, n):
+        self.n = n
+        self.class_prior = 0.0
+        self.lf_accuracy = np.zeros(n, dtype=np.float64)
+        for optional_name in OPTIONAL_NAMES:
+            setattr(self, optional_name, np.zeros(n, dtype=np.float64))
+
+        for dep_name in DEP_NAMES:
+            setattr(self, dep_name, sparse.csr_matrix((n, n), dtype=np.float64))
+
+        # Names of the LFs, if known, used to match LFs when warm starting
+        # GenerativeModel.train from these weights
+        self.lf_names = None
+
+    def is_sign_sparsistent(self, other, threshold=0.1):
+        """
+        Whether every weight of self and other is either within threshold of
+        zero for both, or beyond threshold with the same sign for both.
+        """
+        if self.n != other.n:
+            raise ValueError("Dimension mismatch. %d versus %d" % (self.n, other.n))
+
+        for name in ('class_prior', 'lf_accuracy') + OPTIONAL_NAMES:
+            if not np.array_equal(
+                    _sign_classes(np.atleast_1d(getattr(self, name)), threshold),
+                    _sign_classes(np.atleast_1d(getattr(other, name)), threshold)):
+                return False
+
+        # Only entries stored in either matrix can differ, so compares the
+        # sparse matrices of sign classes
+        for name in DEP_NAMES:
+            if (_sparse_sign_classes(getattr(self, name), threshold) !=
+                    _sparse_sign_classes(getattr(other, name), threshold)).nnz > 0:
+                return False
+
+        return True
+
+
+class GenerativeModelInference(object):
+    """
+    Computes the marginals of a trained generative model from its weights,
+    e.g., as loaded from a model saved with GenerativeModel.save, without
+    numbskull. Scoped categoricals are not supported.
+
+    :param weights: a GenerativeModelWeights instance
+    :param cardinality: number of possible classes
+    """
+    def __init__(self, weights, cardinality=2, name=None):
+        self.name = name or self.__class__.__name__
+        self.weights = weights
+        self.cardinality = cardinality
+
+    @classmethod
+    def load(cls, model_name, save_dir='checkpoints', mmap=True):
+        """Load a model saved with GenerativeModel.save."""
+        weights, metadata = load_generative_model(
+            os.path.join(save_dir, model_name), mmap=mmap)
+        return cls(weights, cardinality=metadata['cardinality'],
+            name=metadata.get('name'))
+
+    def marginals(self, L):
+        """
+        Given an M x N label matrix, returns an M-dim array of the marginal
+        probabilities of each candidate being True if binary, or else an
+        M x K matrix of the marginal probabilities of each class. See
+        GenerativeModel.marginals.
+        """
+        if self.cardinality == 2:
+            return marginals_binary(self.weights, L)
+        return marginals_categorical(self.weights, L, self.cardinality)
+
+
+def marginals_binary(weights, L):
+    """
+    Computes binary marginals with sparse matrix-vector products over L,
+    i.e. the log-odds of each candidate are
+
+        2 * class_prior + 2 * L.dot(lf_accuracy)
+            + 2 * |L|.dot(lf_class_propensity) + dependency terms
+
+    where the fixing and reinforcing terms are computed from the
+    indicator matrices of positive (P) and negative (N) labels.
+    """
+    L = sparse.csr_matrix(L)
+    P = sparse.csr_matrix(((L.data == 1).astype(np.float64), L.indices,
+        L.indptr), shape=L.shape)
+    N = sparse.csr_matrix(((L.data == -1).astype(np.float64), L.indices,
+        L.indptr), shape=L.shape)
+
+    w = weights
+    log_odds = 2 * w.class_prior * np.ones(L.shape[0])
+    log_odds += 2 * (P - N).dot(w.lf_accuracy)
+    log_odds += 2 * (P + N).dot(w.lf_class_propensity)
+
+    # Pairwise terms, for ordered pairs (j, k) of LFs both labeling a
+    # candidate, e.g. for fixing: +w[j, k] if L_j = -1 and L_k = 1, and
+    # -w[j, k] if L_j = 1 and L_k = -1
+    fixing = _off_diagonal(w.dep_fixing)
+    if fixing.nnz > 0:
+        log_odds += _row_sums(N.dot(fixing).multiply(P))
+        log_odds -= _row_sums(P.dot(fixing).multiply(N))
+    reinforcing = _off_diagonal(w.dep_reinforcing)
+    if reinforcing.nnz > 0:
+        log_odds += _row_sums(P.dot(reinforcing).multiply(P))
+        log_odds -= _row_sums(N.dot(reinforcing).multiply(N))
+
+    return 1 / (1 + np.exp(-1 * log_odds))
+
+
+def marginals_categorical(weights, L, cardinality):
+    """
+    Computes categorical marginals as a row-wise softmax over the M x K
+    matrix of summed accuracy weights of the LFs voting for each class.
+    """
+    L = sparse.csr_matrix(L)
+    m, n = L.shape
+    rows = np.repeat(np.arange(m), np.diff(L.indptr))
+    cols, data = L.indices, L.data
+    nz = data != 0
+    rows, cols, data = rows[nz], cols[nz], data[nz]
+
+    illegal = np.flatnonzero((data < 1) | (data > cardinality))
+    if len(illegal) > 0:
+        i = illegal[0]
+        raise ValueError(
+            """Illegal value at %d, %d: %d. Must be in 0 to
+            %d.""" % (rows[i], cols[i], data[i], cardinality))
+
+    # NB: class priors, LF class propensity, and fixing and reinforcing
+    # dependencies not currently available for categoricals
+    scores = sparse.coo_matrix(
+        (2 * weights.lf_accuracy[cols], (rows, data.astype(np.int64) - 1)),
+        shape=(m, cardinality)).toarray()
+
+    # Get softmax
+    scores -= scores.max(axis=1).reshape(m, 1)
+    exps = np.exp(scores)
+    return exps / exps.sum(axis=1).reshape(m, 1)
+
+
+def save_generative_model(model_dir, weights, **metadata):
+    """
+    Saves generative model weights to model_dir in the format described
+    above, with the keyword arguments, e.g., the cardinality, as metadata.
+
+    :param weights: a GenerativeModelWeights instance
+    """
+    if not os.path.exists(model_dir):
+        os.makedirs(model_dir)
+
+    arrays = {'lf_accuracy': np.asarray(weights.lf_accuracy, np.float64)}
+    for optional_name in OPTIONAL_NAMES:
+        arrays[optional_name] = np.asarray(getattr(weights, optional_name),
+            np.float64)
+    for dep_name in DEP_NAMES:
+        dep = sparse.csr_matrix(getattr(weights, dep_name), dtype=np.float64)
+        dep.eliminate_zeros()
+        arrays[dep_name + '_data'] = dep.data
+        arrays[dep_name + '_indices'] = dep.indices.astype(np.int64)
+        arrays[dep_name + '_indptr'] = dep.indptr.astype(np.int64)
+    np.savez(os.path.join(model_dir, WEIGHTS_FILE), **arrays)
+
+    metadata.update({
+        'format': GENERATIVE_MODEL_FORMAT,
+        'version': GENERATIVE_MODEL_FORMAT_VERSION,
+        'n': int(weights.n),
+        'class_prior': float(weights.class_prior),
+        'lf_names': getattr(weights, 'lf_names', None)
+    })
+    with open(os.path.join(model_dir, METADATA_FILE), 'w') as f:
+        json.dump(metadata, f, indent=2, sort_keys=True)
+
+
+def load_generative_model(model_dir, mmap=True):
+    """
+    Loads generative model weights saved with save_generative_model.
+
+    :param mmap: whether to memory-map the weight arrays (read-only) rather
+        than reading them into memory
+    :return: (weights, metadata), a GenerativeModelWeights instance and the
+        metadata dictionary
+    """
+    with open(os.path.join(model_dir, METADATA_FILE)) as f:
+        metadata = json.load(f)
+    if metadata.get('format') != GENERATIVE_MODEL_FORMAT:
+        raise ValueError("%s is not a saved generative model." % model_dir)
+    if metadata['version'] > GENERATIVE_MODEL_FORMAT_VERSION:
+        raise ValueError("Model format version %s is newer than the "
+            "supported version %s." % (metadata['version'],
+                GENERATIVE_MODEL_FORMAT_VERSION))
+
+    arrays = _load_npz(os.path.join(model_dir, WEIGHTS_FILE), mmap)
+    n = metadata['n']
+    weights = GenerativeModelWeights(n)
+    weights.class_prior = metadata['class_prior']
+    weights.lf_names = metadata['lf_names']
+    weights.lf_accuracy = arrays['lf_accuracy']
+    for optional_name in OPTIONAL_NAMES:
+        setattr(weights, optional_name, arrays[optional_name])
+    for dep_name in DEP_NAMES:
+        setattr(weights, dep_name, sparse.csr_matrix((
+            arrays[dep_name + '_data'], arrays[dep_name + '_indices'],
+            arrays[dep_name + '_indptr']), shape=(n, n), copy=False))
+    return weights, metadata
+
+
+def _load_npz(path, mmap=True):
+    """
+    Loads the arrays of an .npz archive, memory-mapping those stored
+    uncompressed (as by np.savez) if mmap
+    """
+    arrays = {}
+    with zipfile.ZipFile(path) as archive:
+        for info in archive.infolist():
+            name = info.filename[:-len('.npy')]
+            if mmap and info.compress_type == zipfile.ZIP_STORED:
+                arrays[name] = _memmap_npz_member(path, info)
+            else:
+                arrays[name] = np.lib.format.read_array(archive.open(info))
+    return arrays
+
+
+def _memmap_npz_member(path, info):
+    """Memory-maps the .npy file stored uncompressed as info in an archive"""
+    with open(path, 'rb') as f:
+        # The data follows the local file header, whose file name and extra
+        # field lengths are at bytes 26 to 30
+        f.seek(info.header_offset)
+        name_length, extra_length = struct.unpack('<HH', f.read(30)[26:30])
+        f.seek(info.header_offset + 30 + name_length + extra_length)
+        version = np.lib.format.read_magic(f)
+        read_header = getattr(np.lib.format,
+            'read_array_header_%s_%s' % version)
+        shape, fortran_order, dtype = read_header(f)
+        offset = f.tell()
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype)
+    return np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=shape,
+        order='F' if fortran_order else 'C')
+
+
+def _sign_classes(w, threshold):
+    """
+    Maps weights to 1 if above threshold, -1 if below -threshold, and 0 if
+    within threshold of zero
+    """
+    return np.where(w > threshold, 1, np.where(w < -threshold, -1, 0))
+
+
+def _sparse_sign_classes(X, threshold):
+    """Returns the sign classes of a sparse matrix as a CSR matrix"""
+    X = sparse.csr_matrix(X, dtype=np.float64, copy=True)
+    X.data = _sign_classes(X.data, threshold).astype(np.float64)
+    X.eliminate_zeros()
+    return X
+
+
+def _off_diagonal(X):
+    """Returns X as a CSR matrix without its diagonal entries"""
+    X = sparse.csr_matrix(X)
+    X = X - sparse.diags(X.diagonal(), 0)
+    X.eliminate_zeros()
+    return X
+
+
+def _row_sums(X):
+    """Returns the row sums of a sparse matrix as a flat array"""
+    return np.ravel(X.sum(axis=1))
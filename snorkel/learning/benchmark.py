@@ -0,0 +1,288 @@
+"""
+Benchmarks of the generative model stack on synthetic data.
+
+Times GenerativeModel.train, GenerativeModel.marginals,
+GenerativeModel.learned_lf_stats and DependencySelector.select over a grid of
+configurations, recording throughput and peak memory, e.g.:
+
+    results = benchmark_generative_model({'m': [10000], 'n': [50, 100]},
+        output='gen_benchmark.json')
+
+or, from the command line, python -m snorkel.learning.benchmark --m 10000
+--n 50 100 --output gen_benchmark.json --baseline last_release.json, which
+exits with an error if any throughput regressed compared to the baseline.
+"""
+from __future__ import division, print_function
+
+from .gen_learning import GenerativeModel, set_numba_seeds
+from .structure import DependencySelector, generate_label_matrix, \
+    generate_model, get_deps
+from collections import OrderedDict
+from itertools import product
+from pandas import DataFrame
+from time import time
+import json
+import numpy as np
+import os
+import platform
+import random
+import scipy.sparse as sparse
+import sys
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# The grid of configurations benchmarked by default: m candidates and n LFs,
+# each labeling a candidate with probability density, with DEP_SIMILAR
+# dependencies among pairs of LFs with probability dep_density
+DEFAULT_GRID = OrderedDict([
+    ('m',           [1000, 10000]),
+    ('n',           [10, 50]),
+    ('density',     [0.1, 0.5]),
+    ('dep_density', [0.0, 0.05]),
+    ('cardinality', [2, 3]),
+    ('threads',     [1, 4]),
+])
+
+OPERATIONS = ('train', 'marginals', 'learned_lf_stats', 'select')
+
+
+def benchmark_generative_model(grid=None, operations=OPERATIONS, epochs=10,
+    lf_stats_samples=1000, seed=0, trace_memory=True, output=None,
+    verbose=False):
+    """
+    Benchmarks the generative model stack for every configuration in a grid.
+
+    :param grid: dictionary mapping the parameters m, n, density, dep_density,
+        cardinality and threads to lists of values, defaulting to those in
+        DEFAULT_GRID
+    :param operations: operations to time, out of OPERATIONS
+    :param epochs: epochs for GenerativeModel.train
+    :param lf_stats_samples: samples for GenerativeModel.learned_lf_stats
+    :param seed: random seed, reset for each configuration
+    :param trace_memory: whether to record the peak memory allocated by each
+        operation with tracemalloc, which adds some overhead (on Python 2, the
+        peak resident set size of the process is recorded instead)
+    :param output: if set, path to write the results to as JSON, or as CSV if
+        it ends with .csv
+    :return: a DataFrame with a row per configuration and operation, with the
+        seconds taken, the throughput in units (e.g., candidates) per second,
+        and the peak memory in MB
+    """
+    params = OrderedDict(DEFAULT_GRID)
+    for k, v in (grid or {}).items():
+        if k not in params:
+            raise ValueError("Unrecognized grid parameter: %s" % k)
+        params[k] = v
+
+    results = []
+    for values in product(*params.values()):
+        config = OrderedDict(zip(params.keys(), values))
+        if verbose:
+            print("Benchmarking %s" % dict(config))
+        L, deps = _synthetic_data(seed=seed, **config)
+        config['n_deps'] = len(deps)
+        config['actual_density'] = L.nnz / np.prod(L.shape)
+
+        m, n, K, threads = L.shape[0], L.shape[1], config['cardinality'], \
+            config['threads']
+        gen_model = GenerativeModel(lf_propensity=True, seed=seed)
+        benchmarks = [
+            ('train', m * epochs, 'candidate epochs',
+                lambda: gen_model.train(L, deps=deps, epochs=epochs,
+                    cardinality=K, threads=threads)),
+            ('marginals', m, 'candidates', lambda: gen_model.marginals(L)),
+            ('learned_lf_stats', lf_stats_samples, 'samples',
+                lambda: gen_model.learned_lf_stats(n_samples=lf_stats_samples,
+                    threads=threads)),
+            ('select', m * n, 'labels',
+                lambda: DependencySelector().select(L, threads=threads,
+                    cardinality=K)),
+        ]
+        for operation, n_units, units, f in benchmarks:
+            # The model must be trained to time the other operations
+            if operation not in operations and operation != 'train':
+                continue
+            seconds, peak_memory = _measure(f, trace_memory)
+            if operation not in operations:
+                continue
+            result = OrderedDict(config)
+            result.update([
+                ('operation', operation),
+                ('seconds', seconds),
+                ('throughput', n_units / seconds if seconds > 0 else np.inf),
+                ('units', units),
+                ('peak_memory_mb', peak_memory),
+            ])
+            results.append(result)
+            if verbose:
+                print("\t%s: %.3fs, %.1f %s/s" % (operation, seconds,
+                    result['throughput'], units))
+
+    results = DataFrame(results)
+    if output is not None:
+        write_benchmark(results, output)
+    return results
+
+
+def write_benchmark(results, path):
+    """
+    Writes benchmark results to path as CSV if it ends with .csv, or else as
+    JSON, along with a description of the environment
+    """
+    if path.endswith('.csv'):
+        results.to_csv(path, index=False)
+        return
+    with open(path, 'w') as f:
+        json.dump({
+            'environment': _environment(),
+            'results': json.loads(results.to_json(orient='records')),
+        }, f, indent=2)
+
+
+def read_benchmark(path):
+    """Reads benchmark results written by write_benchmark as a DataFrame"""
+    if path.endswith('.csv'):
+        from pandas import read_csv
+        return read_csv(path)
+    with open(path) as f:
+        return DataFrame(json.load(f)['results'])
+
+
+def compare_benchmarks(baseline, results, tolerance=0.2, keys=None):
+    """
+    Compares the throughput of benchmark results to a baseline, e.g., read
+    with read_benchmark.
+
+    :param tolerance: relative decrease in throughput tolerated
+    :param keys: columns identifying a benchmark, by default the parameters
+        of DEFAULT_GRID and the operation
+    :return: a DataFrame of the configurations and operations in both, with
+        the baseline and current throughput and their ratio, sorted by ratio,
+        and a column regression marking those below 1 - tolerance
+    """
+    keys = list(keys or list(DEFAULT_GRID.keys()) + ['operation'])
+    merged = baseline[keys + ['throughput']].merge(results[keys +
+        ['throughput']], on=keys, suffixes=('_baseline', ''))
+    merged['ratio'] = merged['throughput'] / merged['throughput_baseline']
+    merged['regression'] = merged['ratio'] < 1 - tolerance
+    return merged.sort_values('ratio').reset_index(drop=True)
+
+
+def _synthetic_data(m, n, density, dep_density, cardinality, threads,
+    seed=0):
+    """
+    Generates an m x n synthetic label matrix with LFs labeling with
+    probability density, from a model sampled with generate_model.
+
+    Binary label matrices are sampled from the model with
+    generate_label_matrix. Categorical label matrices are sampled with the
+    LFs conditionally independent given the class, i.e., ignoring the
+    dependencies, which are still returned for training.
+    """
+    random.seed(seed)
+    set_numba_seeds(seed)
+    rng = np.random.RandomState(seed)
+
+    weights = generate_model(n, dep_density, dep_similar=dep_density > 0)
+    # Sets the propensity weights so that, ignoring dependencies, each LF
+    # labels with probability density, i.e.,
+    #   density = Z_l / (Z_l + 1),
+    # where Z_l = exp(propensity) * (exp(acc) + (K - 1) * exp(-acc)) is the
+    # unnormalized probability of labeling
+    acc = weights.lf_accuracy
+    weights.lf_propensity = np.log(density / (1 - density)) - np.log(
+        np.exp(acc) + (cardinality - 1) * np.exp(-acc))
+    deps = sorted(get_deps(weights, threshold=0.0))
+
+    if cardinality == 2:
+        _, L = generate_label_matrix(weights, m)
+        return L, deps
+
+    # Samples the class, and then each LF's label from its distribution
+    # over the correct class, the K - 1 incorrect classes and abstaining
+    y = rng.randint(1, cardinality + 1, m)
+    p_correct = np.exp(acc + weights.lf_propensity)
+    p_incorrect = np.exp(-acc + weights.lf_propensity)
+    Z = p_correct + (cardinality - 1) * p_incorrect + 1
+    u = rng.rand(m, n) * Z
+    correct = u < p_correct
+    labeled = u < p_correct + (cardinality - 1) * p_incorrect
+    wrong = rng.randint(1, cardinality, (m, n))
+    labels = np.where(correct, y[:, None],
+        np.where(wrong >= y[:, None], wrong + 1, wrong))
+    return sparse.csr_matrix(np.where(labeled, labels, 0)), deps
+
+
+def _measure(f, trace_memory):
+    """Returns the seconds taken by f() and its peak memory in MB"""
+    if not trace_memory:
+        t = time()
+        f()
+        return time() - t, None
+
+    if tracemalloc is None:
+        import resource
+        t = time()
+        f()
+        seconds = time() - t
+        # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return seconds, resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss * scale / 2 ** 20
+
+    tracemalloc.start()
+    try:
+        t = time()
+        f()
+        seconds = time() - t
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return seconds, peak / 2 ** 20
+
+
+def _environment():
+    """Describes the environment benchmarks ran in"""
+    import numbskull
+    import scipy
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count() if hasattr(os, 'cpu_count') else None,
+        'numpy': np.__version__,
+        'scipy': scipy.__version__,
+        'numbskull': getattr(numbskull, '__version__', None),
+    }
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(
+        description="Benchmarks the generative model stack on synthetic data.")
+    for name, values in DEFAULT_GRID.items():
+        parser.add_argument('--' + name, nargs='+', default=values,
+            type=float if 'density' in name else int)
+    parser.add_argument('--operations', nargs='+', default=OPERATIONS,
+        choices=OPERATIONS)
+    parser.add_argument('--epochs', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-trace-memory', action='store_true')
+    parser.add_argument('--output', default='gen_benchmark.json')
+    parser.add_argument('--baseline',
+        help="results to compare to, failing if any throughput regressed")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = benchmark_generative_model(
+        dict((name, getattr(args, name)) for name in DEFAULT_GRID),
+        operations=args.operations, epochs=args.epochs, seed=args.seed,
+        trace_memory=not args.no_trace_memory, output=args.output,
+        verbose=True)
+    if args.baseline:
+        comparison = compare_benchmarks(read_benchmark(args.baseline),
+            results, args.tolerance)
+        print(comparison.to_string())
+        if comparison['regression'].any():
+            sys.exit(1)
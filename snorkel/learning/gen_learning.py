@@ -1,4 +1,10 @@
+from ..gen_inference import (
+    DEP_NAMES, GenerativeModelWeights, OPTIONAL_NAMES, load_generative_model,
+    marginals_binary, marginals_categorical, save_generative_model,
+    _off_diagonal
+)
 from .classifier import Classifier
+from .utils import compress_label_matrix, iter_row_chunks, prune_deps
 from numba import jit
 import numbskull
 from numbskull import NumbSkull
@@ -7,10 +13,14 @@ from numbskull.numbskulltypes import Weight, Variable, Factor, FactorToVar
 import numpy as np
 import random
 import scipy.sparse as sparse
+from concurrent.futures import ThreadPoolExecutor
 from copy import copy
+from itertools import chain
 from pandas import DataFrame
 from distutils.version import StrictVersion
-from six.moves.cPickle import dump, load
+from six import iteritems, string_types
+from six.moves.cPickle import load
+from time import time
 import os
 
 DEP_SIMILAR = 0
@@ -18,6 +28,10 @@ DEP_FIXING = 1
 DEP_REINFORCING = 2
 DEP_EXCLUSIVE = 3
 
+# Fixed propensity weight conditioning LF label variables on not abstaining,
+# see GenerativeModel._compile_sparse
+LABELED_WEIGHT = 25.0
+
 
 class GenerativeModel(Classifier):
     """
@@ -32,9 +46,18 @@ class GenerativeModel(Classifier):
     :param lf_class_propensity: whether to include class-specific labeling
         function propensity factors
     :param seed: seed for initializing state of Numbskull variables
+    :param threads: default number of threads for all Gibbs sampling, i.e.,
+        train, train_streaming, and learned_lf_stats
+    :param parallelism: how training is parallelized over threads, either
+        'hogwild', in which the threads sample disjoint candidates and update
+        one shared copy of the weights without locking, or 'replicas', in
+        which each thread learns on its own shard of the candidates with its
+        own copy of the weights, and the updates of the copies are summed
+        after every epoch
     """
     def __init__(self, class_prior=False, lf_prior=False, lf_propensity=False,
-        lf_class_propensity=False, seed=271828, name=None):
+        lf_class_propensity=False, seed=271828, name=None, threads=1,
+        parallelism='hogwild'):
         self.name = name or self.__class__.__name__
         try:
             numbskull_version = numbskull.__version__
@@ -52,6 +75,13 @@ class GenerativeModel(Classifier):
         self.lf_class_propensity = lf_class_propensity
         self.weights = None
 
+        if parallelism not in ('hogwild', 'replicas'):
+            raise ValueError("Unknown parallelism %s, must be 'hogwild' or "
+                "'replicas'." % parallelism)
+        self.threads = threads
+        self.parallelism = parallelism
+        self._start_trajectory()
+
         self.rng = np.random.RandomState()
         self.rng.seed(seed)
         set_numba_seeds(seed)
@@ -64,16 +94,17 @@ class GenerativeModel(Classifier):
     #
     # These names are also used by other related classes, such as
     # GenerativeModelParameters
-    optional_names = ('lf_prior', 'lf_propensity', 'lf_class_propensity')
-    dep_names = (
-        'dep_similar', 'dep_fixing', 'dep_reinforcing', 'dep_exclusive'
-    )
+    optional_names = OPTIONAL_NAMES
+    dep_names = DEP_NAMES
 
     def train(self, L, deps=(), LF_acc_prior_weights=None,
         LF_acc_prior_weight_default=1, labels=None, label_prior_weight=5,
         init_deps=0.0, init_class_prior=-1.0, epochs=30, step_size=None, 
         decay=1.0, reg_param=0.1, reg_type=2, verbose=False, truncation=10, 
-        burn_in=5, cardinality=None, timer=None, candidate_ranges=None, threads=1):
+        burn_in=5, cardinality=None, timer=None, candidate_ranges=None,
+        threads=None, skip_abstains=False, compress=False, closed_form=False,
+        closed_form_init=False, init_weights=None, lf_names=None, tol=None,
+        patience=1, L_val=None, min_dep_overlap=None):
         """
         Fits the parameters of the model to a data set. By default, learns a
         conditionally independent model. Additional unary dependencies can be
@@ -120,10 +151,87 @@ class GenerativeModel(Classifier):
             candidates can take. If a label is outside of this range throws an
             error. If None, then each candidate can take any value from 0 to
             cardinality.
-        :param threads: the number of threads to use for sampling. Default is 1.
+        :param threads: the number of threads to use for sampling, by default
+            the threads the model was constructed with. How the threads share
+            the work is set by the parallelism option of the constructor. The
+            sampling throughput of each epoch is stored in epoch_throughput,
+            and printed if verbose.
+        :param skip_abstains: If True, compiles LF label variables and factors
+            only for the non-abstain entries of L, so that the size of the
+            factor graph scales with the number of labels rather than M x N.
+            Abstains are then accounted for in closed form: the accuracy
+            weights are fit conditioned on LFs labeling, and the LF propensity
+            weights are set to match the LF coverages. Requires
+            lf_propensity=True, and is not implemented with dependencies,
+            lf_prior, or lf_class_propensity factors.
+        :param compress: If True, collapses the candidates into their unique
+            label patterns (see snorkel.learning.utils.compress_label_matrix)
+            and trains on these, so that the cost of each epoch scales with
+            the number U of unique patterns rather than M. The gradient of
+            each pattern is weighted by the number of candidates sharing it
+            relative to the average, M / U, so that steps (and their
+            regularization) are on the scale of those of a single candidate,
+            and an epoch over the patterns amounts to U / M of an epoch over
+            the candidates. The weights converge to the same values as
+            without compress, taking about M / U times as many epochs (each
+            U / M as costly), or a larger step_size.
+        :param closed_form: If True, skips Gibbs sampling and instead
+            estimates the LF weights from the LF agreement statistics L^T L in
+            closed form, see _fit_moments. Only implemented for binary,
+            conditionally independent models without class_prior, lf_prior,
+            or lf_class_propensity factors.
+        :param closed_form_init: If True, initializes the learnable LF weights
+            to their closed form estimates before Gibbs sampling, under the
+            same restrictions as closed_form.
+        :param init_weights: Optionally, a GenerativeModelWeights instance,
+            e.g., from a previous training run, to initialize the weights
+            with instead of the defaults. LFs are matched to the LFs of
+            init_weights by name if both have names (see lf_names), or else by
+            position; the weights of LFs that are not matched start from their
+            priors as usual. See also fine_tune.
+        :param lf_names: Optionally, the names of the N LFs, e.g.,
+            [L.get_key(session, j).name for j in range(N)], which are stored
+            with the learned weights to match LFs when warm starting. By
+            default, these are read from L if it indexes its keys by name.
+        :param tol: If set, stops training early once the monitored quantity
+            changes by less than tol for patience consecutive epochs. If L_val
+            is given, this is the held-out log-likelihood, else the change of
+            the weights, relative to their norm.
+        :param patience: number of epochs without change to stop after
+        :param L_val: Optionally, a held-out label matrix with the same LFs as
+            L to compute the log-likelihood of after each epoch. Only
+            implemented for models without dependencies or scoped
+            categoricals.
+        :param min_dep_overlap: If set, drops the dependencies in deps
+            between LFs which label fewer than min_dep_overlap candidates in
+            common before compiling the factor graph, e.g., when training with
+            all pairs from snorkel.learning.structure.get_all_deps, see
+            snorkel.learning.utils.prune_deps. The weights of dropped
+            dependencies are zero.
+        :return: a DataFrame with the trajectory of training, with the weight
+            change, the held-out log-likelihood (if L_val is given), and the
+            sampling throughput of each epoch
         """
         m, n = L.shape
         step_size = step_size or 0.0001
+        threads = threads or self.threads
+        lf_names = self._lf_names(L, lf_names)
+
+        if skip_abstains:
+            self._check_skip_abstains(deps)
+        if closed_form or closed_form_init:
+            if len(deps) > 0 or self.class_prior or self.lf_prior or \
+                self.lf_class_propensity or candidate_ranges is not None:
+                raise NotImplementedError("Closed form estimates not "
+                    "implemented for dependencies, class_prior, lf_prior, "
+                    "lf_class_propensity factors, or scoped categoricals.")
+            if init_weights is not None:
+                raise ValueError("Cannot both warm start from init_weights "
+                    "and use closed form estimates.")
+        if L_val is not None and (len(deps) > 0 or
+            candidate_ranges is not None):
+            raise NotImplementedError("Held-out log-likelihood not "
+                "implemented for dependencies or scoped categoricals.")
 
         # Check to make sure matrix is int-valued
         element_type = type(L[0,0])
@@ -131,28 +239,8 @@ class GenerativeModel(Classifier):
             raise ValueError("""Label matrix must have int-type elements, 
                 but elements have type %s""" % element_type)
 
-        # Automatically infer cardinality
-        # Binary: Values in {-1, 0, 1} [Default]
-        # Categorical: Values in {0, 1, ..., K}
         if cardinality is None:
-            # If candidate_ranges is provided, use this to determine cardinality
-            if candidate_ranges is not None:
-                cardinality = max(map(max, candidate_ranges))
-            else:
-                # This is just an annoying hack for LIL sparse matrices...
-                try:
-                    lmax = L.max()
-                except AttributeError:
-                    lmax = L.tocoo().max()
-
-                if lmax > 2:
-                    cardinality = lmax
-                elif lmax < 2:
-                    cardinality = 2
-                else:
-                    raise ValueError(
-                        "L.max() == %s, cannot infer cardinality." % lmax)
-            print("Inferred cardinality: %s" % cardinality)
+            cardinality = self._infer_cardinality(L, candidate_ranges)
         self.cardinality = cardinality
 
         # Priors for LFs default to fixed prior value
@@ -175,6 +263,8 @@ class GenerativeModel(Classifier):
             is_fixed.append(True)
             LF_acc_prior_weights.append(label_prior_weight)
             n += 1
+            if lf_names is not None:
+                lf_names.append(None)
 
         # Reduce overhead of tracking indices by converting L to a CSR sparse matrix.
         L = sparse.csr_matrix(L).copy()
@@ -191,10 +281,31 @@ class GenerativeModel(Classifier):
             L, self.cardinalities, _ = self._remap_scoped_categoricals(L, 
                 self.candidate_ranges)
 
+        # Optionally drop the dependencies between LFs which rarely co-occur,
+        # as each one otherwise compiles a factor per candidate
+        if min_dep_overlap is not None and len(deps) > 0:
+            n_deps = len(deps)
+            deps = prune_deps(L, deps, min_overlap=min_dep_overlap)
+            if verbose:
+                print("Pruned %d of %d dependencies" % (n_deps - len(deps),
+                    n_deps))
+
+        # Optionally collapse candidates with identical label patterns
+        pattern_counts = None
+        if compress:
+            L, pattern_counts, index, _ = compress_label_matrix(L,
+                self.cardinalities)
+            self.cardinalities = self.cardinalities[index]
+            if self.candidate_ranges is not None:
+                self.candidate_ranges = [self.candidate_ranges[i] for i in index]
+            m = L.shape[0]
+
         # Shuffle the data points, cardinalities, and candidate_ranges
         idxs = range(m)
         self.rng.shuffle(idxs)
         L = L[idxs, :]
+        if pattern_counts is not None:
+            pattern_counts = pattern_counts[idxs]
         if candidate_ranges is not None:
             self.cardinalities = self.cardinalities[idxs]
             c_ranges_reshuffled = []
@@ -202,86 +313,625 @@ class GenerativeModel(Classifier):
                 c_ranges_reshuffled.append(self.candidate_ranges[i])
             self.candidate_ranges = c_ranges_reshuffled
 
-        # Compile factor graph
         self._process_dependency_graph(L, deps)
-        weight, variable, factor, ftv, domain_mask, n_edges = self._compile(
-            L, init_deps, init_class_prior, LF_acc_prior_weights, is_fixed, self.cardinalities)
-        fg = NumbSkull(
-            n_inference_epoch=0,
-            n_learning_epoch=epochs, 
-            stepsize=step_size,
-            decay=decay,
-            reg_param=reg_param,
-            regularization=reg_type,
-            truncation=truncation,
-            quiet=(not verbose),
-            verbose=verbose, 
-            learn_non_evidence=True,
-            burn_in=burn_in,
-            nthreads=threads
-        )
-        fg.loadFactorGraph(weight, variable, factor, ftv, domain_mask, n_edges)
+
+        # Estimate the LF weights from the LF agreement statistics
+        if closed_form or closed_form_init:
+            if self.cardinality != 2:
+                raise NotImplementedError("Closed form estimates not "
+                    "implemented for categorical classes.")
+            lf_accuracy, lf_propensity = self._closed_form_weights(L,
+                LF_acc_prior_weights, pattern_counts)
+
+        # Compile factor graph, one per replica if training replicas
+        if not closed_form:
+            row_weights = None
+            if pattern_counts is not None:
+                row_weights = pattern_counts / np.mean(pattern_counts)
+            graphs = []
+            shards = self._shard_rows(m, threads)
+            for rows in shards:
+                graph = self._compile_training_graph(
+                    L if len(shards) == 1 else L[rows], init_deps,
+                    init_class_prior, LF_acc_prior_weights, is_fixed,
+                    self.cardinalities[rows], skip_abstains,
+                    None if row_weights is None else row_weights[rows])
+                if closed_form_init:
+                    self._init_lf_weights(graph[0], LF_acc_prior_weights,
+                        is_fixed, lf_accuracy,
+                        None if skip_abstains else lf_propensity)
+                if init_weights is not None:
+                    self._warm_start_weights(graph[0], init_weights,
+                        self._match_lfs(init_weights, lf_names, n),
+                        LF_acc_prior_weights, is_fixed, skip_abstains)
+                graphs.append(graph)
 
         if timer is not None:
             timer.start()
-        fg.learning(out=False)
+        self._start_trajectory()
+        if closed_form:
+            weight = self._compile(sparse.coo_matrix((1, n), L.dtype),
+                init_deps, init_class_prior, LF_acc_prior_weights, is_fixed,
+                [self.cardinality])[0]
+            self._init_lf_weights(weight, LF_acc_prior_weights, is_fixed,
+                lf_accuracy, lf_propensity)
+            w = weight["initialValue"]
+        else:
+            learners = self._load_learners(graphs, threads,
+                reg_param=reg_param, regularization=reg_type,
+                truncation=truncation, quiet=(not verbose), verbose=verbose)
+            w = np.copy(learners[0].getFactorGraph().getWeights())
+            if skip_abstains:
+                expand = lambda w: self._expand_sparse_weights(w, is_fixed,
+                    _lf_coverage(L, pattern_counts), self.cardinalities,
+                    pattern_counts)
+            else:
+                expand = lambda w: w
+            for epoch in range(epochs):
+                start, w_prev = time(), w
+                w, n_samples = self._learning_epoch(learners,
+                    step_size * decay ** epoch, burn_in if epoch == 0 else 0)
+                log_likelihood = None
+                if L_val is not None:
+                    self._process_learned_weights(n, expand(w),
+                        LF_acc_prior_weights, is_fixed)
+                    log_likelihood = self._log_likelihood(L_val)
+                if self._end_epoch(epoch, w_prev, w, n_samples,
+                    time() - start, verbose, tol, patience, log_likelihood):
+                    break
+            w = expand(w)
         if timer is not None:
             timer.end()
-        self._process_learned_weights(L, fg, LF_acc_prior_weights, is_fixed)
 
         # Store info from factor graph
         if self.candidate_ranges is not None:
             self.cardinality_for_stats = int(max(self.cardinalities))
         else:
             self.cardinality_for_stats = self.cardinality
-        self.learned_weights = fg.factorGraphs[0].weight_value
+        self._set_learned_weights(w, init_deps, init_class_prior,
+            LF_acc_prior_weights, is_fixed, threads)
+        self.weights.lf_names = lf_names
+        self.cardinality = cardinality
+        return DataFrame(self._trajectory)
+
+    def fine_tune(self, L, epochs=5, lf_names=None, **kwargs):
+        """
+        Continues training the model on L, e.g., after adding new LFs or
+        candidates, starting from its current weights (see the init_weights
+        option of train), for a short schedule of epochs.
+
+        :param L: M x N label matrix, whose LFs are matched to the LFs the
+            model was trained with by name, see train
+        :param epochs: number of training epochs
+        :param lf_names: Optionally, the names of the N LFs, see train
+
+        See train for the other parameters. Unless deps is given, the model
+        keeps its dependencies among the LFs that are matched.
+        """
+        if self.weights is None:
+            raise ValueError("Must fit model with train() before fine tuning.")
+        if 'deps' not in kwargs:
+            kwargs['deps'] = self._matched_deps(self._match_lfs(self.weights,
+                self._lf_names(L, lf_names), L.shape[1]))
+        return self.train(L, epochs=epochs, init_weights=self.weights,
+            lf_names=lf_names, **kwargs)
+
+    def train_streaming(self, L, chunk_size=10000, deps=(),
+        LF_acc_prior_weights=None, LF_acc_prior_weight_default=1,
+        init_deps=0.0, init_class_prior=-1.0, epochs=30, step_size=None,
+        decay=1.0, reg_param=0.1, reg_type=2, verbose=False, truncation=10,
+        burn_in=5, cardinality=None, timer=None, threads=None,
+        skip_abstains=False, compress=False, tol=None, patience=1):
+        """
+        Fits the parameters of the model to a data set like train, but streams
+        over the label matrix in chunks of rows, compiling and sampling the
+        factor graph of one chunk at a time. This way, the label matrix never
+        has to be held in memory (or copied) as a whole.
+
+        Each epoch is one pass over the chunks. For each chunk, burn_in Gibbs
+        sweeps are taken, followed by one learning sweep, starting from the
+        weights learned on the previous chunks.
+
+        :param L: Either an M x N label matrix, e.g. memory-mapped from disk
+            (see snorkel.learning.utils.load_csr_memmap), which is read
+            chunk_size rows at a time, or a function returning a new iterable
+            of label matrix chunks for each epoch, e.g.
+            lambda: iter_label_matrix_chunks(session, chunk_size=10000) to
+            read them from the label table
+        :param chunk_size: number of rows per chunk if L is a label matrix
+        :param cardinality: number of possible classes; by default is inferred
+            from the first chunk
+
+        See train for the other parameters. Supervised labels, scoped
+        categoricals, and held-out log-likelihoods are not supported.
+        """
+        step_size = step_size or 0.0001
+        threads = threads or self.threads
+        if skip_abstains:
+            self._check_skip_abstains(deps)
+        if callable(L):
+            chunks = L
+        else:
+            chunks = lambda: iter_row_chunks(L, chunk_size)
+
+        if timer is not None:
+            timer.start()
+        w = None
+        m, lf_labeled = 0, 0
+        self._start_trajectory()
+        for epoch in range(epochs):
+            start, n_samples, w_prev = time(), 0, w
+            for L_chunk in chunks():
+                L_chunk = sparse.csr_matrix(L_chunk)
+                n = L_chunk.shape[1]
+
+                # Set up the model from the first chunk
+                if w is None:
+                    if cardinality is None:
+                        cardinality = self._infer_cardinality(L_chunk)
+                    self.cardinality = cardinality
+                    if LF_acc_prior_weights is None:
+                        LF_acc_prior_weights = \
+                            [LF_acc_prior_weight_default for _ in range(n)]
+                    else:
+                        LF_acc_prior_weights = list(copy(LF_acc_prior_weights))
+                    is_fixed = [False for _ in range(n)]
+                    self._process_dependency_graph(L_chunk, deps)
+
+                counts = None
+                if compress:
+                    L_chunk, counts, _, _ = compress_label_matrix(L_chunk)
+                idxs = self.rng.permutation(L_chunk.shape[0])
+                L_chunk = L_chunk[idxs, :]
+                if counts is not None:
+                    counts = counts[idxs]
+                    row_weights = counts / np.mean(counts)
+
+                # Track the LF coverages over the first pass
+                if epoch == 0:
+                    m_chunk = L_chunk.shape[0] if counts is None else \
+                        np.sum(counts)
+                    lf_labeled += m_chunk * _lf_coverage(L_chunk, counts)
+                    m += m_chunk
+
+                graphs = []
+                shards = self._shard_rows(L_chunk.shape[0], threads)
+                for rows in shards:
+                    L_shard = L_chunk if len(shards) == 1 else L_chunk[rows]
+                    graphs.append(self._compile_training_graph(L_shard,
+                        init_deps, init_class_prior, LF_acc_prior_weights,
+                        is_fixed,
+                        self.cardinality * np.ones(L_shard.shape[0], np.int64),
+                        skip_abstains,
+                        None if counts is None else row_weights[rows]))
+                learners = self._load_learners(graphs, threads, w,
+                    reg_param=reg_param, regularization=reg_type,
+                    truncation=truncation, quiet=(not verbose),
+                    verbose=verbose)
+                w, chunk_samples = self._learning_epoch(learners,
+                    step_size * decay ** epoch, burn_in)
+                n_samples += chunk_samples
+            if self._end_epoch(epoch, w_prev, w, n_samples, time() - start,
+                verbose, tol, patience):
+                break
+        if w is None:
+            raise ValueError("Label matrix has no rows.")
+        if skip_abstains:
+            w = self._expand_sparse_weights(w, is_fixed,
+                lf_labeled / float(m), [self.cardinality])
+        if timer is not None:
+            timer.end()
+
+        self.candidate_ranges = None
+        self.cardinality_for_stats = self.cardinality
+        self._set_learned_weights(w, init_deps, init_class_prior,
+            LF_acc_prior_weights, is_fixed, threads)
+        return DataFrame(self._trajectory)
+
+    def _check_skip_abstains(self, deps):
+        if not self.lf_propensity:
+            raise ValueError("skip_abstains requires lf_propensity=True.")
+        if len(deps) > 0 or self.lf_prior or self.lf_class_propensity:
+            raise NotImplementedError("skip_abstains not implemented for "
+                "dependencies, lf_prior, or lf_class_propensity factors.")
+
+    def _infer_cardinality(self, L, candidate_ranges=None):
+        """
+        Automatically infers the cardinality:
+            Binary: Values in {-1, 0, 1} [Default]
+            Categorical: Values in {0, 1, ..., K}
+        """
+        # If candidate_ranges is provided, use this to determine cardinality
+        if candidate_ranges is not None:
+            cardinality = max(map(max, candidate_ranges))
+        else:
+            # This is just an annoying hack for LIL sparse matrices...
+            try:
+                lmax = L.max()
+            except AttributeError:
+                lmax = L.tocoo().max()
+
+            if lmax > 2:
+                cardinality = lmax
+            elif lmax < 2:
+                cardinality = 2
+            else:
+                raise ValueError(
+                    "L.max() == %s, cannot infer cardinality." % lmax)
+        print("Inferred cardinality: %s" % cardinality)
+        return cardinality
+
+    def _compile_training_graph(self, L, init_deps, init_class_prior,
+        LF_acc_prior_weights, is_fixed, cardinalities, skip_abstains=False,
+        row_weights=None):
+        """
+        Compiles the factor graph to learn from L (see _compile and
+        _compile_sparse), optionally weighting the gradient of each factor by
+        the weight of the row of L it belongs to.
+
+        NB: numbskull only scales the gradient by the factor weights
+        (featureValue), while the regularization is applied once per update,
+        so for compressed rows these are the counts of the patterns relative
+        to the average count, rather than the counts themselves, which would
+        take steps as large as the counts from single samples.
+        """
+        m, n = L.shape
+        if skip_abstains:
+            weight, variable, factor, ftv, domain_mask, n_edges = \
+                self._compile_sparse(L, init_class_prior, LF_acc_prior_weights,
+                    is_fixed, cardinalities)
+        else:
+            weight, variable, factor, ftv, domain_mask, n_edges = self._compile(
+                L, init_deps, init_class_prior, LF_acc_prior_weights, is_fixed,
+                cardinalities)
+
+        if row_weights is not None:
+            if skip_abstains:
+                lf_var_rows = L.tocoo().row
+            else:
+                lf_var_rows = np.repeat(np.arange(m), n)
+            var_rows = np.concatenate([np.arange(m), lf_var_rows])
+            factor["featureValue"] = \
+                row_weights[var_rows[ftv["vid"][factor["ftv_offset"]]]]
+        return weight, variable, factor, ftv, domain_mask, n_edges
+
+    def _shard_rows(self, m, threads):
+        """
+        Splits the M (shuffled) rows to train on into one contiguous shard
+        per replica, or a single shard unless parallelism is 'replicas'
+        """
+        if self.parallelism != 'replicas' or threads <= 1 or m <= 1:
+            return [slice(0, m)]
+        bounds = np.linspace(0, m, min(threads, m) + 1).astype(np.int64)
+        return [slice(a, b) for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def _load_learners(self, graphs, threads, w=None, **kwargs):
+        """
+        Loads each compiled training graph (see _compile_training_graph) into
+        its own NumbSkull instance, optionally initialized with weights w. A
+        single graph is sampled with all threads (Hogwild), while each of
+        several graphs, i.e., replicas, is sampled by one thread.
+        """
+        learners = []
+        for weight, variable, factor, ftv, domain_mask, n_edges in graphs:
+            if w is not None:
+                weight["initialValue"] = w
+            fg = NumbSkull(n_inference_epoch=0, n_learning_epoch=1, decay=1.0,
+                learn_non_evidence=True,
+                nthreads=threads if len(graphs) == 1 else 1, **kwargs)
+            fg.loadFactorGraph(weight, variable, factor, ftv, domain_mask,
+                n_edges)
+            learners.append(fg)
+        return learners
+
+    def _learning_epoch(self, learners, step_size, burn_in):
+        """
+        Runs burn_in Gibbs sweeps and then one learning epoch of each learner
+        (see _load_learners), with the replicas running in parallel. Then the
+        weight updates of the replicas are summed, so that an epoch over the
+        shards takes a step of the same size as an epoch over all rows, and
+        synchronized across the replicas.
+
+        :return: (w, n_samples), the weights after the epoch and the number of
+            variables sampled per sweep
+        """
+        for fg in learners:
+            fg.stepsize = step_size
+            fg.burn_in = burn_in
+        if len(learners) == 1:
+            learners[0].learning(out=False)
+            w = np.copy(learners[0].getFactorGraph().getWeights())
+        else:
+            w = np.copy(learners[0].getFactorGraph().weight_value[0])
+            w_start = np.copy(w)
+            with ThreadPoolExecutor(len(learners)) as pool:
+                futures = [pool.submit(fg.learning, out=False)
+                    for fg in learners]
+                for future in futures:
+                    future.result()
+            for fg in learners:
+                w += fg.getFactorGraph().getWeights() - w_start
+            for fg in learners:
+                fg.getFactorGraph().weight_value[0] = w
+        n_samples = sum(fg.getFactorGraph().variable.shape[0]
+            for fg in learners)
+        return w, n_samples
+
+    def _start_trajectory(self):
+        self.epoch_throughput = []
+        self._trajectory = []
+
+    def _end_epoch(self, epoch, w_prev, w, n_samples, seconds, verbose,
+        tol=None, patience=1, log_likelihood=None):
+        """
+        Records the trajectory of training after an epoch, which took the
+        weights from w_prev to w, and checks for convergence.
+
+        :return: whether to stop training
+        """
+        self.epoch_throughput.append(n_samples / max(seconds, 1e-9))
+        change = np.nan
+        if w_prev is not None:
+            change = np.linalg.norm(w - w_prev) / \
+                max(np.linalg.norm(w_prev), 1e-9)
+        record = {"Epoch": epoch, "Weight change": change,
+            "Samples/sec": self.epoch_throughput[-1]}
+        if log_likelihood is not None:
+            record["Log-likelihood"] = log_likelihood
+        self._trajectory.append(record)
+        if verbose:
+            print("Epoch %s: %s" % (epoch, ", ".join("%s = %.4g" % (k,
+                record[k]) for k in sorted(record) if k != "Epoch")))
+
+        if tol is None:
+            return False
+        if log_likelihood is not None:
+            monitored = [r["Log-likelihood"] for r in self._trajectory]
+            changes = np.abs(np.diff(monitored))
+        else:
+            changes = [r["Weight change"] for r in self._trajectory]
+        return len(changes) >= patience and \
+            all(c < tol for c in changes[-patience:])
+
+    def _set_learned_weights(self, w, init_deps, init_class_prior,
+        LF_acc_prior_weights, is_fixed, threads=1):
+        """
+        Stores the learned weights w, and a single-candidate factor graph
+        using them, sampled with the given number of threads, in fg
+        """
+        n = len(is_fixed)
+        self._process_learned_weights(n, w, LF_acc_prior_weights, is_fixed)
+        self.learned_weights = w.reshape(1, len(w))
         weight, variable, factor, ftv, domain_mask, n_edges =\
-            self._compile(sparse.coo_matrix((1, n), L.dtype), init_deps,
+            self._compile(sparse.coo_matrix((1, n), np.int64), init_deps,
                 init_class_prior, LF_acc_prior_weights, is_fixed,
                 [self.cardinality_for_stats])
 
         variable["isEvidence"] = False
         weight["isFixed"] = True
-        weight["initialValue"] = fg.factorGraphs[0].weight_value
+        weight["initialValue"] = w
 
-        fg.factorGraphs = []
+        fg = NumbSkull(n_inference_epoch=0, n_learning_epoch=0, quiet=True,
+            nthreads=threads)
         fg.loadFactorGraph(weight, variable, factor, ftv, domain_mask, n_edges)
 
         self.fg = fg
         self.nlf = n
-        self.cardinality = cardinality
+        self._stats_graph_args = (init_deps, init_class_prior,
+            LF_acc_prior_weights, is_fixed)
+
+    def _closed_form_weights(self, L, LF_acc_prior_weights, counts=None):
+        """
+        Estimates the total accuracy weight (and, if lf_propensity, the
+        propensity weight) of each LF of a binary, conditionally independent
+        model by matching its moments to the LF agreement statistics of L.
+
+        With lf_propensity, the accuracy weights are arctanh(a), where a is
+        the agreement rate with the true class of each LF when it labels (see
+        _fit_moments), and the propensity weights match the LF coverages.
+        Otherwise, the accuracy weights are set so that E[lambda * y] under
+        the model matches that of L. LFs which never overlap with other LFs
+        are left at their prior weights.
+
+        :param counts: Optionally, the number of candidates represented by
+            each row of L, see compress_label_matrix
+        """
+        agreement, coverage = _fit_moments(L, counts)
+        has_overlaps = ~np.isnan(agreement)
+        agreement = np.clip(np.nan_to_num(agreement), -0.99, 0.99)
+        if self.lf_propensity:
+            lf_accuracy = np.arctanh(agreement)
+        else:
+            a = np.clip(coverage * agreement, -0.99, 0.99)
+            lf_accuracy = np.log((a + np.sqrt(4 - 3 * a ** 2)) / (2 * (1 - a)))
+        lf_accuracy = np.where(has_overlaps, lf_accuracy, LF_acc_prior_weights)
+
+        lf_propensity = None
+        if self.lf_propensity:
+            lf_propensity = _propensity_weights(coverage, lf_accuracy,
+                self.cardinalities, counts)
+        return lf_accuracy, lf_propensity
+
+    def _init_lf_weights(self, weight, LF_acc_prior_weights, is_fixed,
+        lf_accuracy, lf_propensity=None, lf_prior=None,
+        lf_class_propensity=None):
+        """
+        Sets the initial values of the learnable LF accuracy weights of a
+        compiled weight array so that, with their priors, they sum to
+        lf_accuracy, and of the LF propensity weights (if included) to
+        lf_propensity, and likewise for the other optional LF weights.
+
+        :return: the offset of the first dependency weight
+        """
+        optional_weights = {
+            'lf_prior': lf_prior,
+            'lf_propensity': lf_propensity,
+            'lf_class_propensity': lf_class_propensity
+        }
+        n = len(is_fixed)
+        w_off = 1 if self.class_prior else 0
+        for i in range(n):
+            if self.hasPrior[i]:
+                w_off += 1
+            if (not is_fixed[i]):
+                weight[w_off]['initialValue'] = \
+                    lf_accuracy[i] - LF_acc_prior_weights[i]
+                w_off += 1
+        for optional_name in GenerativeModel.optional_names:
+            if getattr(self, optional_name):
+                if optional_weights[optional_name] is not None:
+                    weight[w_off:w_off + n]['initialValue'] = \
+                        optional_weights[optional_name]
+                w_off += n
+        return w_off
+
+    def _lf_names(self, L, lf_names=None):
+        """
+        Returns the names of the LFs labeling the columns of L, either as
+        given or read from an annotation matrix indexing its keys by name,
+        or else None
+        """
+        if lf_names is not None:
+            if len(lf_names) != L.shape[1]:
+                raise ValueError("Got %s LF names for %s LFs." %
+                    (len(lf_names), L.shape[1]))
+            return list(lf_names)
+        col_index = getattr(L, 'col_index', None)
+        if col_index is not None and len(col_index) == L.shape[1] and \
+            all(isinstance(col_index[j], string_types)
+                for j in range(L.shape[1])):
+            return [col_index[j] for j in range(L.shape[1])]
+        return None
+
+    def _match_lfs(self, init_weights, lf_names, n):
+        """
+        Matches the N LFs to the LFs of init_weights, by name if both are
+        named, or else by position.
+
+        :return: an array with the index in init_weights of each LF, or -1 if
+            it is not matched
+        """
+        init_names = getattr(init_weights, 'lf_names', None)
+        if lf_names is not None and init_names is not None:
+            init_index = dict((name, i) for i, name in enumerate(init_names)
+                if name is not None)
+            return np.array([init_index.get(name, -1) if name is not None
+                else -1 for name in lf_names], dtype=np.int64)
+        if init_weights.n != n:
+            raise ValueError("Cannot match %s LFs to the %s LFs of "
+                "init_weights without LF names." % (n, init_weights.n))
+        return np.arange(n, dtype=np.int64)
+
+    def _matched_deps(self, lf_index):
+        """
+        Returns the dependencies of the learned weights as (lf_1, lf_2, type)
+        triples over the LFs matched to them by lf_index (see _match_lfs),
+        dropping those involving unmatched LFs.
+        """
+        new_index = dict((int(i), j) for j, i in enumerate(lf_index) if i >= 0)
+        deps = []
+        for dep_type, dep_name in enumerate(GenerativeModel.dep_names):
+            mat = sparse.coo_matrix(getattr(self.weights, dep_name))
+            for j, k in zip(mat.row, mat.col):
+                if j in new_index and k in new_index:
+                    deps.append((new_index[j], new_index[k], dep_type))
+        return deps
+
+    def _warm_start_weights(self, weight, init_weights, lf_index,
+        LF_acc_prior_weights, is_fixed, skip_abstains=False):
+        """
+        Sets the initial values of a compiled weight array to the weights in
+        init_weights, with lf_index mapping each LF to its index there (see
+        _match_lfs). The weights of unmatched LFs, and of dependencies
+        involving them, are left at their defaults.
+        """
+        matched = lf_index >= 0
+        index = np.where(matched, lf_index, 0)
+
+        def init(x):
+            return np.where(matched, np.asarray(x, dtype=np.float64)[index],
+                0.0)
+
+        if self.class_prior:
+            weight[0]['initialValue'] = init_weights.class_prior
+        lf_accuracy = np.where(matched, init(init_weights.lf_accuracy),
+            LF_acc_prior_weights)
+        # With skip_abstains, the propensity weights are fixed and set after
+        # training, see _expand_sparse_weights
+        w_off = self._init_lf_weights(weight, LF_acc_prior_weights, is_fixed,
+            lf_accuracy,
+            None if skip_abstains else init(init_weights.lf_propensity),
+            init(init_weights.lf_prior),
+            init(init_weights.lf_class_propensity))
+
+        for dep_name in GenerativeModel.dep_names:
+            mat = getattr(self, dep_name)
+            init_mat = sparse.csr_matrix(getattr(init_weights, dep_name))
+            for i in range(len(mat.data)):
+                j, k = mat.row[i], mat.col[i]
+                if matched[j] and matched[k]:
+                    weight[w_off]['initialValue'] = \
+                        init_mat[lf_index[j], lf_index[k]]
+                w_off += 1
 
     def _remap_scoped_categoricals(self, L_in, candidate_ranges):
         """
         Remap the values of each individual candidate so that they have dense
         support, returning the remapped label matrix, cardinalities, and
         inverse mapping.
+
+        The inverse mapping is a pair of arrays (range_ptr, range_values), a
+        flattened table of the candidate ranges: the value with (1-indexed)
+        remapped value k for candidate i is range_values[range_ptr[i] + k - 1].
         """
-        L = L_in.copy()
+        L = sparse.csr_matrix(L_in, copy=True)
+        L.eliminate_zeros()
         m, n = L.shape
-        cardinalities = np.ones(m)
-        mappings = []
-        for i in range(m):
-            c_range = candidate_ranges[i]
-
-            # Confirm that the candidate range has only unique values
-            assert len(c_range) == len(set(c_range))
-            cardinalities[i] = len(c_range)
-
-            # Create the inverse mapping
-            mappings.append(dict([(a + 1, b) for a, b in enumerate(c_range)]))
-
-            # Re-map the values of L[i, :]
-            # Assumes L is csr_sparse format at this point
-            for j in range(L[i].data.shape[0]):
-                val = L[i].data[j]
-                if val not in c_range:
-                    raise ValueError("""Value {0} is not in supplied range 
-                        for candidate at index {1}""".format(val, i))
-                L[i, L[i].indices[j]] = c_range.index(val) + 1
-        return L, cardinalities, mappings
-
-    def learned_lf_stats(self):
+        range_ptr, range_values = _flatten_ranges(candidate_ranges)
+        cardinalities = np.diff(range_ptr)
+
+        # Look up each (candidate, value) pair of L in the range table, sorted
+        # by candidate and then value rank. Values are ranked by their offset
+        # from the smallest value, unless the keys would overflow
+        if len(range_values) > 0:
+            v_min, v_max = range_values.min(), range_values.max()
+        else:
+            v_min, v_max = 0, 0
+        n_ranked = int(v_max - v_min + 1)
+        if m * float(n_ranked) < 2 ** 62:
+            ranks = range_values - v_min
+            r = L.data - v_min
+            in_values = (r >= 0) & (r < n_ranked)
+        else:
+            ranked_values, ranks = np.unique(range_values, return_inverse=True)
+            n_ranked = len(ranked_values)
+            ranks = ranks.ravel()
+            r = np.searchsorted(ranked_values, L.data)
+            in_values = ranked_values[np.minimum(r, n_ranked - 1)] == L.data
+        range_rows = np.repeat(np.arange(m, dtype=np.int64), cardinalities)
+        keys = range_rows * n_ranked + ranks
+        order = np.argsort(keys, kind='mergesort')
+        sorted_keys = keys[order]
+
+        # Confirm that the candidate ranges have only unique values
+        if np.any(np.diff(sorted_keys) == 0):
+            i = range_rows[order[np.flatnonzero(np.diff(sorted_keys) == 0)[0]]]
+            raise ValueError("Range for candidate at index %d has duplicate "
+                "values" % i)
+
+        rows = np.repeat(np.arange(m, dtype=np.int64), np.diff(L.indptr))
+        pos = np.searchsorted(sorted_keys, rows * n_ranked + r)
+        found = in_values & (pos < len(sorted_keys))
+        found[found] = sorted_keys[pos[found]] == rows[found] * n_ranked + \
+            r[found]
+        if not np.all(found):
+            e = np.flatnonzero(~found)[0]
+            raise ValueError("""Value {0} is not in supplied range 
+                for candidate at index {1}""".format(L.data[e], rows[e]))
+        L.data = order[pos] - range_ptr[rows] + 1
+        return L, cardinalities, (range_ptr, range_values)
+
+    def learned_lf_stats(self, n_samples=5000, burn_in=500, threads=None):
         """
         Provides a summary of what the model has learned about the labeling
         functions. For each labeling function, estimates of the following
@@ -300,36 +950,36 @@ class GenerativeModel(Classifier):
         For scoped categoricals, the information provided is for the maximum
         observed cardinality of any single data point.
 
-        WARNING: This uses Gibbs sampling to estimate these values. This will
-                 tend to mix poorly when there are many very accurate labeling
-                 functions. In this case, this function will assume that the
-                 classes are approximately balanced.
+        If the model has no dependencies between LFs, these are computed
+        exactly from the learned weights. Otherwise, they are estimated with
+        Gibbs sampling.
+
+        WARNING: Gibbs sampling will tend to mix poorly when there are many
+                 very accurate labeling functions. In this case, this function
+                 will assume that the classes are approximately balanced.
+
+        :param n_samples: number of Gibbs samples to take starting from each
+            class, if sampling
+        :param burn_in: number of burn-in sweeps before sampling
+        :param threads: number of threads to sample with, by default the
+            threads the model was constructed with; each thread samples an
+            independent chain, taking n_samples / threads samples
         """
-        if self.fg is None:
+        if self.weights is None:
             raise ValueError(
                 "Must fit model with train() before computing diagnostics.")
 
-        burnin = 500
-        trials = 5000
         cardinality = self.cardinality_for_stats
-        count = np.zeros((self.nlf, cardinality, cardinality + 1))
-
-        for true_label in range(cardinality):
-            for i in range(self.nlf + 1):
-                self.fg.factorGraphs[0].var_value[0, i] = true_label
-            self.fg.factorGraphs[0].inference(burnin, 0, True)
-            for i in range(trials):
-                self.fg.factorGraphs[0].inference(0, 1, True)
-                y = self.fg.factorGraphs[0].var_value[0, 0]
-                for j in range(self.nlf):
-                    lf = self.fg.factorGraphs[0].var_value[0, j + 1]
-                    count[j, y, lf] += 1
-
-        count /= cardinality * trials
+        if any(getattr(self.weights, dep_name).nnz > 0
+            for dep_name in GenerativeModel.dep_names):
+            count = self._sample_lf_stats_counts(n_samples, burn_in,
+                threads or self.threads)
+        else:
+            count = self._lf_stats_counts()
 
         # Compute summary stats to return to user
         stats = []
-        for i in range(self.nlf):
+        for i in range(count.shape[0]):
             if cardinality == 2:
                 tp = count[i, 1, 1]
                 fp = count[i, 0, 1]
@@ -353,7 +1003,120 @@ class GenerativeModel(Classifier):
 
         return DataFrame(stats)
 
-    def marginals(self, L, candidate_ranges=None, batch_size=None):
+    def _lf_stats_counts(self):
+        """
+        Computes the joint distribution P(y, lambda_j) of the true class and
+        the (internal) value of each LF for a model without dependencies.
+        Then each LF is independent given y, with
+
+            P(lambda_j | y) = exp(phi_j(y, lambda_j)) / Z_j(y),
+            P(y) \propto exp(phi_0(y)) * prod_j Z_j(y),
+
+        where phi_j are the summed weighted factors of LF j (see the factor
+        functions in numbskull.inference) and phi_0 the class prior.
+
+        :return: count, an N x K x (K + 1) array with P(y, lambda_j) in
+            count[j, y, lambda_j]
+        """
+        phi, log_z, log_p_y = self._lf_log_potentials(self.weights,
+            self.cardinality_for_stats)
+        return np.exp(log_p_y + phi - log_z)
+
+    def _lf_log_potentials(self, w, K):
+        """
+        Computes the terms of the distribution of a model without
+        dependencies with weights w (see _lf_stats_counts).
+
+        :return: (phi, log_z, log_p_y), an N x K x (K + 1) array with
+            phi_j(y, lambda_j) in phi[j, y, lambda_j], an N x K x 1 array with
+            log Z_j(y), and a 1 x K x 1 array with log P(y)
+        """
+        n = w.n
+        y = np.arange(K).reshape(1, K, 1)
+        lf = np.arange(K + 1).reshape(1, 1, K + 1)
+        labeled = (lf != K).astype(np.float64)
+        y_sign = np.where(y == 1, 1.0, -1.0)
+
+        def lf_weights(x):
+            return np.asarray(x, dtype=np.float64).reshape(n, 1, 1)
+
+        phi = lf_weights(w.lf_accuracy) * labeled * np.where(lf == y, 1.0, -1.0)
+        phi = phi + lf_weights(w.lf_prior) * np.where(lf == 2, -1.0,
+            np.where(lf == 0, 0.0, 1.0))
+        phi = phi + lf_weights(w.lf_propensity) * labeled
+        phi = phi + lf_weights(w.lf_class_propensity) * labeled * y_sign
+
+        phi_max = phi.max(axis=2, keepdims=True)
+        log_z = np.log(np.exp(phi - phi_max).sum(axis=2, keepdims=True)) + \
+            phi_max
+        log_p_y = w.class_prior * y_sign + log_z.sum(axis=0, keepdims=True)
+        log_p_y -= log_p_y.max()
+        log_p_y -= np.log(np.exp(log_p_y).sum())
+        return phi, log_z, log_p_y
+
+    def _log_likelihood(self, L):
+        """
+        Computes the mean log-likelihood log P(lambda_i) of the rows of the
+        label matrix L under the current weights, for a model without
+        dependencies (see _lf_stats_counts). Any LFs of the model after the
+        columns of L, i.e., supervised labels, are marginalized out.
+        """
+        K = self.cardinality
+        phi, log_z, log_p_y = self._lf_log_potentials(self.weights, K)
+        L = sparse.csr_matrix(L)
+        phi, log_z = phi[:L.shape[1]], log_z[:L.shape[1]]
+        rows = np.repeat(np.arange(L.shape[0]), np.diff(L.indptr))
+        values = (L.data + 1) // 2 if K == 2 else L.data - 1
+
+        # The log-likelihood of each row if all LFs abstain, plus the change
+        # from each LF label
+        log_p = np.tile(log_p_y[0, :, 0] + (phi[:, :, K] - log_z[:, :, 0]).sum(
+            axis=0), (L.shape[0], 1))
+        delta = phi[L.indices, :, values] - phi[L.indices, :, K]
+        for y in range(K):
+            log_p[:, y] += np.bincount(rows, weights=delta[:, y],
+                minlength=L.shape[0])
+        log_p_max = log_p.max(axis=1, keepdims=True)
+        return np.mean(np.log(np.exp(log_p - log_p_max).sum(axis=1)) +
+            log_p_max[:, 0])
+
+    def _sample_lf_stats_counts(self, n_samples, burn_in, threads):
+        """
+        Estimates the joint distribution P(y, lambda_j) (see _lf_stats_counts)
+        by Gibbs sampling, with one independent single-candidate chain per
+        thread. Half of the chains start from each class.
+        """
+        if getattr(self, '_stats_graph_args', None) is None:
+            raise ValueError("Sampling LF stats requires a model trained "
+                "with train().")
+        n, K = self.nlf, self.cardinality_for_stats
+        weight, variable, factor, ftv, domain_mask, n_edges =\
+            self._compile(sparse.coo_matrix((threads, n), np.int64),
+                *(self._stats_graph_args + ([K] * threads,)))
+        variable["isEvidence"] = False
+        weight["isFixed"] = True
+        weight["initialValue"] = self.learned_weights[0]
+        fg = NumbSkull(n_inference_epoch=0, n_learning_epoch=0, quiet=True,
+            nthreads=threads)
+        fg.loadFactorGraph(weight, variable, factor, ftv, domain_mask, n_edges)
+        fg = fg.factorGraphs[0]
+
+        trials = int(np.ceil(n_samples / float(threads)))
+        count = np.zeros((n, K, K + 1))
+        lfs = np.tile(np.arange(n), threads)
+        for true_label in range(K):
+            fg.var_value[0, :] = true_label
+            fg.inference(burn_in, 0, True)
+            for _ in range(trials):
+                fg.inference(0, 1, True)
+                y = fg.var_value[0, :threads]
+                lf = fg.var_value[0, threads:threads * (n + 1)]
+                np.add.at(count, (lfs, np.repeat(y, n), lf), 1)
+        count /= K * trials * threads
+        return count
+
+    def marginals(self, L, candidate_ranges=None, batch_size=None,
+        compress=False):
         """
         Given an M x N label matrix, returns marginal probabilities for each
         candidate, depending on classification setting:
@@ -370,100 +1133,90 @@ class GenerativeModel(Classifier):
 
         In the categorical setting, the K values (columns in the marginals
         matrix) correspond to indices of the Candidate values defined.
+
+        :param batch_size: Optionally, the number of rows of L to evaluate at
+            a time, to bound memory usage on very large label matrices
+        :param compress: If True, computes the marginals once per unique label
+            pattern in L and broadcasts them back to all candidates. Not
+            implemented for scoped categoricals.
         """
         m, n = L.shape
         if self.weights is None:
             raise ValueError("""Must fit model with train() before computing 
                 marginal probabilities.""")
 
+        if compress:
+            if candidate_ranges is not None:
+                raise NotImplementedError("compress not implemented for "
+                    "scoped categoricals.")
+            L_unique, _, _, inverse = compress_label_matrix(L)
+            return self.marginals(L_unique, batch_size=batch_size)[inverse]
+
+        # Optionally evaluate in row batches, bounding the memory used for
+        # intermediate products to O(batch_size) rows
+        if batch_size is not None and batch_size < m:
+            L = sparse.csr_matrix(L)
+            batches = []
+            for b in range(0, m, batch_size):
+                batches.append(self.marginals(L[b:b + batch_size],
+                    candidate_ranges=candidate_ranges[b:b + batch_size]
+                        if candidate_ranges is not None else None))
+            if self.cardinality == 2:
+                return np.concatenate(batches)
+            elif candidate_ranges is not None:
+                return sparse.vstack(batches)
+            else:
+                return np.vstack(batches)
+
         # Binary classification setting
         if self.cardinality == 2:
-            marginals = np.ndarray(L.shape[0], dtype=np.float64)
-
-            for i in range(L.shape[0]):
-                logp_true = self.weights.class_prior
-                logp_false = -1 * self.weights.class_prior
-
-                l_i = L[i].tocoo()
-
-                for l_index1 in range(l_i.nnz):
-                    data_j, j = l_i.data[l_index1], l_i.col[l_index1]
-                    if data_j == 1:
-                        logp_true  += self.weights.lf_accuracy[j]
-                        logp_false -= self.weights.lf_accuracy[j]
-                        logp_true  += self.weights.lf_class_propensity[j]
-                        logp_false -= self.weights.lf_class_propensity[j]
-                    elif data_j == -1:
-                        logp_true  -= self.weights.lf_accuracy[j]
-                        logp_false += self.weights.lf_accuracy[j]
-                        logp_true  += self.weights.lf_class_propensity[j]
-                        logp_false -= self.weights.lf_class_propensity[j]
-                    else:
-                        ValueError("""Illegal value at %d, %d: %d.
-                            Must be in {-1, 0, 1}.""" % (i, j, data_j))
-
-                    for l_index2 in range(l_i.nnz):
-                        data_k, k = l_i.data[l_index2], l_i.col[l_index2]
-                        if j != k:
-                            if data_j == -1 and data_k == 1:
-                                logp_true += self.weights.dep_fixing[j, k]
-                            elif data_j == 1 and data_k == -1:
-                                logp_false += self.weights.dep_fixing[j, k]
-
-                            if data_j == 1 and data_k == 1:
-                                logp_true += self.weights.dep_reinforcing[j, k]
-                            elif data_j == -1 and data_k == -1:
-                                logp_false += self.weights.dep_reinforcing[j, k]
-
-                marginals[i] = 1 / (1 + np.exp(logp_false - logp_true))
-            return marginals
+            return marginals_binary(self.weights, L)
 
         # Categorical setting
+        # Handle the scoped categorical case, otherwise get cardinalities
+        # from self.cardinality
+        elif candidate_ranges is not None:
+            return self._marginals_scoped_categorical(L, candidate_ranges)
         else:
-            all_marginals = []
+            return marginals_categorical(self.weights, L, self.cardinality)
 
-            # Handle the scoped categorical case, otherwise get cardinalities
-            # from self.cardinality
-            if candidate_ranges is not None:
-                L, cardinalities, mappings = self._remap_scoped_categoricals(L, 
-                    candidate_ranges)
-            else:
-                cardinalities = self.cardinality * np.ones(m)
-
-            # Get the marginal (posterior) probability for each candidate
-            for i in range(m):
-                cardinality = int(cardinalities[i])
-                marginals = np.zeros(cardinality, dtype=np.float64)
-                # NB: class priors not currently available for categoricals
-                l_i = L[i].tocoo()
-                for l_index1 in range(l_i.nnz):
-                    data_j, j = l_i.data[l_index1], l_i.col[l_index1]
-                    if (data_j != 0):
-                        if not 1 <= data_j <= cardinality:
-                            raise ValueError(
-                                """Illegal value at %d, %d: %d. Must be in 0 to 
-                                %d.""" % (i, j, data_j, cardinality))
-                        # NB: LF class propensity not currently available
-                        # for categoricals
-                        marginals[int(data_j - 1)] += \
-                            2 * self.weights.lf_accuracy[j]
-                            
-                # NB: fixing and reinforcing not available for categoricals
-                # Get softmax
-                exps = np.exp(marginals)
-                marginals = exps / exps.sum()
-                all_marginals.append(marginals)
-
-            # If candidate_ranges not None, remap back to original values and
-            # return as sparse matrix
-            if candidate_ranges is not None:
-                M = sparse.coo_matrix((m, self.cardinality), dtype=np.float64)
-                for i, marginals in enumerate(all_marginals):
-                    for j, p in enumerate(marginals):
-                        M[i, mappings[i][j]] = p
-            else:
-                M = np.vstack(all_marginals)
-            return M
+    def _marginals_scoped_categorical(self, L, candidate_ranges):
+        """
+        Computes scoped categorical marginals as a softmax over the summed
+        accuracy weights of the LFs voting for each value in the range of
+        each candidate. Scores and probabilities are kept in one flat array
+        over the concatenated candidate ranges (see _flatten_ranges), which
+        becomes the data of the returned M x K CSR matrix.
+        """
+        L, _, (range_ptr, range_values) = \
+            self._remap_scoped_categoricals(L, candidate_ranges)
+        m, n = L.shape
+        if len(range_values) > 0 and (range_values.min() < 1 or
+            range_values.max() > self.cardinality):
+            raise ValueError("Candidate range values must be in 1 to %d." %
+                self.cardinality)
+
+        # NB: class priors, LF class propensity, and fixing and reinforcing
+        # dependencies not currently available for categoricals
+        rows = np.repeat(np.arange(m), np.diff(L.indptr))
+        scores = np.bincount(range_ptr[rows] + L.data - 1,
+            weights=2 * self.weights.lf_accuracy[L.indices],
+            minlength=range_ptr[-1]).astype(np.float64)
+
+        # Get softmax over each (nonempty) candidate range
+        range_rows = np.repeat(np.arange(m), np.diff(range_ptr))
+        nonempty = np.flatnonzero(np.diff(range_ptr) > 0)
+        row_max = np.zeros(m)
+        if len(nonempty) > 0:
+            row_max[nonempty] = np.maximum.reduceat(scores,
+                range_ptr[nonempty])
+        exps = np.exp(scores - row_max[range_rows])
+        exps /= np.bincount(range_rows, weights=exps, minlength=m)[range_rows]
+
+        M = sparse.csr_matrix((exps, range_values - 1, range_ptr),
+            shape=(m, self.cardinality))
+        M.sort_indices()
+        return M
 
     def _process_dependency_graph(self, L, deps):
         """
@@ -582,50 +1335,47 @@ class GenerativeModel(Classifier):
         #   Labeling functions: 0 to (cardinality - 1) are the classes
         #                       cardinality is abstain
         # Candidates (variables)
-        for i in range(m):
-            variable[i]['isEvidence'] = False
-            variable[i]['initialValue'] = self.rng.randint(cardinalities[i])
-            variable[i]["dataType"] = 0
-            variable[i]["cardinality"] = cardinalities[i]
-
-        # LF label variables -- initial loop to set all variables
-        for i in range(m):
-            for j in range(n):
-                index = m + n * i + j
-                variable[index]["isEvidence"] = 1
-                variable[index]["dataType"] = 0
-                variable[index]["cardinality"] = cardinalities[i] + 1
-                
-                # Default to abstain
-                variable[index]["initialValue"] = cardinalities[i]
+        cardinalities = np.asarray(cardinalities, dtype=np.int64)
+        variable[:m]['isEvidence'] = False
+        variable[:m]['initialValue'] = self.rng.randint(cardinalities)
+        variable[:m]["dataType"] = 0
+        variable[:m]["cardinality"] = cardinalities
+
+        # LF label variables -- initial pass to set all variables, which are
+        # laid out row-major, i.e., the LF j label of candidate i is at index
+        # m + n * i + j
+        lf_variable = variable[m:]
+        lf_variable["isEvidence"] = 1
+        lf_variable["dataType"] = 0
+        lf_variable["cardinality"] = np.repeat(cardinalities + 1, n)
+
+        # Default to abstain
+        lf_variable["initialValue"] = np.repeat(cardinalities, n)
 
         # LF labels -- now set the non-zero labels
         L_coo = L.tocoo()
-        for L_index in range(L_coo.nnz):
-            data, i, j = L_coo.data[L_index], L_coo.row[L_index], L_coo.col[L_index]
-            index = m + n * i + j
-
-            # Note: Here we need to use the overall cardinality to handle, since
-            # with candidate_ranges not None and self.cardinality > 2, some
-            # candidates could have cardinality == 2...
-            if (self.cardinality == 2):
-                if data == 1:
-                    variable[index]["initialValue"] = 1
-                elif data == 0:
-                    variable[index]["initialValue"] = 2
-                elif data == -1:
-                    variable[index]["initialValue"] = 0
-                else:
-                    raise ValueError("Invalid labeling function output in cell (%d, %d): %d. "
-                                     "Valid values are 1, 0, and -1. " % (i, j, data))
-            else:
-                if data == 0:
-                    variable[index]["initialValue"] = cardinalities[i]
-                elif 1 <= data <= cardinalities[i]:
-                    variable[index]["initialValue"] = data - 1
-                else:
-                    raise ValueError("Invalid labeling function output in cell (%d, %d): %d. "
-                                     "Valid values are 0 to %d. " % (i, j, data, self.cardinalities[i]))
+        data, rows, cols = L_coo.data, L_coo.row, L_coo.col
+
+        # Note: Here we need to use the overall cardinality to handle, since
+        # with candidate_ranges not None and self.cardinality > 2, some
+        # candidates could have cardinality == 2...
+        if (self.cardinality == 2):
+            invalid = np.flatnonzero((data != 1) & (data != 0) & (data != -1))
+            if len(invalid) > 0:
+                i = invalid[0]
+                raise ValueError("Invalid labeling function output in cell (%d, %d): %d. "
+                                 "Valid values are 1, 0, and -1. " % (rows[i], cols[i], data[i]))
+            values = np.where(data == 1, 1, np.where(data == 0, 2, 0))
+        else:
+            row_cardinalities = cardinalities[rows]
+            invalid = np.flatnonzero((data != 0) &
+                ((data < 1) | (data > row_cardinalities)))
+            if len(invalid) > 0:
+                i = invalid[0]
+                raise ValueError("Invalid labeling function output in cell (%d, %d): %d. "
+                                 "Valid values are 0 to %d. " % (rows[i], cols[i], data[i], row_cardinalities[i]))
+            values = np.where(data == 0, row_cardinalities, data - 1)
+        lf_variable["initialValue"][n * rows + cols] = values
 
         #
         # Compiles factor and ftv matrices
@@ -634,14 +1384,13 @@ class GenerativeModel(Classifier):
         if self.class_prior:
             if self.cardinality != 2:
                 raise NotImplementedError("Class Prior not implemented for categorical classes.")
-            for i in range(m):
-                factor[i]["factorFunction"] = FACTORS["DP_GEN_CLASS_PRIOR"]
-                factor[i]["weightId"] = 0
-                factor[i]["featureValue"] = 1
-                factor[i]["arity"] = 1
-                factor[i]["ftv_offset"] = i
+            factor[:m]["factorFunction"] = FACTORS["DP_GEN_CLASS_PRIOR"]
+            factor[:m]["weightId"] = 0
+            factor[:m]["featureValue"] = 1
+            factor[:m]["arity"] = 1
+            factor[:m]["ftv_offset"] = np.arange(m)
 
-                ftv[i]["vid"] = i
+            ftv[:m]["vid"] = np.arange(m)
 
             f_off = m
             ftv_off = m
@@ -713,6 +1462,156 @@ class GenerativeModel(Classifier):
 
         return weight, variable, factor, ftv, domain_mask, n_edges
 
+    def _compile_sparse(self, L, init_class_prior, LF_acc_prior_weights,
+        is_fixed, cardinalities):
+        """
+        Compiles a conditionally independent generative model with LF label
+        variables and accuracy factors only for the non-abstain entries of L.
+
+        Each LF label variable also gets a factor with a large, fixed
+        propensity weight (LABELED_WEIGHT), so that when sampled it
+        (effectively) never abstains, i.e., the accuracy weights are learned
+        conditioned on the LFs having labeled. See _expand_sparse_weights.
+        """
+        L = sparse.csr_matrix(L, copy=True)
+        L.eliminate_zeros()
+        m, n = L.shape
+        L_coo = L.tocoo()
+        data, rows, cols = L_coo.data, L_coo.row, L_coo.col
+        nnz = len(data)
+
+        self.hasPrior = [i != 0 for i in LF_acc_prior_weights]
+        nfactors_for_lf = np.array([(int(self.hasPrior[i]) + int(not is_fixed[i]))
+            for i in range(n)], dtype=np.int64)
+
+        # One factor per accuracy weight for each label, plus the class prior
+        # and the fixed propensity factors
+        nfactors_for_label = nfactors_for_lf[cols]
+        n_acc_factors = int(nfactors_for_label.sum())
+        w_off = 1 if self.class_prior else 0
+        n_weights = w_off + int(nfactors_for_lf.sum()) + 1
+        n_vars = m + nnz
+        n_factors = w_off * m + n_acc_factors + nnz
+        n_edges = w_off * m + 2 * n_acc_factors + nnz
+
+        weight = np.zeros(n_weights, Weight)
+        variable = np.zeros(n_vars, Variable)
+        factor = np.zeros(n_factors, Factor)
+        ftv = np.zeros(n_edges, FactorToVar)
+        domain_mask = np.zeros(n_vars, np.bool)
+
+        #
+        # Compiles weight matrix
+        #
+        if self.class_prior:
+            weight[0]['isFixed'] = False
+            weight[0]['initialValue'] = np.float64(init_class_prior)
+        for i in range(n):
+            if self.hasPrior[i]:
+                weight[w_off]['isFixed'] = True
+                weight[w_off]['initialValue'] = LF_acc_prior_weights[i]
+                w_off += 1
+            if (not is_fixed[i]):
+                weight[w_off]['isFixed'] = False
+                weight[w_off]['initialValue'] = np.float64(0)
+                w_off += 1
+        weight[w_off]['isFixed'] = True
+        weight[w_off]['initialValue'] = LABELED_WEIGHT
+
+        #
+        # Compiles variable matrix
+        #
+        # Candidates (variables), then one LF label variable per label, in
+        # row-major order
+        cardinalities = np.asarray(cardinalities, dtype=np.int64)
+        variable[:m]['isEvidence'] = False
+        variable[:m]['initialValue'] = self.rng.randint(cardinalities)
+        variable[:m]["dataType"] = 0
+        variable[:m]["cardinality"] = cardinalities
+
+        row_cardinalities = cardinalities[rows]
+        if (self.cardinality == 2):
+            invalid = np.flatnonzero((data != 1) & (data != -1))
+            values = np.where(data == 1, 1, 0)
+        else:
+            invalid = np.flatnonzero((data < 1) | (data > row_cardinalities))
+            values = data - 1
+        if len(invalid) > 0:
+            i = invalid[0]
+            raise ValueError("Invalid labeling function output in cell "
+                "(%d, %d): %d." % (rows[i], cols[i], data[i]))
+        variable[m:]["isEvidence"] = 1
+        variable[m:]["dataType"] = 0
+        variable[m:]["cardinality"] = row_cardinalities + 1
+        variable[m:]["initialValue"] = values
+
+        #
+        # Compiles factor and ftv matrices
+        #
+        if self.class_prior:
+            if self.cardinality != 2:
+                raise NotImplementedError("Class Prior not implemented for categorical classes.")
+            factor[:m]["factorFunction"] = FACTORS["DP_GEN_CLASS_PRIOR"]
+            factor[:m]["weightId"] = 0
+            factor[:m]["featureValue"] = 1
+            factor[:m]["arity"] = 1
+            factor[:m]["ftv_offset"] = np.arange(m)
+            ftv[:m]["vid"] = np.arange(m)
+            f_off = ftv_off = m
+        else:
+            f_off = ftv_off = 0
+
+        # Accuracy factors, nfactors_for_lf[j] for each label of LF j
+        labels = np.repeat(np.arange(nnz), nfactors_for_label)
+        first_factor = np.cumsum(nfactors_for_label) - nfactors_for_label
+        first_weight = (1 if self.class_prior else 0) + \
+            np.cumsum(nfactors_for_lf) - nfactors_for_lf
+        k = np.arange(n_acc_factors) - np.repeat(first_factor, nfactors_for_label)
+
+        f = factor[f_off:f_off + n_acc_factors]
+        f["factorFunction"] = FACTORS["DP_GEN_LF_ACCURACY"]
+        f["weightId"] = first_weight[cols[labels]] + k
+        f["featureValue"] = 1
+        f["arity"] = 2
+        f["ftv_offset"] = ftv_off + 2 * np.arange(n_acc_factors)
+        ftv[ftv_off:ftv_off + 2 * n_acc_factors]["vid"] = np.column_stack(
+            [rows[labels], m + labels]).ravel()
+        f_off += n_acc_factors
+        ftv_off += 2 * n_acc_factors
+
+        # Fixed propensity factors
+        f = factor[f_off:f_off + nnz]
+        f["factorFunction"] = FACTORS["DP_GEN_LF_PROPENSITY"]
+        f["weightId"] = n_weights - 1
+        f["featureValue"] = 1
+        f["arity"] = 1
+        f["ftv_offset"] = ftv_off + np.arange(nnz)
+        ftv[ftv_off:ftv_off + nnz]["vid"] = m + np.arange(nnz)
+
+        return weight, variable, factor, ftv, domain_mask, n_edges
+
+    def _expand_sparse_weights(self, w, is_fixed, coverage, cardinalities,
+        counts=None):
+        """
+        Maps weights learned with _compile_sparse to the layout of _compile,
+        replacing the fixed LABELED_WEIGHT with LF propensity weights set so
+        that the expected coverage of each LF matches its empirical coverage.
+
+        :param coverage: the fraction of candidates labeled by each LF
+        :param cardinalities: the cardinalities of the candidates, optionally
+            with counts giving the number of candidates each represents
+        """
+        n = len(is_fixed)
+        w_off = 1 if self.class_prior else 0
+        lf_accuracy = np.zeros(n)
+        for i in range(n):
+            n_acc = int(self.hasPrior[i]) + int(not is_fixed[i])
+            lf_accuracy[i] = np.sum(w[w_off:w_off + n_acc])
+            w_off += n_acc
+
+        return np.concatenate([w[:w_off], _propensity_weights(coverage,
+            lf_accuracy, cardinalities, counts)])
+
     def _compile_output_factors(self, L, factors, factors_offset, ftv, 
         ftv_offset, weight_offset, factor_name, vid_funcs,
         nfactors_for_lf=None):
@@ -726,26 +1625,27 @@ class GenerativeModel(Classifier):
         if nfactors_for_lf == None:
             nfactors_for_lf = [1 for i in range(n)]
 
-        factors_index = factors_offset
-        ftv_index = ftv_offset
-        for i in range(m):
-            w_off = weight_offset
-            for j in range(n):
-                for k in range(nfactors_for_lf[j]):
-                    factors[factors_index]["factorFunction"] = FACTORS[factor_name]
-                    factors[factors_index]["weightId"] = w_off
-                    factors[factors_index]["featureValue"] = 1
-                    factors[factors_index]["arity"] = len(vid_funcs)
-                    factors[factors_index]["ftv_offset"] = ftv_index
+        # Each candidate has the same sequence of factors, with weights
+        # weight_offset, weight_offset + 1, ..., over the outputs of LFs lfs
+        lfs = np.repeat(np.arange(n), nfactors_for_lf)
+        n_per_row = len(lfs)
+        n_factors = m * n_per_row
+        arity = len(vid_funcs)
 
-                    factors_index += 1
-                    w_off += 1
+        f = factors[factors_offset:factors_offset + n_factors]
+        f["factorFunction"] = FACTORS[factor_name]
+        f["weightId"] = np.tile(weight_offset + np.arange(n_per_row), m)
+        f["featureValue"] = 1
+        f["arity"] = arity
+        f["ftv_offset"] = ftv_offset + arity * np.arange(n_factors)
 
-                    for vid_func in vid_funcs:
-                        ftv[ftv_index]["vid"] = vid_func(m, n, i, j)
-                        ftv_index += 1
+        i = np.repeat(np.arange(m), n_per_row)
+        j = np.tile(lfs, m)
+        vids = np.column_stack([vid_func(m, n, i, j) for vid_func in vid_funcs])
+        ftv[ftv_offset:ftv_offset + arity * n_factors]["vid"] = vids.ravel()
 
-        return factors_index, ftv_index, w_off
+        return factors_offset + n_factors, ftv_offset + arity * n_factors, \
+            weight_offset + n_per_row
 
     def _compile_dep_factors(self, L, factors, factors_offset, ftv, ftv_offset, weight_offset, j, k, factor_name, vid_funcs):
         """
@@ -753,26 +1653,22 @@ class GenerativeModel(Classifier):
         class label).
         """
         m, n = L.shape
+        arity = len(vid_funcs)
 
-        for i in range(m):
-            factors_index = factors_offset + i
-            ftv_index = ftv_offset + len(vid_funcs) * i
-
-            factors[factors_index]["factorFunction"] = FACTORS[factor_name]
-            factors[factors_index]["weightId"] = weight_offset
-            factors[factors_index]["featureValue"] = 1
-            factors[factors_index]["arity"] = len(vid_funcs)
-            factors[factors_index]["ftv_offset"] = ftv_index
+        f = factors[factors_offset:factors_offset + m]
+        f["factorFunction"] = FACTORS[factor_name]
+        f["weightId"] = weight_offset
+        f["featureValue"] = 1
+        f["arity"] = arity
+        f["ftv_offset"] = ftv_offset + arity * np.arange(m)
 
-            for i_var, vid_func in enumerate(vid_funcs):
-                ftv[ftv_index + i_var]["vid"] = vid_func(m, n, i, j, k)
+        i = np.arange(m)
+        vids = np.column_stack([vid_func(m, n, i, j, k) for vid_func in vid_funcs])
+        ftv[ftv_offset:ftv_offset + arity * m]["vid"] = vids.ravel()
 
-        return factors_offset + m, ftv_offset + len(vid_funcs) * m, weight_offset + 1
+        return factors_offset + m, ftv_offset + arity * m, weight_offset + 1
 
-    def _process_learned_weights(self, L, fg, LF_acc_prior_weights, is_fixed):
-        _, n = L.shape
-
-        w = fg.getFactorGraph().getWeights()
+    def _process_learned_weights(self, n, w, LF_acc_prior_weights, is_fixed):
         weights = GenerativeModelWeights(n)
 
         if self.class_prior:
@@ -799,102 +1695,171 @@ class GenerativeModel(Classifier):
 
         for dep_name in self.dep_names:
             mat = getattr(self, dep_name)
-            weight_mat = sparse.lil_matrix((n, n))
-
-            for i in range(len(mat.data)):
-                if w[w_off] != 0:
-                    weight_mat[mat.row[i], mat.col[i]] = w[w_off]
-                w_off += 1
-
-            setattr(weights, dep_name, weight_mat.tocsr(copy=True))
+            dep_w = w[w_off:w_off + len(mat.data)]
+            nz = dep_w != 0
+            setattr(weights, dep_name, sparse.coo_matrix(
+                (dep_w[nz], (mat.row[nz], mat.col[nz])), shape=(n, n)).tocsr())
+            w_off += len(mat.data)
 
         self.weights = weights
 
     def save(self, model_name=None, save_dir='checkpoints', verbose=True):
-        """Save current model."""
+        """
+        Save current model, as a directory model_name in save_dir holding the
+        weights and metadata, see snorkel.gen_inference.
+        """
         model_name = model_name or self.name
-        if not os.path.exists(save_dir):
-            os.makedirs(save_dir)
-        
-        # Save generative model weights
-        save_path = os.path.join(save_dir, "{0}.weights.pkl".format(model_name))
-        with open(save_path, 'wb') as f:
-            dump(self.weights, f)
-
-        # Save other model hyperparameters needed to rebuild model
-        save_path2 = os.path.join(save_dir, "{0}.hps.pkl".format(model_name))
-        with open(save_path2, 'wb') as f:
-            dump({
-                'cardinality': self.cardinality,
-                'cardinality_for_stats': self.cardinality_for_stats
-            }, f)
-
+        save_generative_model(os.path.join(save_dir, model_name),
+            self.weights,
+            name=model_name,
+            cardinality=int(self.cardinality),
+            cardinality_for_stats=int(self.cardinality_for_stats),
+            factors=dict((name, bool(getattr(self, name)))
+                for name in ('class_prior',) + self.optional_names)
+        )
         if verbose:
             print("[{0}] Model saved as <{1}>.".format(self.name, model_name))
 
-    def load(self, model_name=None, save_dir='checkpoints', verbose=True):
-        """Load model."""
+    def load(self, model_name=None, save_dir='checkpoints', verbose=True,
+        mmap=True):
+        """
+        Load model saved with save, memory-mapping its weights if mmap. Models
+        saved in the earlier pickle format are loaded as well.
+        """
         model_name = model_name or self.name
-        save_path = os.path.join(save_dir, "{0}.weights.pkl".format(model_name))
-        with open(save_path, 'rb') as f:
-            self.weights = load(f)
-        save_path2 = os.path.join(save_dir, "{0}.hps.pkl".format(model_name))
-        with open(save_path2, 'rb') as f:
-            hps = load(f)
-            for k, v in hps.iteritems():
-                setattr(self, k, v)
+        model_dir = os.path.join(save_dir, model_name)
+        if os.path.isdir(model_dir):
+            self.weights, metadata = load_generative_model(model_dir,
+                mmap=mmap)
+            self.cardinality = metadata['cardinality']
+            self.cardinality_for_stats = metadata['cardinality_for_stats']
+            for name, included in iteritems(metadata['factors']):
+                setattr(self, name, included)
+        else:
+            save_path = os.path.join(save_dir,
+                "{0}.weights.pkl".format(model_name))
+            with open(save_path, 'rb') as f:
+                self.weights = load(f)
+            save_path2 = os.path.join(save_dir, "{0}.hps.pkl".format(model_name))
+            with open(save_path2, 'rb') as f:
+                hps = load(f)
+                for k, v in iteritems(hps):
+                    setattr(self, k, v)
         if verbose:
             print("[{0}] Model <{1}> loaded.".format(self.name, model_name))
 
 
-class GenerativeModelWeights(object):
+def _flatten_ranges(candidate_ranges):
+    """
+    Flattens a list of M candidate ranges into an (M + 1)-dim array of offsets
+    range_ptr and an array range_values, such that the range of candidate i
+    is range_values[range_ptr[i]:range_ptr[i + 1]]
+    """
+    lengths = np.fromiter((len(r) for r in candidate_ranges), dtype=np.int64,
+        count=len(candidate_ranges))
+    range_ptr = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+    range_values = np.fromiter(chain.from_iterable(candidate_ranges),
+        dtype=np.int64, count=range_ptr[-1])
+    return range_ptr, range_values
 
-    def __init__(self, n):
-        self.n = n
-        self.class_prior = 0.0
-        self.lf_accuracy = np.zeros(n, dtype=np.float64)
-        for optional_name in GenerativeModel.optional_names:
-            setattr(self, optional_name, np.zeros(n, dtype=np.float64))
 
-        for dep_name in GenerativeModel.dep_names:
-            setattr(self, dep_name, sparse.lil_matrix((n, n), dtype=np.float64))
-
-    def is_sign_sparsistent(self, other, threshold=0.1):
-        if self.n != other.n:
-            raise ValueError("Dimension mismatch. %d versus %d" % (self.n, other.n))
+def _lf_coverage(L, counts=None):
+    """
+    Returns the fraction of candidates labeled by each LF, optionally given
+    the number of candidates represented by each row of L
+    """
+    L = sparse.csr_matrix(L)
+    m, n = L.shape
+    if counts is None:
+        counts = np.ones(m)
+    labeled = L.data != 0
+    entry_counts = np.repeat(counts, np.diff(L.indptr))[labeled]
+    return np.bincount(L.indices[labeled], weights=entry_counts,
+        minlength=n) / float(np.sum(counts))
+
+
+def _propensity_weights(coverage, lf_accuracy, cardinalities, counts=None,
+    n_iter=50):
+    """
+    Solves for the LF propensity weights p such that, for each LF with total
+    accuracy weight a, the expected fraction of candidates it labels,
 
-        if not self._weight_is_sign_sparsitent(self.class_prior, other.class_prior, threshold):
-            return False
+        mean_i S_i e^p / (S_i e^p + 1),  S_i = e^a + (K_i - 1) e^-a,
 
-        for i in range(self.n):
-            if not self._weight_is_sign_sparsitent(
-                    self.lf_accuracy[i], other.lf_accuracy[i], threshold):
-                return False
-
-        for name in GenerativeModel.optional_names:
-            for i in range(self.n):
-                if not self._weight_is_sign_sparsitent(
-                        getattr(self, name)[i], getattr(other, name)[i], threshold):
-                    return False
-
-        for name in GenerativeModel.dep_names:
-            for i in range(self.n):
-                for j in range(self.n):
-                    if not self._weight_is_sign_sparsitent(
-                            getattr(self, name)[i, j], getattr(other, name)[i, j], threshold):
-                        return False
-
-        return True
-
-    def _weight_is_sign_sparsitent(self, w1, w2, threshold):
-        if abs(w1) <= threshold and abs(w2) <= threshold:
-            return True
-        elif w1 > threshold and w2 > threshold:
-            return True
-        elif w1 < -1 * threshold and w2 < -1 * threshold:
-            return True
-        else:
-            return False
+    equals its coverage, where K_i is the cardinality of candidate i. This has
+    a closed form if all K_i are equal, otherwise it is found by bisection.
+    Optionally, counts gives the number of candidates with each cardinality.
+    """
+    ks, k_index = np.unique(cardinalities, return_inverse=True)
+    freqs = np.bincount(k_index.ravel(), weights=counts, minlength=len(ks))
+    freqs = freqs / freqs.sum()
+    a = np.asarray(lf_accuracy, dtype=np.float64).reshape(-1, 1)
+    log_s = np.log(np.exp(a) + (ks - 1) * np.exp(-1 * a))
+    coverage = np.clip(coverage, 1e-6, 1 - 1e-6)
+    logit = np.log(coverage / (1 - coverage))
+
+    # The solution is bracketed by the solutions for the smallest and the
+    # largest S_i
+    lo = logit - log_s.max(axis=1)
+    hi = logit - log_s.min(axis=1)
+    for _ in range(n_iter):
+        mid = (lo + hi) / 2
+        expected = (freqs / (1 + np.exp(-1 * (mid.reshape(-1, 1) + log_s)))).sum(axis=1)
+        lo = np.where(expected < coverage, mid, lo)
+        hi = np.where(expected < coverage, hi, mid)
+    return (lo + hi) / 2
+
+
+def _fit_moments(L, counts=None, n_iter=500, tol=1e-6):
+    """
+    Estimates the agreement rate a_j = E[lambda_j * y | lambda_j != 0] of each
+    LF j of a binary label matrix with the (unobserved) true class, using that
+    for conditionally independent LFs, the agreement rate of two LFs where
+    they overlap is
+
+        E[lambda_j * lambda_k | lambda_j, lambda_k != 0] = a_j * a_k.
+
+    The a_j are fit to the observed agreement rates by (overlap-weighted)
+    rank-one least squares, assuming that the LFs are better than random on
+    average.
+
+    :param L: M x N label matrix with values in {-1, 0, 1}
+    :param counts: Optionally, the number of candidates represented by each
+        row of L, see compress_label_matrix
+    :return: (agreement, coverage), where agreement is NaN for LFs which do
+        not overlap with any other LF
+    """
+    L = sparse.csr_matrix(L, dtype=np.float64)
+    m, n = L.shape
+    if counts is None:
+        counts = np.ones(m)
+    D = sparse.diags(np.asarray(counts, dtype=np.float64), 0)
+    A = abs(L)
+    coverage = _lf_coverage(L, counts)
+
+    # Numbers of overlaps, and of agreements minus disagreements, of each
+    # pair of LFs; the agreement rates are O / N
+    N = _off_diagonal(A.T.dot(D).dot(A)).toarray()
+    O = _off_diagonal(L.T.dot(D).dot(L)).toarray()
+
+    # Fixed point iterations for min sum N * (O / N - a a^T)^2; these are
+    # averaged with the previous iterate, as the plain updates oscillate in
+    # scale (scaling a by s scales the update by 1 / s)
+    has_overlaps = N.sum(axis=1) > 0
+    agreement = 0.5 * np.ones(n)
+    for _ in range(n_iter):
+        denom = N.dot(agreement ** 2)
+        a = np.where(denom > 0, O.dot(agreement) / np.maximum(denom, 1e-12),
+            agreement)
+        a = np.clip((a + agreement) / 2, -1, 1)
+        delta = np.max(np.abs(a - agreement)) if n > 0 else 0.0
+        agreement = a
+        if delta < tol:
+            break
+    if np.sum(coverage * agreement) < 0:
+        agreement = -1 * agreement
+    agreement[~has_overlaps] = np.nan
+    return agreement, coverage
 
 
 @jit
@@ -1,6 +1,9 @@
+from ..utils import compress_label_matrix
 from .constants import *
+from concurrent.futures import ThreadPoolExecutor
 from numba import jit
 import numpy as np
+import scipy.sparse as sparse
 
 
 class DependencySelector(object):
@@ -10,56 +13,145 @@ class DependencySelector(object):
     def __init__(self):
         pass
 
-    def select(self, L, higher_order=False, propensity=False, threshold=0.05, truncation=10):
+    def select(self, L, higher_order=False, propensity=False, threshold=0.05, truncation=10, threads=1,
+               compress=False, max_rows=None, epochs=10, tol=None, seed=None, cardinality=None):
         """
         Identifies a dependency structure among labeling functions for a given data set.
 
         By default searches for correlations, i.e., the DEP_SIMILAR dependency type.
 
-        :param L: labeling function output matrix
+        :param L: labeling function output matrix, used as a sparse matrix
+            (abstains are its zero entries) without densifying it
         :param higher_order: bool indicating whether to additionally search for higher order
                              fixing and reinforcing dependencies (DEP_FIXING and DEP_REINFORCING)
         :param propensity: bool indicating whether to include LF propensity dependencies during learning
         :param threshold: minimum magnitude weight a dependency must have to be returned (in log scale), also
                           regularization strength
         :param truncation: number of iterations between truncation step for regularization
+        :param threads: number of threads to fit the (independent) problems of the labeling functions with
+                        concurrently
+        :param compress: whether to collapse the rows of L into their unique label patterns
+                         (see snorkel.learning.utils.compress_label_matrix), each weighted by its count, so that
+                         the cost of an epoch scales with the number of unique patterns
+        :param max_rows: if set, learns from a random subsample of this many rows of L
+        :param epochs: maximum number of passes over the rows for each labeling function
+        :param tol: if set, stops the fit for a labeling function after an epoch in which no weight changed by
+                    more than tol
+        :param seed: seed for the random subsample of rows
+        :param cardinality: number of possible classes, by default inferred from L as in
+                            snorkel.learning.gen_learning.GenerativeModel: binary LFs label with values in
+                            {-1, 0, 1}, and categorical LFs with values in {0, 1, ..., K}. For categorical label
+                            matrices only DEP_SIMILAR dependencies are supported.
         :return: collection of tuples of the format (LF 1 index, LF 2 index, dependency type),
                  see snorkel.learning.constants
         """
-        try:
-            L = L.todense()
-        except AttributeError:
-            pass
+        return self.select_path(L, [threshold], higher_order=higher_order, propensity=propensity,
+                                truncation=truncation, threads=threads, compress=compress, max_rows=max_rows,
+                                epochs=epochs, tol=tol, seed=seed, cardinality=cardinality)[threshold]
+
+    def select_path(self, L, thresholds, higher_order=False, propensity=False, truncation=10, threads=1,
+                    compress=False, max_rows=None, epochs=10, path_epochs=2, tol=None, seed=None,
+                    cardinality=None):
+        """
+        Identifies the dependency structures among labeling functions for a sequence of thresholds, i.e., along
+        the L1 regularization path, in one call.
+
+        The structure for the largest threshold is fit as in select. Then the fit for each next smaller
+        threshold starts from the weights for the previous one, and takes at most path_epochs epochs, so that
+        the whole path costs about as much as a single call to select.
+
+        :param thresholds: collection of thresholds, see select
+        :param path_epochs: maximum number of epochs for each warm-started threshold after the first
+
+        See select for the other parameters.
+
+        :return: dictionary mapping each threshold to its collection of dependencies, as returned by select
+        """
+        L = sparse.csr_matrix(L, dtype=np.int64, copy=True)
+        L.eliminate_zeros()
+        if cardinality is None:
+            cardinality = self._infer_cardinality(L)
+        if cardinality > 2:
+            if higher_order:
+                raise NotImplementedError("Higher order dependencies not implemented for categoricals.")
+            if L.nnz > 0 and (L.data.min() < 1 or L.data.max() > cardinality):
+                raise ValueError("Categorical labels must be in 0 to %d." % cardinality)
+        elif L.nnz > 0 and np.any(np.abs(L.data) != 1):
+            raise ValueError("Binary labels must be in {-1, 0, 1}.")
+        if max_rows is not None and max_rows < L.shape[0]:
+            rng = np.random.RandomState(seed)
+            L = L[np.sort(rng.choice(L.shape[0], max_rows, replace=False)), :]
+        if compress:
+            L, counts, _, _ = compress_label_matrix(L)
+            L = sparse.csr_matrix(L, dtype=np.int64)
+        else:
+            counts = np.ones(L.shape[0], np.int64)
+        counts = counts.astype(np.int64)
+        L.sort_indices()
 
         m, n = L.shape
+        thresholds = sorted(set(thresholds), reverse=True)
 
         # Initializes data structures
-        deps = set()
         n_weights = 2 * n
         if higher_order:
             n_weights += 4 * n
         if propensity:
             n_weights += 1
-        weights = np.zeros((n_weights,))
-        joint = np.zeros((6,))
-        # joint[0] = P(Y = -1, L_j = -1)
-        # joint[1] = P(Y = -1, L_j =  0)
-        # joint[2] = P(Y = -1, L_j =  1)
-        # joint[3] = P(Y =  1, L_j = -1)
-        # joint[4] = P(Y =  1, L_j =  0)
-        # joint[5] = P(Y =  1, L_j =  1)
-
-        for j in range(n):
-            # Initializes weights
-            for k in range(n):
-                weights[k] = 1.0
-            for k in range(n, len(weights)):
-                weights[k] = 0.0
-            if propensity:
-                weights[len(weights) - 1] = 0.0
-
-            _fit_deps(m, n, j, L, weights, joint, higher_order, propensity,  threshold, truncation)
 
+        def fit_path(j):
+            # Initializes weights
+            weights = np.zeros((n_weights,))
+            weights[:n] = 1.0
+            if cardinality > 2:
+                # joint[y, l] = P(Y = y + 1, L_j = l + 1), where l = K is abstaining
+                joint = np.zeros((cardinality, cardinality + 1))
+            else:
+                joint = np.zeros((6,))
+                # joint[0] = P(Y = -1, L_j = -1)
+                # joint[1] = P(Y = -1, L_j =  0)
+                # joint[2] = P(Y = -1, L_j =  1)
+                # joint[3] = P(Y =  1, L_j = -1)
+                # joint[4] = P(Y =  1, L_j =  0)
+                # joint[5] = P(Y =  1, L_j =  1)
+
+            path = []
+            for i, threshold in enumerate(thresholds):
+                if cardinality > 2:
+                    _fit_deps_categorical(m, n, j, cardinality, L.indptr, L.indices, L.data, counts, weights,
+                        joint, propensity, threshold, truncation, epochs if i == 0 else path_epochs,
+                        tol or 0.0)
+                else:
+                    _fit_deps(m, n, j, L.indptr, L.indices, L.data, counts, weights,
+                        joint, higher_order, propensity, threshold, truncation,
+                        epochs if i == 0 else path_epochs, tol or 0.0)
+                path.append(weights.copy())
+            return path
+
+        # The numba kernel releases the GIL, so the fits run in parallel
+        if threads > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                lf_paths = list(pool.map(fit_path, range(n)))
+        else:
+            lf_paths = [fit_path(j) for j in range(n)]
+
+        return dict((threshold, self._get_deps([path[i] for path in lf_paths], threshold, higher_order))
+                    for i, threshold in enumerate(thresholds))
+
+    def _infer_cardinality(self, L):
+        """Infers the cardinality from the values of L, see GenerativeModel._infer_cardinality"""
+        lmax = L.data.max() if L.nnz > 0 else 0
+        if lmax > 2:
+            return lmax
+        elif lmax < 2:
+            return 2
+        raise ValueError("L.max() == %s, cannot infer cardinality." % lmax)
+
+    def _get_deps(self, lf_weights, threshold, higher_order):
+        """Collects the dependencies with weights of magnitude above threshold from the fit for each LF"""
+        n = len(lf_weights)
+        deps = set()
+        for j, weights in enumerate(lf_weights):
             for k in range(n):
                 if abs(weights[n + k]) > threshold:
                     deps.add((j, k, DEP_SIMILAR) if j < k else (k, j, DEP_SIMILAR))
@@ -77,15 +169,32 @@ class DependencySelector(object):
 
 
 @jit(nopython=True, cache=True, nogil=True)
-def _fit_deps(m, n, j, L, weights, joint, higher_order, propensity, regularization, truncation):
-    step_size = 1.0 / m
-    epochs = 10
+def _fit_deps(m, n, j, indptr, indices, data, counts, weights, joint,
+              higher_order, propensity, regularization, truncation, epochs,
+              tol):
+    """
+    Fits the pseudo-likelihood of LF j with SGD over the rows of the M x N
+    label matrix given as the CSR arrays indptr, indices, and data. Each row
+    is scattered into a dense buffer of length N while it is processed, and
+    its gradient is weighted by the number of candidates it represents, in
+    counts.
+
+    :return: the number of epochs taken, fewer than epochs if no weight
+        changed by more than tol (if positive) in an epoch
+    """
+    step_size = 1.0 / np.sum(counts)
     l1delta = regularization * step_size * truncation
     last_weight = len(weights) - 1
+    row = np.zeros(n, np.int64)
+    seen = 0
 
     for t in range(epochs):
+        weights_start = weights.copy()
         for i in range(m):
-            # Processes a training example
+            # Processes a training example, weighted by its count
+            step = step_size * counts[i]
+            for p in range(indptr[i], indptr[i + 1]):
+                row[indices[p]] = data[p]
 
             # First, computes joint and conditional distributions
             joint[:] = 0, 0, 0, 0, 0, 0
@@ -97,7 +206,7 @@ def _fit_deps(m, n, j, L, weights, joint, higher_order, propensity, regularizati
                     joint[2] -= weights[j]
                     joint[3] -= weights[j]
                 else:
-                    if L[i, k] == 1:
+                    if row[k] == 1:
                         # Accuracy
                         joint[0] -= weights[k]
                         joint[1] -= weights[k]
@@ -122,7 +231,7 @@ def _fit_deps(m, n, j, L, weights, joint, higher_order, propensity, regularizati
                             joint[4] -= weights[4 * n + k]
                             joint[0] += weights[5 * n + k]
 
-                    elif L[i, k] == -1:
+                    elif row[k] == -1:
                         # Accuracy
                         joint[0] += weights[k]
                         joint[1] += weights[k]
@@ -177,10 +286,10 @@ def _fit_deps(m, n, j, L, weights, joint, higher_order, propensity, regularizati
             marginal_pos = np.sum(joint[3:6])
             marginal_neg = np.sum(joint[0:3])
 
-            if L[i, j] == 1:
+            if row[j] == 1:
                 conditional_pos = joint[5] / (joint[2] + joint[5])
                 conditional_neg = joint[2] / (joint[2] + joint[5])
-            elif L[i, j] == -1:
+            elif row[j] == -1:
                 conditional_pos = joint[3] / (joint[0] + joint[3])
                 conditional_neg = joint[0] / (joint[0] + joint[3])
             else:
@@ -192,105 +301,224 @@ def _fit_deps(m, n, j, L, weights, joint, higher_order, propensity, regularizati
             for k in range(n):
                 if j == k:
                     # Accuracy
-                    weights[j] -= step_size * (joint[5] + joint[0] - joint[2] - joint[3])
-                    if L[i, j] == 1:
-                        weights[j] += step_size * (conditional_pos - conditional_neg)
-                    elif L[i, j] == -1:
-                        weights[j] += step_size * (conditional_neg - conditional_pos)
+                    weights[j] -= step * (joint[5] + joint[0] - joint[2] - joint[3])
+                    if row[j] == 1:
+                        weights[j] += step * (conditional_pos - conditional_neg)
+                    elif row[j] == -1:
+                        weights[j] += step * (conditional_neg - conditional_pos)
                 else:
-                    if L[i, k] == 1:
+                    if row[k] == 1:
                         # Accuracy
-                        weights[k] -= step_size * (marginal_pos - marginal_neg - conditional_pos + conditional_neg)
+                        weights[k] -= step * (marginal_pos - marginal_neg - conditional_pos + conditional_neg)
 
                         # Similar
-                        weights[n + k] -= step_size * (joint[2] + joint[5])
-                        if L[i, j] == 1:
-                            weights[n + k] += step_size
+                        weights[n + k] -= step * (joint[2] + joint[5])
+                        if row[j] == 1:
+                            weights[n + k] += step
 
                         if higher_order:
                             # Incoming reinforcement
-                            weights[2 * n + k] -= step_size * (joint[5] - joint[1] - joint[4])
-                            if L[i, j] == 1:
-                                weights[2 * n + k] += step_size * conditional_pos
-                            elif L[i, j] == 0:
-                                weights[2 * n + k] += step_size * -1
+                            weights[2 * n + k] -= step * (joint[5] - joint[1] - joint[4])
+                            if row[j] == 1:
+                                weights[2 * n + k] += step * conditional_pos
+                            elif row[j] == 0:
+                                weights[2 * n + k] += step * -1
 
                             # Outgoing reinforcement
-                            weights[3 * n + k] -= step_size * joint[5]
-                            if L[i, j] == 1:
-                                weights[3 * n + k] += step_size * conditional_pos
+                            weights[3 * n + k] -= step * joint[5]
+                            if row[j] == 1:
+                                weights[3 * n + k] += step * conditional_pos
 
                             # Incoming fixing
-                            weights[4 * n + k] -= step_size * (joint[3] - joint[1] - joint[4])
-                            if L[i, j] == -1:
-                                weights[4 * n + k] += step_size * conditional_pos
-                            elif L[i, j] == 0:
-                                weights[4 * n + k] += step_size * -1
+                            weights[4 * n + k] -= step * (joint[3] - joint[1] - joint[4])
+                            if row[j] == -1:
+                                weights[4 * n + k] += step * conditional_pos
+                            elif row[j] == 0:
+                                weights[4 * n + k] += step * -1
 
                             # Outgoing fixing
-                            weights[5 * n + k] -= step_size * joint[0]
-                            if L[i, j] == -1:
-                                weights[5 * n + k] += step_size * conditional_neg
-                    elif L[i, k] == -1:
+                            weights[5 * n + k] -= step * joint[0]
+                            if row[j] == -1:
+                                weights[5 * n + k] += step * conditional_neg
+                    elif row[k] == -1:
                         # Accuracy
-                        weights[k] -= step_size * (marginal_neg - marginal_pos - conditional_neg + conditional_pos)
+                        weights[k] -= step * (marginal_neg - marginal_pos - conditional_neg + conditional_pos)
 
                         # Similar
-                        weights[n + k] -= step_size * (joint[0] + joint[3])
-                        if L[i, j] == -1:
-                            weights[n + k] += step_size
+                        weights[n + k] -= step * (joint[0] + joint[3])
+                        if row[j] == -1:
+                            weights[n + k] += step
 
                         if higher_order:
                             # Incoming reinforcement
-                            weights[2 * n + k] -= step_size * (joint[0] - joint[1] - joint[4])
-                            if L[i, j] == -1:
-                                weights[2 * n + k] += step_size * conditional_neg
-                            elif L[i, j] == 0:
-                                weights[2 * n + k] += step_size * -1
+                            weights[2 * n + k] -= step * (joint[0] - joint[1] - joint[4])
+                            if row[j] == -1:
+                                weights[2 * n + k] += step * conditional_neg
+                            elif row[j] == 0:
+                                weights[2 * n + k] += step * -1
 
                             # Outgoing reinforcement
-                            weights[3 * n + k] -= step_size * joint[0]
-                            if L[i, j] == -1:
-                                weights[3 * n + k] += step_size * conditional_neg
+                            weights[3 * n + k] -= step * joint[0]
+                            if row[j] == -1:
+                                weights[3 * n + k] += step * conditional_neg
 
                             # Incoming fixing
-                            weights[4 * n + k] -= step_size * (joint[2] - joint[1] - joint[4])
-                            if L[i, j] == 1:
-                                weights[4 * n + k] += step_size * conditional_neg
-                            elif L[i, j] == 0:
-                                weights[4 * n + k] += step_size * -1
+                            weights[4 * n + k] -= step * (joint[2] - joint[1] - joint[4])
+                            if row[j] == 1:
+                                weights[4 * n + k] += step * conditional_neg
+                            elif row[j] == 0:
+                                weights[4 * n + k] += step * -1
 
                             # Outgoing fixing
-                            weights[5 * n + k] -= step_size * joint[5]
-                            if L[i, j] == 1:
-                                weights[5 * n + k] += step_size * conditional_pos
+                            weights[5 * n + k] -= step * joint[5]
+                            if row[j] == 1:
+                                weights[5 * n + k] += step * conditional_pos
                     else:
                         # Similar
-                        weights[n + k] -= step_size * (joint[1] + joint[4])
-                        if L[i, j] == 0:
-                            weights[n + k] += step_size
+                        weights[n + k] -= step * (joint[1] + joint[4])
+                        if row[j] == 0:
+                            weights[n + k] += step
 
                         if higher_order:
                             # No effect of incoming reinforcement
 
                             # Outgoing reinforcement
-                            weights[3 * n + k] -= step_size * (-1 * joint[0] - joint[2] - joint[3] - joint[5])
-                            if L[i, j] != 0:
-                                weights[3 * n + k] += step_size * -1
+                            weights[3 * n + k] -= step * (-1 * joint[0] - joint[2] - joint[3] - joint[5])
+                            if row[j] != 0:
+                                weights[3 * n + k] += step * -1
 
                             # No effect of incoming fixing
 
                             # Outgoing fixing
-                            weights[5 * n + k] -= step_size * (-1 * joint[0] - joint[2] - joint[3] - joint[5])
-                            if L[i, j] != 0:
-                                weights[5 * n + k] += step_size * -1
+                            weights[5 * n + k] -= step * (-1 * joint[0] - joint[2] - joint[3] - joint[5])
+                            if row[j] != 0:
+                                weights[5 * n + k] += step * -1
 
             if propensity:
-                weights[last_weight] -= step_size * (joint[0] + joint[2] + joint[3] + joint[5])
-                if L[i, j] != 0:
-                    weights[last_weight] += step_size
+                weights[last_weight] -= step * (joint[0] + joint[2] + joint[3] + joint[5])
+                if row[j] != 0:
+                    weights[last_weight] += step
+
+            # Third, takes regularization gradient step, once per truncation
+            # candidates
+            n_truncations = (seen + counts[i] - 1) // truncation - \
+                (seen - 1) // truncation
+            seen += counts[i]
+            if n_truncations > 0:
+                delta = l1delta * n_truncations
+                for k in range(len(weights)):
+                    weights[k] = max(0, weights[k] - delta) if weights[k] > 0 else min(0, weights[k] + delta)
+
+            for p in range(indptr[i], indptr[i + 1]):
+                row[indices[p]] = 0
+
+        if tol > 0 and np.max(np.abs(weights - weights_start)) < tol:
+            return t + 1
+    return epochs
 
-            # Third, takes regularization gradient step
-            if (t * m + i) % truncation == 0:
+
+@jit(nopython=True, cache=True, nogil=True)
+def _fit_deps_categorical(m, n, j, cardinality, indptr, indices, data, counts,
+                          weights, joint, propensity, regularization,
+                          truncation, epochs, tol):
+    """
+    Categorical version of _fit_deps, for LFs labeling with values in
+    1, ..., K = cardinality, supporting accuracy, DEP_SIMILAR, and propensity
+    weights. The classes and labels are mapped to 0, ..., K - 1 internally,
+    with K for abstaining, and joint is the K x (K + 1) table of (Y, L_j).
+    """
+    K = cardinality
+    step_size = 1.0 / np.sum(counts)
+    l1delta = regularization * step_size * truncation
+    last_weight = len(weights) - 1
+    row = np.full(n, K, np.int64)
+    accuracy = np.zeros(K)
+    similar = np.zeros(K + 1)
+    marginal = np.zeros(K)
+    conditional = np.zeros(K)
+    seen = 0
+
+    for t in range(epochs):
+        weights_start = weights.copy()
+        for i in range(m):
+            # Processes a training example, weighted by its count
+            step = step_size * counts[i]
+            for p in range(indptr[i], indptr[i + 1]):
+                row[indices[p]] = data[p] - 1
+            l = row[j]
+
+            # First, computes joint and conditional distributions, summing
+            # the accuracy weights of the other LFs by the class they vote
+            # for, and their similarity weights by their label
+            accuracy[:] = 0.0
+            similar[:] = 0.0
+            labeled = 0.0
+            for k in range(n):
+                if k != j:
+                    if row[k] != K:
+                        accuracy[row[k]] += weights[k]
+                        labeled += weights[k]
+                    similar[row[k]] += weights[n + k]
+
+            for y in range(K):
+                for c in range(K + 1):
+                    joint[y, c] = 2 * accuracy[y] - labeled + similar[c]
+                    if c != K:
+                        # Accuracy of LF j
+                        joint[y, c] += weights[j] if c == y else -weights[j]
+                        if propensity:
+                            joint[y, c] += weights[last_weight]
+
+            joint -= joint.max()
+            joint[:, :] = np.exp(joint)
+            joint /= joint.sum()
+
+            total = 0.0
+            for y in range(K):
+                marginal[y] = joint[y, :].sum()
+                conditional[y] = joint[y, l]
+                total += joint[y, l]
+            conditional /= total
+
+            # Second, takes likelihood gradient step
+
+            # Accuracy of LF j
+            expected = 0.0
+            for y in range(K):
+                expected += 2 * joint[y, y] - joint[y, :K].sum()
+            weights[j] -= step * expected
+            if l != K:
+                weights[j] += step * (2 * conditional[l] - 1)
+
+            for k in range(n):
+                if k != j:
+                    # Accuracy
+                    if row[k] != K:
+                        weights[k] += step * 2 * (conditional[row[k]] - marginal[row[k]])
+
+                    # Similar
+                    weights[n + k] -= step * joint[:, row[k]].sum()
+                    if l == row[k]:
+                        weights[n + k] += step
+
+            if propensity:
+                weights[last_weight] -= step * (1 - joint[:, K].sum())
+                if l != K:
+                    weights[last_weight] += step
+
+            # Third, takes regularization gradient step, once per truncation
+            # candidates
+            n_truncations = (seen + counts[i] - 1) // truncation - \
+                (seen - 1) // truncation
+            seen += counts[i]
+            if n_truncations > 0:
+                delta = l1delta * n_truncations
                 for k in range(len(weights)):
-                    weights[k] = max(0, weights[k] - l1delta) if weights[k] > 0 else min(0, weights[k] + l1delta)
+                    weights[k] = max(0, weights[k] - delta) if weights[k] > 0 else min(0, weights[k] + delta)
+
+            for p in range(indptr[i], indptr[i + 1]):
+                row[indices[p]] = K
+
+        if tol > 0 and np.max(np.abs(weights - weights_start)) < tol:
+            return t + 1
+    return epochs
@@ -1,11 +1,35 @@
-from numbskull import NumbSkull
-from numbskull.inference import FACTORS
-from numbskull.numbskulltypes import Weight, Variable, Factor, FactorToVar
+from numba import jit
 import numpy as np
 import random
 import scipy.sparse as sparse
 from snorkel.learning import GenerativeModel, GenerativeModelWeights
 
+# The potentials of the factors of a generative model as tables indexed by the values of their variables, as evaluated
+# by numbskull, with the true label y indexed by {1: 0, -1: 1} and LF labels indexed by {1: 0, -1: 1, 0: 2}
+Y_VALUES = np.array([1, -1])
+LF_VALUES = np.array([1, -1, 0])
+
+CLASS_PRIOR = np.array([-1.0, 1.0])
+LF_PRIOR = np.array([0.0, 1.0, -1.0])
+LF_PROPENSITY = np.array([1.0, 1.0, 0.0])
+LF_ACCURACY = np.array([[1.0, -1.0, 0.0],
+                        [-1.0, 1.0, 0.0]])
+LF_CLASS_PROPENSITY = np.array([[-1.0, -1.0, 0.0],
+                                [1.0, 1.0, 0.0]])
+
+
+def _dep_table(f):
+    return np.array([[[f(y, l1, l2) for l2 in range(3)] for l1 in range(3)] for y in range(2)], dtype=np.float64)
+
+DEP_TABLES = {
+    'dep_similar': _dep_table(lambda y, l1, l2: 1 if l1 == l2 else 0),
+    'dep_fixing': _dep_table(lambda y, l1, l2: (-1 if l2 != 1 else 0) if l1 == 2 else
+                             1 if (l1, l2, y) in ((0, 1, 1), (1, 0, 0)) else 0),
+    'dep_reinforcing': _dep_table(lambda y, l1, l2: (-1 if l2 != 1 else 0) if l1 == 2 else
+                                  1 if (l1, l2, y) in ((0, 0, 0), (1, 1, 1)) else 0),
+    'dep_exclusive': _dep_table(lambda y, l1, l2: -1 if l1 != 2 and l2 != 2 else 0),
+}
+
 
 def generate_model(n, dep_density, class_prior=False, lf_propensity=False, lf_prior=False, lf_class_propensity=False,
                    dep_similar=False, dep_reinforcing=False, dep_fixing=False, dep_exclusive=False, force_dep=False):
@@ -28,35 +52,42 @@ def generate_model(n, dep_density, class_prior=False, lf_propensity=False, lf_pr
         for i in range(n):
             weights.lf_class_propensity[i] = random.choice((1.0, -1.0))
 
+    # Collects the dependencies as (row, column) entries of the sparse dependency weight matrices
+    deps = dict((dep_name, ([], [])) for dep_name in GenerativeModel.dep_names)
+
     if dep_similar:
         for i in range(n):
             for j in range(i+1, n):
                 if random.random() < dep_density:
-                    weights.dep_similar[i, j] = 0.25
+                    _add_dep(deps['dep_similar'], i, j)
 
     if dep_fixing:
         for i in range(n):
             for j in range(i+1, n):
                 if random.random() < dep_density:
                     if random.random() < 0.5:
-                        weights.dep_fixing[i, j] = 0.25
+                        _add_dep(deps['dep_fixing'], i, j)
                     else:
-                        weights.dep_fixing[j, i] = 0.25
+                        _add_dep(deps['dep_fixing'], j, i)
 
     if dep_reinforcing:
         for i in range(n):
             for j in range(i+1, n):
                 if random.random() < dep_density:
                     if random.random() < 0.5:
-                        weights.dep_reinforcing[i, j] = 0.25
+                        _add_dep(deps['dep_reinforcing'], i, j)
                     else:
-                        weights.dep_reinforcing[j, i] = 0.25
+                        _add_dep(deps['dep_reinforcing'], j, i)
 
     if dep_exclusive:
         for i in range(n):
             for j in range(i+1, n):
                 if random.random() < dep_density:
-                    weights.dep_exclusive[i, j] = 0.25
+                    _add_dep(deps['dep_exclusive'], i, j)
+
+    for dep_name, (rows, cols) in deps.items():
+        setattr(weights, dep_name, sparse.csr_matrix(
+            (0.25 * np.ones(len(rows)), (rows, cols)), shape=(n, n)))
 
     if force_dep and weights.dep_similar.getnnz() == 0 and weights.dep_fixing.getnnz() == 0 \
         and weights.dep_reinforcing.getnnz() == 0 and weights.dep_exclusive.getnnz() == 0:
@@ -67,205 +98,117 @@ def generate_model(n, dep_density, class_prior=False, lf_propensity=False, lf_pr
         return weights
 
 
-def generate_label_matrix(weights, m):
-    # Compilation
-
-    # Weights
-    n_weights = 1 if weights.class_prior != 0.0 else 0
-
-    n_weights += weights.n
-
-    for optional_name in GenerativeModel.optional_names:
-        for i in range(weights.n):
-            if getattr(weights, optional_name)[i] != 0.0:
-                n_weights += 1
-
-    for dep_name in GenerativeModel.dep_names:
-        for i in range(weights.n):
-            for j in range(weights.n):
-                if getattr(weights, dep_name)[i, j] != 0.0:
-                    n_weights += 1
-
-    weight = np.zeros(n_weights, Weight)
-    for i in range(len(weight)):
-        weight[i]['isFixed'] = True
-
-    if weights.class_prior != 0.0:
-        weight[0]['initialValue'] = np.float64(weights.class_prior)
-        w_off = 1
-    else:
-        w_off = 0
-
-    for i in range(weights.n):
-        weight[w_off + i]['initialValue'] = np.float64(weights.lf_accuracy[i])
-    w_off += weights.n
-
-    for optional_name in GenerativeModel.optional_names:
-        for i in range(weights.n):
-            if getattr(weights, optional_name)[i] != 0.0:
-                weight[w_off]['initialValue'] = np.float64(getattr(weights, optional_name)[i])
-                w_off += 1
+def _add_dep(entries, i, j):
+    entries[0].append(i)
+    entries[1].append(j)
 
-    for dep_name in GenerativeModel.dep_names:
-        for i in range(weights.n):
-            for j in range(weights.n):
-                if getattr(weights, dep_name)[i, j] != 0.0:
-                    weight[w_off]['initialValue'] = np.float64(getattr(weights, dep_name)[i, j])
-                    w_off += 1
-
-    # Variables
-    variable = np.zeros(1 + weights.n, Variable)
-
-    variable[0]['isEvidence'] = 0
-    variable[0]['initialValue'] = 0
-    variable[0]["dataType"] = 0
-    variable[0]["cardinality"] = 2
-
-    for i in range(weights.n):
-        variable[1 + i]['isEvidence'] = 0
-        variable[1 + i]['initialValue'] = 0
-        variable[1 + i]["dataType"] = 0
-        variable[1 + i]["cardinality"] = 3
-
-    # Factors and FactorToVar
-    n_edges = 1 if weights.class_prior != 0.0 else 0
-    n_edges += 2 * weights.n
-    for optional_name in GenerativeModel.optional_names:
-        for i in range(weights.n):
-            if getattr(weights, optional_name)[i] != 0.0:
-                if optional_name == 'lf_prior' or optional_name == 'lf_propensity':
-                    n_edges += 1
-                elif optional_name == 'lf_class_propensity':
-                    n_edges += 2
-                else:
-                    raise ValueError()
-    for dep_name in GenerativeModel.dep_names:
-        for i in range(weights.n):
-            for j in range(weights.n):
-                if getattr(weights, dep_name)[i, j] != 0.0:
-                    if dep_name == 'dep_similar' or dep_name == 'dep_exclusive':
-                        n_edges += 2
-                    elif dep_name == 'dep_fixing' or dep_name == 'dep_reinforcing':
-                        n_edges += 3
-                    else:
-                        raise ValueError()
 
-    factor = np.zeros(n_weights, Factor)
-    ftv = np.zeros(n_edges, FactorToVar)
+def generate_label_matrix(weights, m, burn_in=10, batch_size=10000, seed=None):
+    """
+    Samples true labels and a label matrix from a generative model.
 
-    if weights.class_prior != 0.0:
-        factor[0]["factorFunction"] = FACTORS["DP_GEN_CLASS_PRIOR"]
-        factor[0]["weightId"] = 0
-        factor[0]["featureValue"] = 1
-        factor[0]["arity"] = 1
-        factor[0]["ftv_offset"] = 0
+    Candidates are sampled independently, in batches of batch_size. Without dependencies, each candidate is sampled
+    exactly with vectorized NumPy operations: its true label from its marginal distribution, and then the labels of
+    the LFs, which are conditionally independent given it. With dependencies, each batch is then updated with burn_in
+    sweeps of Gibbs sampling, each resampling the true labels of the whole batch, and then the labels of each LF.
 
-        ftv[0]["vid"] = 0
+    :param weights: a GenerativeModelWeights instance
+    :param m: number of candidates
+    :param burn_in: number of sweeps of Gibbs sampling if the model has dependencies
+    :param batch_size: number of candidates sampled at once
+    :param seed: seed for the random number generator
+    :return: (y, L), an m-dim array of the true labels in {-1, 1} and an m x n CSR label matrix
+    """
+    rng = np.random.RandomState(seed)
+    n = weights.n
 
-        f_off = 1
-        ftv_off = 1
-    else:
-        f_off = 0
-        ftv_off = 0
-
-    for i in range(weights.n):
-        factor[f_off + i]["factorFunction"] = FACTORS["DP_GEN_LF_ACCURACY"]
-        factor[f_off + i]["weightId"] = f_off + i
-        factor[f_off + i]["featureValue"] = 1
-        factor[f_off + i]["arity"] = 2
-        factor[f_off + i]["ftv_offset"] = ftv_off + 2 * i
-
-        ftv[ftv_off + 2 * i]["vid"] = 0
-        ftv[ftv_off + 2 * i + 1]["vid"] = 1 + i
-    f_off += weights.n
-    ftv_off += 2 * weights.n
-
-    for i in range(weights.n):
-        if weights.lf_prior[i] != 0.0:
-            factor[f_off]["factorFunction"] = FACTORS["DP_GEN_LF_PRIOR"]
-            factor[f_off]["weightId"] = f_off
-            factor[f_off]["featureValue"] = 1
-            factor[f_off]["arity"] = 1
-            factor[f_off]["ftv_offset"] = ftv_off
-
-            ftv[ftv_off]["vid"] = 1 + i
-            f_off += 1
-            ftv_off += 1
-
-    for i in range(weights.n):
-        if weights.lf_propensity[i] != 0.0:
-            factor[f_off]["factorFunction"] = FACTORS["DP_GEN_LF_PROPENSITY"]
-            factor[f_off]["weightId"] = f_off
-            factor[f_off]["featureValue"] = 1
-            factor[f_off]["arity"] = 1
-            factor[f_off]["ftv_offset"] = ftv_off
-
-            ftv[ftv_off]["vid"] = 1 + i
-            f_off += 1
-            ftv_off += 1
-
-    for i in range(weights.n):
-        if weights.lf_class_propensity[i] != 0.0:
-            factor[f_off]["factorFunction"] = FACTORS["DP_GEN_LF_CLASS_PROPENSITY"]
-            factor[f_off]["weightId"] = f_off
-            factor[f_off]["featureValue"] = 1
-            factor[f_off]["arity"] = 2
-            factor[f_off]["ftv_offset"] = ftv_off
-
-            ftv[ftv_off]["vid"] = 0
-            ftv[ftv_off + 1]["vid"] = 1 + i
-
-            f_off += 1
-            ftv_off += 2
+    unary = weights.lf_accuracy[:, None, None] * LF_ACCURACY[None, :, :] \
+        + weights.lf_class_propensity[:, None, None] * LF_CLASS_PROPENSITY[None, :, :] \
+        + (weights.lf_prior[:, None] * LF_PRIOR[None, :] +
+           weights.lf_propensity[:, None] * LF_PROPENSITY[None, :])[:, None, :]
+    class_prior = weights.class_prior * CLASS_PRIOR
 
+    # Collects the dependencies as potential tables with their pairs of LFs, indexed by LF
+    tables, lfs = [], []
     for dep_name in GenerativeModel.dep_names:
-        for i in range(weights.n):
-            for j in range(weights.n):
-                if getattr(weights, dep_name)[i, j] != 0.0:
-                    if dep_name == 'dep_similar' or dep_name == 'dep_exclusive':
-                        factor[f_off]["factorFunction"] = FACTORS["DP_GEN_DEP_SIMILAR"] if dep_name == 'dep_similar' else FACTORS["DP_GEN_DEP_EXCLUSIVE"]
-                        factor[f_off]["weightId"] = f_off
-                        factor[f_off]["featureValue"] = 1
-                        factor[f_off]["arity"] = 2
-                        factor[f_off]["ftv_offset"] = ftv_off
-
-                        ftv[ftv_off]["vid"] = 1 + i
-                        ftv[ftv_off + 1]["vid"] = 1 + j
-
-                        f_off += 1
-                        ftv_off += 2
-                    elif dep_name == 'dep_fixing' or dep_name == 'dep_reinforcing':
-                        factor[f_off]["factorFunction"] = FACTORS["DP_GEN_DEP_FIXING"] if dep_name == 'dep_fixing' else FACTORS["DP_GEN_DEP_REINFORCING"]
-
-                        factor[f_off]["weightId"] = f_off
-                        factor[f_off]["featureValue"] = 1
-                        factor[f_off]["arity"] = 3
-                        factor[f_off]["ftv_offset"] = ftv_off
-
-                        ftv[ftv_off]["vid"] = 0
-                        ftv[ftv_off + 1]["vid"] = 1 + i
-                        ftv[ftv_off + 2]["vid"] = 1 + j
-
-                        f_off += 1
-                        ftv_off += 3
-                    else:
-                        raise ValueError()
-
-    # Domain mask
-    domain_mask = np.zeros(1 + weights.n, np.bool)
-
-    # Instantiates factor graph
-    ns = NumbSkull(n_inference_epoch=100, quiet=True)
-    ns.loadFactorGraph(weight, variable, factor, ftv, domain_mask, n_edges)
-    fg = ns.getFactorGraph()
-
-    y = np.ndarray((m,), np.int64)
-    L = sparse.lil_matrix((m, weights.n), dtype=np.int64)
+        dep = sparse.coo_matrix(getattr(weights, dep_name))
+        nz = dep.data != 0
+        tables.append(dep.data[nz, None, None, None] * DEP_TABLES[dep_name][None])
+        lfs.append(np.column_stack((dep.row[nz], dep.col[nz])))
+    tables = np.concatenate(tables)
+    lfs = np.concatenate(lfs).astype(np.int64)
+    lf_deps = sparse.csr_matrix((np.ones(2 * len(lfs)), (lfs.T.ravel(), np.tile(np.arange(len(lfs)), 2))),
+                                shape=(n, len(lfs)))
+
+    ys, Ls = [], []
+    for start in range(0, m, batch_size):
+        y, L = _sample_independent(unary, class_prior, min(batch_size, m - start), rng)
+        for _ in range(burn_in if len(tables) > 0 else 0):
+            _gibbs_sweep(y, L, unary, class_prior, tables, lfs, lf_deps.indptr, lf_deps.indices,
+                         rng.rand(L.shape[0], n + 1))
+        ys.append(Y_VALUES[y])
+        Ls.append(sparse.csr_matrix(LF_VALUES[L]))
+
+    if m == 0:
+        return np.zeros((0,), np.int64), sparse.csr_matrix((0, n), dtype=np.int64)
+    return np.concatenate(ys), sparse.vstack(Ls, format='csr')
+
+
+def _sample_categorical(logits, rng):
+    """Samples an index of the last axis of unnormalized log-probabilities"""
+    cum = np.cumsum(np.exp(logits - logits.max(axis=-1)[..., None]), axis=-1)
+    return (rng.rand(*cum.shape[:-1])[..., None] * cum[..., -1:] > cum).sum(axis=-1)
+
+
+def _sample_independent(unary, class_prior, m, rng):
+    """Samples m candidates exactly from the model without its dependencies"""
+    n = unary.shape[0]
+    lf_log_z = np.log(np.exp(unary).sum(axis=2)).sum(axis=0)
+    y = _sample_categorical(np.tile(class_prior + lf_log_z, (m, 1)), rng)
+
+    # Samples the LF labels by comparing uniform samples to the cumulative conditional probabilities of the first two
+    # values given each true label
+    cum = np.cumsum(np.exp(unary), axis=2)
+    cum = cum[:, :, :2] / cum[:, :, 2:]
+    u = rng.rand(m, n)
+    L = np.zeros((m, n), np.int64)
+    for y_index in range(2):
+        rows = y == y_index
+        L[rows] = (u[rows] > cum[None, :, y_index, 0]).astype(np.int64) + (u[rows] > cum[None, :, y_index, 1])
+    return y, L
+
+
+@jit(nopython=True, cache=True, nogil=True)
+def _gibbs_sweep(y, L, unary, class_prior, tables, lfs, lf_deps_indptr, lf_deps_indices, u):
+    """
+    Updates a batch of candidates with a sweep of Gibbs sampling, resampling the true labels of all candidates, and
+    then the labels of each LF for all candidates, given the uniform samples u
+    """
+    m, n = L.shape
+    logits = np.zeros(3)
     for i in range(m):
-        fg.burnIn(10, False)
-        y[i] = 1 if fg.var_value[0, 0] == 0 else -1
-        for j in range(weights.n):
-            if fg.var_value[0, 1 + j] != 2:
-                L[i, j] = 1 if fg.var_value[0, 1 + j] == 0 else -1
-
-    return y, L.tocsr()
+        e0, e1 = class_prior[0], class_prior[1]
+        for j in range(n):
+            e0 += unary[j, 0, L[i, j]]
+            e1 += unary[j, 1, L[i, j]]
+        for d in range(len(tables)):
+            e0 += tables[d, 0, L[i, lfs[d, 0]], L[i, lfs[d, 1]]]
+            e1 += tables[d, 1, L[i, lfs[d, 0]], L[i, lfs[d, 1]]]
+        y[i] = 0 if u[i, 0] * (1 + np.exp(e1 - e0)) < 1 else 1
+
+    for j in range(n):
+        for i in range(m):
+            for v in range(3):
+                logits[v] = unary[j, y[i], v]
+            for p in range(lf_deps_indptr[j], lf_deps_indptr[j + 1]):
+                d = lf_deps_indices[p]
+                for v in range(3):
+                    l1 = v if lfs[d, 0] == j else L[i, lfs[d, 0]]
+                    l2 = v if lfs[d, 1] == j else L[i, lfs[d, 1]]
+                    logits[v] += tables[d, y[i], l1, l2]
+
+            # Samples from the unnormalized probabilities
+            z = logits.max()
+            p0, p1, p2 = np.exp(logits[0] - z), np.exp(logits[1] - z), np.exp(logits[2] - z)
+            r = u[i, 1 + j] * (p0 + p1 + p2)
+            L[i, j] = 0 if r < p0 else 1 if r < p0 + p1 else 2
@@ -1,18 +1,33 @@
 from .constants import *
-import random
+from ..utils import LF_cooccurrences, prune_deps
+import numpy as np
+import scipy.sparse as sparse
 
 
 def get_deps(weights, threshold=0.05, expand=0.0):
+    """
+    Returns the set of dependencies (LF 1 index, LF 2 index, dependency type) with weights of absolute value greater
+    than threshold in a GenerativeModelWeights instance.
+
+    :param expand: probability with which to also include each other dependency (i, j, _), i != j, drawn with
+                   numpy.random
+    """
     deps = set()
     for dep_mat, dep in (
             (weights.dep_fixing, DEP_FIXING),
             (weights.dep_reinforcing, DEP_REINFORCING),
             (weights.dep_similar, DEP_SIMILAR),
             (weights.dep_exclusive,  DEP_EXCLUSIVE)):
-        for i in range(weights.n):
-            for j in range(weights.n):
-                if abs(dep_mat[i, j]) > threshold or (random.random() < expand and i != j):
-                    deps.add((i, j, dep))
+        dep_mat = sparse.coo_matrix(dep_mat)
+        selected = np.abs(dep_mat.data) > threshold
+        rows, cols = dep_mat.row[selected], dep_mat.col[selected]
+        if expand > 0:
+            expanded = np.random.rand(weights.n, weights.n) < expand
+            np.fill_diagonal(expanded, False)
+            expanded_rows, expanded_cols = np.nonzero(expanded)
+            rows = np.concatenate((rows, expanded_rows))
+            cols = np.concatenate((cols, expanded_cols))
+        deps.update((int(i), int(j), dep) for i, j in zip(rows, cols))
 
     return deps
 
@@ -23,7 +38,8 @@ def get_all_deps(n, dep_fixing=False, dep_reinforcing=False, dep_similar=False,
     functions.
 
     No self dependencies are included, i.e., (i, i, _). In cases of symmetric dependencies, e.g., DEP_SIMILAR, only the
-    first case, (i, j, _) where i < j, is included.
+    first case, (i, j, _) where i < j, is included. Dependencies between LFs which rarely or never label the same
+    candidates can be dropped with prune_deps.
 
     :param n: number of labeling functions
     :param dep_fixing: whether to include DEP_FIXING dependencies. Default is False.
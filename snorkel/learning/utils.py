@@ -659,6 +659,124 @@ def sparse_abs(X):
     return X_abs
 
 
+def compress_label_matrix(L, cardinalities=None):
+    """
+    Collapses the rows of a label matrix into its unique label patterns, so
+    that computations over candidates which share the same labels are only
+    done once.
+
+    :param L: M x N sparse label matrix
+    :param cardinalities: Optionally, an M-dim array of per-candidate
+        cardinalities; rows are only merged if these are equal as well
+    :return: (L_unique, counts, index, inverse), where L_unique is the U x N
+        CSR matrix of unique rows, counts the number of rows of L with each
+        pattern, index the first row of L with each pattern, and inverse the
+        pattern of each row of L, i.e. L == L_unique[inverse]
+    """
+    L = sparse.csr_matrix(L, copy=True)
+    L.eliminate_zeros()
+    L.sort_indices()
+    m, n = L.shape
+
+    # Hash each row as a sum of random keys of its (LF, label) entries, using
+    # two independent 64-bit hashes; collisions are checked for below
+    rs = np.random.RandomState(0)
+    rows = np.repeat(np.arange(m), np.diff(L.indptr))
+    data = L.data.astype(np.int64).astype(np.uint64)
+    keys = np.zeros((3, m), dtype=np.uint64)
+    for h in range(2):
+        a = rs.randint(1, 2**62, size=n, dtype=np.int64).astype(np.uint64)
+        b = rs.randint(1, 2**62, size=n, dtype=np.int64).astype(np.uint64)
+        np.add.at(keys[h], rows, a[L.indices] * data + b[L.indices])
+    if cardinalities is not None:
+        keys[2] = np.asarray(cardinalities, dtype=np.int64)
+    _, index, inverse, counts = np.unique(keys.T, axis=0, return_index=True,
+        return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    L_unique = L[index]
+
+    # In case of a hash collision, fall back to exact (but slow) grouping
+    if (L_unique[inverse] != L).nnz > 0:
+        patterns = {}
+        inverse = np.zeros(m, dtype=np.int64)
+        for i in range(m):
+            s = slice(L.indptr[i], L.indptr[i + 1])
+            key = (L.indices[s].tobytes(), L.data[s].tobytes(), keys[2, i])
+            inverse[i] = patterns.setdefault(key, len(patterns))
+        _, index, counts = np.unique(inverse, return_index=True,
+            return_counts=True)
+        L_unique = L[index]
+    return L_unique, counts, index, inverse
+
+
+def LF_cooccurrences(L):
+    """
+    Given an M x N sparse label matrix, returns the N x N CSR matrix of the
+    number of candidates each pair of LFs both label, i.e., |L|^T |L| for the
+    indicator matrix |L| of the non-abstain labels
+    """
+    L = sparse.csr_matrix(L)
+    labeled = sparse.csr_matrix(((L.data != 0).astype(np.int64), L.indices,
+        L.indptr), shape=L.shape)
+    labeled.eliminate_zeros()
+    return sparse.csr_matrix(labeled.T.dot(labeled))
+
+
+def prune_deps(L, deps, min_overlap=1):
+    """
+    Drops the dependencies between LFs which label fewer than min_overlap
+    candidates in common, e.g., from snorkel.learning.structure.get_all_deps,
+    so that GenerativeModel.train does not compile factors for them. Their
+    weights then stay at zero.
+
+    :param L: M x N sparse label matrix
+    :param deps: collection of dependencies, each a tuple of the form
+        (LF 1 index, LF 2 index, dependency type)
+    :param min_overlap: minimum number of candidates labeled by both LFs
+    :return: the list of dependencies kept, in their original order
+    """
+    deps = list(deps)
+    if len(deps) == 0:
+        return deps
+    lfs = np.array([dep[:2] for dep in deps], dtype=np.int64)
+    overlaps = np.ravel(LF_cooccurrences(L)[lfs[:, 0], lfs[:, 1]])
+    return [dep for dep, keep in zip(deps, overlaps >= min_overlap) if keep]
+
+
+def iter_row_chunks(L, chunk_size):
+    """
+    Iterates over an M x N sparse matrix in CSR chunks of chunk_size rows.
+    For a memory-mapped matrix (see load_csr_memmap), only the current chunk
+    is read into memory.
+    """
+    for i in range(0, L.shape[0], chunk_size):
+        yield sparse.csr_matrix(L[i:i + chunk_size])
+
+
+def save_csr_memmap(L, path):
+    """
+    Saves a sparse matrix as a directory of uncompressed CSR arrays which can
+    be memory-mapped with load_csr_memmap.
+    """
+    L = sparse.csr_matrix(L)
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(path, name + '.npy'), getattr(L, name))
+    np.save(os.path.join(path, 'shape.npy'), np.array(L.shape))
+
+
+def load_csr_memmap(path):
+    """
+    Loads a sparse matrix saved with save_csr_memmap as a CSR matrix whose
+    arrays are memory-mapped (read-only), so that it can be larger than RAM.
+    """
+    arrays = [np.load(os.path.join(path, name + '.npy'), mmap_mode='r')
+        for name in ('data', 'indices', 'indptr')]
+    shape = tuple(np.load(os.path.join(path, 'shape.npy')))
+    return sparse.csr_matrix(tuple(arrays), shape=shape, copy=False)
+
+
 def candidate_coverage(L):
     """
     Given an N x M matrix where L_{i,j} is the label given by the jth LF to the ith candidate:
@@ -1,7 +1,7 @@
 import math
 from numbskull.inference import FACTORS
 from scipy import sparse
-from snorkel.learning.gen_learning import GenerativeModel, DEP_EXCLUSIVE, DEP_REINFORCING, DEP_FIXING, DEP_SIMILAR
+from snorkel.learning.gen_learning import GenerativeModel, GenerativeModelWeights, DEP_EXCLUSIVE, DEP_REINFORCING, DEP_FIXING, DEP_SIMILAR
 import unittest
 import random
 import numpy as np
@@ -242,6 +242,54 @@ class TestCategorical(unittest.TestCase):
         self._test_categorical(L, LF_acc_priors, labels,
             candidate_ranges=candidate_ranges)
 
+    def test_remap_scoped_categoricals(self):
+        L = sparse.csr_matrix(np.array([
+            [7, 0, 2],
+            [0, 3, 3],
+            [9, 0, 0],
+        ]))
+        candidate_ranges = [[2, 5, 7], [3], [9, 1]]
+        gen_model = GenerativeModel()
+        L_remapped, cardinalities, (range_ptr, range_values) =\
+            gen_model._remap_scoped_categoricals(L, candidate_ranges)
+        self.assertTrue(np.array_equal(L_remapped.toarray(),
+            [[3, 0, 1], [0, 1, 1], [1, 0, 0]]))
+        self.assertTrue(np.array_equal(cardinalities, [3, 1, 2]))
+
+        # Inverse mapping
+        rows, cols = L.nonzero()
+        self.assertTrue(np.array_equal(range_values[range_ptr[rows] +
+            np.ravel(L_remapped[rows, cols]) - 1], np.ravel(L[rows, cols])))
+
+        # Values outside of the candidate's range
+        self.assertRaises(ValueError, gen_model._remap_scoped_categoricals,
+            L, [[2, 5, 7], [3], [1]])
+
+    def test_marginals_scoped_categorical(self):
+        L = sparse.csr_matrix(np.array([
+            [7, 0, 2],
+            [0, 3, 3],
+            [0, 0, 0],
+        ]))
+        candidate_ranges = [[2, 5, 7], [3], [9, 1]]
+        gen_model = GenerativeModel()
+        gen_model.cardinality = 10
+        gen_model.weights = GenerativeModelWeights(3)
+        gen_model.weights.lf_accuracy = np.array([1.0, 0.5, 0.25])
+
+        marginals = gen_model.marginals(L, candidate_ranges=candidate_ranges)
+        self.assertTrue(sparse.isspmatrix_csr(marginals))
+        self.assertEqual(marginals.shape, (3, 10))
+        self.assertEqual(marginals.nnz, 6)
+
+        # Softmax over the scores of the values in each candidate's range
+        scores = np.array([2 * 0.25, 0.0, 2 * 1.0])
+        expected = np.zeros((3, 10))
+        expected[0, [1, 4, 6]] = np.exp(scores) / np.exp(scores).sum()
+        expected[1, 2] = 1.0
+        expected[2, [8, 0]] = 0.5
+        self.assertTrue(np.allclose(marginals.toarray(), expected))
+
     # def test_scoped_categorical_large(self):
     #     LF_acc_priors = [0.75, 0.75, 0.75, 0.75, 0.9]
     #     print("Generating L...")
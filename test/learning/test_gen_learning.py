@@ -1,7 +1,13 @@
 import math
+import shutil
+import tempfile
 from numbskull.inference import FACTORS
 from scipy import sparse
-from snorkel.learning.gen_learning import GenerativeModel, DEP_EXCLUSIVE, DEP_REINFORCING, DEP_FIXING, DEP_SIMILAR
+from snorkel.gen_inference import GenerativeModelInference
+from snorkel.learning.gen_learning import GenerativeModel, GenerativeModelWeights, DEP_EXCLUSIVE, DEP_REINFORCING, DEP_FIXING, DEP_SIMILAR
+from snorkel.learning.gen_learning import LABELED_WEIGHT, _propensity_weights
+from snorkel.learning.structure import DependencySelector, generate_label_matrix, get_all_deps, get_deps
+from snorkel.learning.utils import compress_label_matrix, save_csr_memmap, load_csr_memmap, iter_row_chunks, LF_cooccurrences, prune_deps
 import unittest
 import numpy as np
 
@@ -375,5 +381,453 @@ class TestGenLearning(unittest.TestCase):
         # n_edges
         self.assertEqual(n_edges, 135)
 
+    def test_marginals_binary(self):
+        # Defines a label matrix
+        L = sparse.lil_matrix((4, 3), dtype=np.int64)
+        L[0, 0] = 1
+        L[0, 1] = 1
+        L[1, 0] = -1
+        L[1, 2] = 1
+        L[2, 1] = -1
+        L[2, 2] = -1
+
+        gen_model = GenerativeModel()
+        gen_model.cardinality = 2
+        gen_model.weights = GenerativeModelWeights(3)
+        gen_model.weights.class_prior = 0.5
+        gen_model.weights.lf_accuracy = np.array([1.0, 0.5, 2.0])
+        gen_model.weights.lf_class_propensity = np.array([0.1, 0.0, -0.2])
+        gen_model.weights.dep_fixing[0, 2] = 0.3
+        gen_model.weights.dep_reinforcing[1, 0] = 0.4
+        gen_model.weights.dep_reinforcing[2, 1] = 0.7
+
+        # Log-odds, computed by hand
+        log_odds = [
+            1.0 + 2 * 1.0 + 2 * 0.5 + 2 * 0.1 + 0.4,
+            1.0 - 2 * 1.0 + 2 * 2.0 + 2 * 0.1 - 2 * 0.2 + 0.3,
+            1.0 - 2 * 0.5 - 2 * 2.0 - 2 * 0.2 - 0.7,
+            1.0
+        ]
+        expected = 1 / (1 + np.exp(-1 * np.array(log_odds)))
+
+        marginals = gen_model.marginals(sparse.csr_matrix(L))
+        self.assertTrue(np.allclose(marginals, expected))
+        marginals = gen_model.marginals(sparse.csr_matrix(L), batch_size=3)
+        self.assertTrue(np.allclose(marginals, expected))
+
+    def test_compile_sparse(self):
+        # Defines a label matrix
+        L = sparse.lil_matrix((5, 3))
+        L[0, 0] = 1
+        L[1, 0] = 1
+        L[2, 0] = 1
+        L[3, 0] = 1
+        L[4, 0] = 1
+        L[0, 1] = 1
+        L[2, 1] = -1
+        L[4, 1] = 1
+
+        gen_model = GenerativeModel(class_prior=True, lf_propensity=True)
+        gen_model._process_dependency_graph(L, ())
+        gen_model.cardinality = 2
+        weight, variable, factor, ftv, domain_mask, n_edges =\
+            gen_model._compile_sparse(L, 0.5, [0.0, 0.0, 0.0],
+                [False, False, False], 2 * np.ones(5))
+
+        # 1 class prior + 3 LFs + 1 fixed propensity weight
+        self.assertEqual(len(weight), 5)
+        self.assertTrue(weight[4]['isFixed'])
+        self.assertEqual(weight[4]['initialValue'], LABELED_WEIGHT)
+
+        # 5 candidates + 8 labels, in row-major order
+        self.assertEqual(len(variable), 13)
+        self.assertEqual(list(variable[5:]['initialValue']),
+            [1, 1, 1, 1, 0, 1, 1, 1])
+        for i in range(5, 13):
+            self.assertEqual(variable[i]['isEvidence'], 1)
+            self.assertEqual(variable[i]['cardinality'], 3)
+
+        # 5 class prior + 8 accuracy + 8 propensity factors
+        self.assertEqual(len(factor), 21)
+        self.assertEqual(list(factor[5:13]['weightId']),
+            [1, 2, 1, 1, 2, 1, 1, 2])
+        self.assertEqual(list(ftv[5:21]['vid']),
+            [0, 5, 0, 6, 1, 7, 2, 8, 2, 9, 3, 10, 4, 11, 4, 12])
+        for i in range(13, 21):
+            self.assertEqual(factor[i]['factorFunction'], FACTORS["DP_GEN_LF_PROPENSITY"])
+            self.assertEqual(factor[i]['weightId'], 4)
+            self.assertEqual(ftv[factor[i]['ftv_offset']]['vid'], i - 8)
+        self.assertEqual(n_edges, 29)
+
+    def test_train_skip_abstains(self):
+        rng = np.random.RandomState(0)
+        m = 2000
+        accuracy = np.array([0.85, 0.8, 0.75, 0.7])
+        coverage = np.array([0.6, 0.5, 0.5, 0.4])
+        y = rng.choice([-1, 1], m)
+        labeled = rng.rand(m, 4) < coverage
+        correct = rng.rand(m, 4) < accuracy
+        L = sparse.csr_matrix(np.where(labeled, np.where(correct, y[:, None], -y[:, None]), 0))
+
+        # The sparse factor graph fits the same weights as the dense one
+        weights, marginals = [], []
+        for skip_abstains in (False, True):
+            gen_model = GenerativeModel(lf_propensity=True, seed=0)
+            gen_model.train(L, epochs=100, step_size=0.2 / m, reg_param=0.0, skip_abstains=skip_abstains)
+            weights.append(gen_model.weights)
+            marginals.append(gen_model.marginals(L))
+        np.testing.assert_allclose(weights[1].lf_accuracy, weights[0].lf_accuracy, atol=0.2)
+        np.testing.assert_allclose(weights[1].lf_accuracy, 0.5 * np.log(accuracy / (1 - accuracy)), atol=0.2)
+        np.testing.assert_allclose(weights[1].lf_propensity, weights[0].lf_propensity, atol=0.2)
+        np.testing.assert_allclose(marginals[1], marginals[0], atol=0.15)
+
+    def test_propensity_weights(self):
+        coverage = np.array([0.1, 0.5, 0.9])
+        lf_accuracy = np.array([0.5, 1.0, -0.2])
+        cardinalities = np.array([2, 3, 3, 5])
+        p = _propensity_weights(coverage, lf_accuracy, cardinalities)
+        for i in range(3):
+            a = lf_accuracy[i]
+            s = np.exp(a) + (cardinalities - 1) * np.exp(-1 * a)
+            expected = np.mean(s * np.exp(p[i]) / (s * np.exp(p[i]) + 1))
+            self.assertAlmostEqual(expected, coverage[i])
+
+    def test_compress_label_matrix(self):
+        L = sparse.csr_matrix(np.array([
+            [1, 0, -1],
+            [0, 0, 0],
+            [1, 0, -1],
+            [0, 1, 0],
+            [0, 0, 0],
+            [1, 0, -1],
+        ]))
+        L_unique, counts, index, inverse = compress_label_matrix(L)
+        self.assertEqual(L_unique.shape, (3, 3))
+        self.assertEqual(sorted(counts), [1, 2, 3])
+        self.assertEqual((L_unique[inverse] != L).nnz, 0)
+        self.assertEqual((L_unique != L[index]).nnz, 0)
+
+        # Rows with different cardinalities are not merged
+        L_unique, counts, _, inverse = compress_label_matrix(L,
+            cardinalities=[2, 2, 3, 2, 2, 2])
+        self.assertEqual(L_unique.shape, (4, 3))
+        self.assertEqual((L_unique[inverse] != L).nnz, 0)
+
+        # Marginals are broadcast back to all candidates
+        gen_model = GenerativeModel()
+        gen_model.cardinality = 2
+        gen_model.weights = GenerativeModelWeights(3)
+        gen_model.weights.lf_accuracy = np.array([1.0, 0.5, 2.0])
+        self.assertTrue(np.allclose(gen_model.marginals(L, compress=True),
+            gen_model.marginals(L)))
+
+    def test_train_compress(self):
+        rng = np.random.RandomState(0)
+        m = 2000
+        accuracy = np.array([0.85, 0.8, 0.75, 0.7])
+        coverage = np.array([0.6, 0.5, 0.5, 0.4])
+        y = rng.choice([-1, 1], m)
+        labeled = rng.rand(m, 4) < coverage
+        correct = rng.rand(m, 4) < accuracy
+        L = sparse.csr_matrix(np.where(labeled, np.where(correct, y[:, None], -y[:, None]), 0))
+
+        # An epoch over the 81 patterns amounts to 81 / 2000 of an epoch over the candidates
+        weights, marginals = [], []
+        for compress, epochs in ((False, 20), (True, 500)):
+            gen_model = GenerativeModel(lf_propensity=True, seed=0)
+            gen_model.train(L, epochs=epochs, step_size=2.0 / m, compress=compress)
+            weights.append(gen_model.weights)
+            marginals.append(gen_model.marginals(L))
+        np.testing.assert_allclose(weights[1].lf_accuracy, weights[0].lf_accuracy, atol=0.2)
+        np.testing.assert_allclose(weights[1].lf_propensity, weights[0].lf_propensity, atol=0.1)
+        np.testing.assert_allclose(marginals[1], marginals[0], atol=0.2)
+
+    def test_closed_form(self):
+        # Generates conditionally independent LFs with known accuracies
+        rng = np.random.RandomState(0)
+        m, n = 20000, 8
+        accuracy = rng.uniform(0.6, 0.9, n)
+        coverage = rng.uniform(0.2, 0.5, n)
+        y = rng.choice([-1, 1], m)
+        L = np.zeros((m, n), dtype=np.int64)
+        for j in range(n):
+            labeled = rng.rand(m) < coverage[j]
+            correct = rng.rand(m) < accuracy[j]
+            L[labeled, j] = np.where(correct, y, -y)[labeled]
+
+        gen_model = GenerativeModel(lf_propensity=True)
+        gen_model.train(sparse.csr_matrix(L), closed_form=True)
+        self.assertTrue(np.allclose(gen_model.weights.lf_accuracy,
+            np.arctanh(2 * accuracy - 1), atol=0.1))
+        self.assertTrue(np.allclose(1 / (1 + np.exp(-1 * (
+            gen_model.weights.lf_propensity + np.log(2 * np.cosh(
+                gen_model.weights.lf_accuracy))))), coverage, atol=0.02))
+
+    def test_train_streaming(self):
+        rng = np.random.RandomState(0)
+        L = sparse.random(500, 4, density=0.5, random_state=rng, format='csr')
+        L.data = rng.choice([-1, 1], L.nnz)
+        L = L.astype(np.int64)
+
+        # Memory-mapped matrices are read back chunk by chunk
+        path = tempfile.mkdtemp()
+        try:
+            save_csr_memmap(L, path)
+            L_mmap = load_csr_memmap(path)
+            chunks = list(iter_row_chunks(L_mmap, 200))
+            self.assertEqual([c.shape[0] for c in chunks], [200, 200, 100])
+            self.assertEqual((sparse.vstack(chunks) != L).nnz, 0)
+
+            gen_model = GenerativeModel(lf_propensity=True)
+            gen_model.train_streaming(L_mmap, chunk_size=200, epochs=2)
+        finally:
+            shutil.rmtree(path)
+        self.assertEqual(gen_model.weights.lf_accuracy.shape, (4,))
+        self.assertEqual(gen_model.weights.lf_propensity.shape, (4,))
+        self.assertEqual(gen_model.marginals(L).shape, (500,))
+
+    def test_learned_lf_stats(self):
+        gen_model = GenerativeModel(lf_propensity=True)
+        gen_model.cardinality = gen_model.cardinality_for_stats = 2
+        gen_model.weights = GenerativeModelWeights(2)
+        gen_model.weights.lf_accuracy = np.array([1.0, 0.5])
+        gen_model.weights.lf_propensity = np.array([-1.0, 0.5])
+
+        # Without dependencies, the stats are computed exactly
+        stats = gen_model.learned_lf_stats()
+        for j in range(2):
+            a = gen_model.weights.lf_accuracy[j]
+            p = gen_model.weights.lf_propensity[j]
+            z = np.exp(a + p) + np.exp(-a + p)
+            self.assertAlmostEqual(stats["Accuracy"][j],
+                np.exp(a) / (np.exp(a) + np.exp(-a)))
+            self.assertAlmostEqual(stats["Coverage"][j], z / (z + 1))
+            self.assertAlmostEqual(stats["Precision"][j],
+                np.exp(a) / (np.exp(a) + np.exp(-a)))
+
+    def test_parallelism(self):
+        rng = np.random.RandomState(0)
+        y = rng.choice([-1, 1], 2000)
+        L = np.zeros((2000, 4), np.int64)
+        for j in range(4):
+            labeled = rng.rand(2000) < 0.5
+            correct = rng.rand(2000) < 0.8
+            L[labeled, j] = np.where(correct, y, -y)[labeled]
+        L = sparse.csr_matrix(L)
+
+        w = {}
+        for parallelism in ('hogwild', 'replicas'):
+            gen_model = GenerativeModel(lf_propensity=True, threads=4,
+                parallelism=parallelism)
+            gen_model.train(L, epochs=20, step_size=0.1 / 2000, decay=0.95,
+                reg_param=0.0)
+            self.assertEqual(len(gen_model.epoch_throughput), 20)
+            self.assertEqual(gen_model.fg.nthreads, 4)
+            w[parallelism] = gen_model.weights.lf_accuracy
+        np.testing.assert_allclose(w['hogwild'], w['replicas'], atol=0.1)
+
+        with self.assertRaises(ValueError):
+            GenerativeModel(parallelism='locked')
+
+    def test_warm_start(self):
+        rng = np.random.RandomState(0)
+        L = sparse.random(500, 3, density=0.5, random_state=rng, format='csr')
+        L.data = rng.choice([-1, 1], L.nnz)
+        L = L.astype(np.int64)
+
+        gen_model = GenerativeModel(lf_propensity=True)
+        gen_model.train(L, epochs=5, lf_names=['a', 'b', 'c'])
+        weights = gen_model.weights
+        self.assertEqual(weights.lf_names, ['a', 'b', 'c'])
+
+        # LFs are matched by name, and new LFs start from their priors
+        warm_model = GenerativeModel(lf_propensity=True)
+        warm_model.train(L, epochs=0, init_weights=weights,
+            lf_names=['c', 'd', 'a'])
+        np.testing.assert_allclose(warm_model.weights.lf_accuracy,
+            [weights.lf_accuracy[2], 1.0, weights.lf_accuracy[0]])
+        np.testing.assert_allclose(warm_model.weights.lf_propensity,
+            [weights.lf_propensity[2], 0.0, weights.lf_propensity[0]])
+
+        trajectory = gen_model.fine_tune(L[:, ::-1], epochs=2,
+            lf_names=['c', 'b', 'a'])
+        self.assertEqual(len(trajectory), 2)
+        self.assertEqual(gen_model.weights.lf_names, ['c', 'b', 'a'])
+
+        # Fine tuning keeps the dependencies among the matched LFs, unless
+        # they are overridden
+        dep_model = GenerativeModel()
+        dep_model.train(L, deps=[(0, 1, DEP_SIMILAR), (1, 2, DEP_FIXING)],
+            epochs=2, init_deps=1.0, lf_names=['a', 'b', 'c'])
+        dep_model.fine_tune(L[:, :2], epochs=1, lf_names=['b', 'a'])
+        self.assertEqual(list(zip(*dep_model.weights.dep_similar.nonzero())),
+            [(1, 0)])
+        self.assertEqual(dep_model.weights.dep_fixing.nnz, 0)
+        dep_model.fine_tune(L[:, :2], epochs=1, lf_names=['b', 'a'], deps=())
+        self.assertEqual(dep_model.weights.dep_similar.nnz, 0)
+
+    def test_early_stopping(self):
+        rng = np.random.RandomState(0)
+        L = sparse.random(500, 3, density=0.5, random_state=rng, format='csr')
+        L.data = rng.choice([-1, 1], L.nnz)
+        L = L.astype(np.int64)
+
+        gen_model = GenerativeModel(lf_propensity=True)
+        trajectory = gen_model.train(L, epochs=50, decay=0.5, tol=1e-3,
+            L_val=L[:100])
+        self.assertLess(len(trajectory), 50)
+        self.assertEqual(list(trajectory["Epoch"]), list(range(len(trajectory))))
+        self.assertFalse(np.any(np.isnan(trajectory["Log-likelihood"])))
+
+        # For one LF, P(abstain) = 1 / (z + 1) and P(lambda = +/-1) =
+        # z / (2 (z + 1)) with z = exp(a + p) + exp(-a + p)
+        gen_model.weights = GenerativeModelWeights(1)
+        gen_model.weights.lf_accuracy[0] = 1.0
+        gen_model.weights.lf_propensity[0] = -0.5
+        z = np.exp(0.5) + np.exp(-1.5)
+        L = sparse.csr_matrix(np.array([[1], [0], [-1]], dtype=np.int64))
+        self.assertAlmostEqual(gen_model._log_likelihood(L),
+            (2 * np.log(z / (2 * (z + 1))) + np.log(1 / (z + 1))) / 3)
+
+    def test_save_load(self):
+        rng = np.random.RandomState(0)
+        L = sparse.random(500, 3, density=0.5, random_state=rng, format='csr')
+        L.data = rng.choice([-1, 1], L.nnz)
+        L = L.astype(np.int64)
+
+        gen_model = GenerativeModel(class_prior=True, lf_propensity=True)
+        gen_model.train(L, deps=[(0, 1, DEP_REINFORCING)], epochs=5,
+            lf_names=['a', 'b', 'c'])
+        save_dir = tempfile.mkdtemp()
+        try:
+            gen_model.save('gen_model', save_dir=save_dir, verbose=False)
+            loaded_model = GenerativeModel()
+            loaded_model.load('gen_model', save_dir=save_dir, verbose=False)
+            self.assertIsInstance(loaded_model.weights.lf_accuracy, np.memmap)
+            self.assertTrue(loaded_model.class_prior)
+            self.assertEqual(loaded_model.weights.lf_names, ['a', 'b', 'c'])
+            np.testing.assert_allclose(
+                loaded_model.weights.dep_reinforcing.toarray(),
+                gen_model.weights.dep_reinforcing.toarray())
+            np.testing.assert_allclose(loaded_model.marginals(L),
+                gen_model.marginals(L))
+
+            # Models can be applied without numbskull
+            inference = GenerativeModelInference.load('gen_model',
+                save_dir=save_dir)
+            np.testing.assert_allclose(inference.marginals(L),
+                gen_model.marginals(L))
+        finally:
+            shutil.rmtree(save_dir)
+
+    def test_sparse_weights(self):
+        w1 = GenerativeModelWeights(3)
+        w1.lf_accuracy[:] = 1.0
+        w1.dep_fixing = sparse.csr_matrix(([0.3, 0.05], ([0, 1], [2, 0])), shape=(3, 3))
+        w2 = GenerativeModelWeights(3)
+        w2.lf_accuracy[:] = 0.5
+        w2.dep_fixing = sparse.csr_matrix(([0.2], ([0], [2])), shape=(3, 3))
+
+        self.assertTrue(w1.is_sign_sparsistent(w2))
+        self.assertEqual(get_deps(w1, threshold=0.1), set([(0, 2, DEP_FIXING)]))
+        w2.dep_similar = sparse.csr_matrix(([-0.2], ([1], [2])), shape=(3, 3))
+        self.assertFalse(w1.is_sign_sparsistent(w2))
+        self.assertFalse(w2.is_sign_sparsistent(w1))
+
+    def test_prune_deps(self):
+        # LFs 0 and 1 co-occur on 3 candidates, 0 and 2 on 1, and 1 and 2 never
+        L = sparse.csr_matrix(np.array([
+            [1, -1, 0],
+            [1, 1, 0],
+            [-1, 1, 0],
+            [1, 0, -1],
+            [0, 0, 1],
+        ]))
+        np.testing.assert_array_equal(LF_cooccurrences(L).toarray(), [[4, 3, 1], [3, 3, 0], [1, 0, 2]])
+        deps = get_all_deps(3, dep_similar=True, dep_fixing=True)
+        self.assertEqual(prune_deps(L, deps), [dep for dep in deps if set(dep[:2]) != set([1, 2])])
+        self.assertEqual(prune_deps(L, deps, min_overlap=2), [dep for dep in deps if set(dep[:2]) == set([0, 1])])
+        self.assertEqual(prune_deps(L, []), [])
+
+        gen_model = GenerativeModel(lf_propensity=True, seed=0)
+        gen_model.train(L, deps=deps, epochs=2, min_dep_overlap=2)
+        self.assertEqual(gen_model.dep_similar.nnz, 1)
+        self.assertEqual(gen_model.dep_fixing.nnz, 2)
+        self.assertEqual(gen_model.weights.dep_similar.nnz, 1)
+
+    def test_generate_label_matrix(self):
+        weights = GenerativeModelWeights(3)
+        weights.lf_accuracy[:] = [2.0, 2.0, 0.0]
+        weights.lf_propensity[:] = [5.0, -6.0, 0.0]
+        y, L = generate_label_matrix(weights, 5000, batch_size=2000, seed=0)
+        self.assertTrue(sparse.isspmatrix_csr(L))
+        self.assertEqual(L.shape, (5000, 3))
+        L = L.toarray()
+        self.assertGreater(np.mean(L[:, 0] == y), 0.95)
+        self.assertLess(np.mean(L[:, 1] != 0), 0.05)
+
+        # Seeded and reproducible, with and without dependencies
+        y2, L2 = generate_label_matrix(weights, 5000, batch_size=2000, seed=0)
+        np.testing.assert_array_equal(y, y2)
+        np.testing.assert_array_equal(L, L2.toarray())
+        weights.dep_similar = sparse.csr_matrix(([5.0], ([0], [2])), shape=(3, 3))
+        y, L = generate_label_matrix(weights, 5000, seed=1)
+        y2, L2 = generate_label_matrix(weights, 5000, seed=1)
+        np.testing.assert_array_equal(L.toarray(), L2.toarray())
+        self.assertGreater(np.mean(L[:, 0].toarray() == L[:, 2].toarray()), 0.95)
+
+    def test_benchmark(self):
+        from snorkel.learning.benchmark import benchmark_generative_model, read_benchmark, compare_benchmarks
+        grid = {'m': [200], 'n': [4], 'density': [0.5], 'dep_density': [0.0], 'cardinality': [2, 3], 'threads': [1]}
+        save_dir = tempfile.mkdtemp()
+        try:
+            path = save_dir + '/results.json'
+            results = benchmark_generative_model(grid, epochs=2, lf_stats_samples=100, output=path)
+            self.assertEqual(len(results), 2 * 4)
+            self.assertTrue((results['throughput'] > 0).all())
+            self.assertFalse(compare_benchmarks(read_benchmark(path), results)['regression'].any())
+        finally:
+            shutil.rmtree(save_dir)
+
+    def test_dependency_selector(self):
+        rng = np.random.RandomState(0)
+        y = rng.choice([-1, 1], 1000)
+        L = np.zeros((1000, 4), np.int64)
+        for j in range(3):
+            labeled = rng.rand(1000) < 0.5
+            correct = rng.rand(1000) < 0.8
+            L[labeled, j] = np.where(correct, y, -y)[labeled]
+        # LF 3 duplicates LF 0
+        L[:, 3] = L[:, 0]
+
+        ds = DependencySelector()
+        deps = ds.select(sparse.csr_matrix(L))
+        self.assertIn((0, 3, DEP_SIMILAR), deps)
+        self.assertEqual(deps, ds.select(L))
+        self.assertEqual(deps, ds.select(L, threads=2))
+        self.assertIn((0, 3, DEP_SIMILAR), ds.select(L, compress=True,
+            max_rows=800, seed=0, epochs=50, tol=1e-4))
+
+        # The path starts with the largest threshold, fit as by select
+        path = ds.select_path(L, [0.01, 0.05, 0.02])
+        self.assertEqual(sorted(path.keys()), [0.01, 0.02, 0.05])
+        self.assertEqual(path[0.05], deps)
+        self.assertIn((0, 3, DEP_SIMILAR), path[0.01])
+
+        # Categorical labels, in {0, 1, 2, 3}
+        y = rng.randint(1, 4, 1000)
+        L = np.zeros((1000, 4), np.int64)
+        for j in range(3):
+            labeled = rng.rand(1000) < 0.5
+            correct = rng.rand(1000) < 0.8
+            L[labeled, j] = np.where(correct, y, rng.randint(1, 4, 1000))[labeled]
+        L[:, 3] = L[:, 0]
+
+        deps = ds.select(L)
+        self.assertIn((0, 3, DEP_SIMILAR), deps)
+        self.assertEqual(deps, ds.select(sparse.csr_matrix(L), threads=2, cardinality=3))
+        self.assertRaises(NotImplementedError, ds.select, L, higher_order=True)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,167 @@
+import os
+import shutil
+import signal
+import tempfile
+import time
+import unittest
+
+# Runs against a fresh SQLite DB, which must be configured before importing snorkel
+DB_DIR = tempfile.mkdtemp()
+os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(DB_DIR, 'snorkel.db')
+
+from snorkel.annotations import (FailedAnnotation, LabelAnnotator, apply_lfs_isolated, iter_label_matrix_chunks,
+    load_label_matrix)
+from snorkel.models import Document, Sentence, Span, candidate_subclass
+from snorkel.models.meta import SnorkelSession
+import numpy as np
+
+Pair = candidate_subclass('Pair', ['a', 'b'])
+
+
+def lf_odd(c):
+    return 1 if c.a.sentence.position % 2 else 0
+
+
+def lf_doc(c):
+    return -1 if c.a.sentence.document.name == 'doc1' else None
+
+
+def lf_raise(c):
+    if c.a.sentence.position == 0:
+        raise ValueError("LF failed")
+    return 1
+
+
+def lf_sleep(c):
+    if c.a.sentence.position == 0:
+        time.sleep(1)
+    return -1
+
+
+def lf_swallow(c):
+    # Catches everything but the timeout
+    try:
+        time.sleep(1)
+    except Exception:
+        pass
+    return 1
+
+
+class TestAnnotations(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.session = SnorkelSession()
+        for d in range(2):
+            doc = Document(name='doc%d' % d, stable_id='doc%d::document:0:0' % d)
+            cls.session.add(doc)
+            for p in range(3):
+                words = ['w%d' % k for k in range(4)]
+                offsets = [3 * k for k in range(4)]
+                sentence = Sentence(document=doc, position=p, text=' '.join(words), words=words,
+                    char_offsets=offsets, abs_char_offsets=offsets,
+                    stable_id='doc%d::sentence:%d:%d' % (d, p, p))
+                a = Span(sentence=sentence, char_start=0, char_end=1, stable_id='doc%d:%d::span:0:1' % (d, p))
+                b = Span(sentence=sentence, char_start=3, char_end=4, stable_id='doc%d:%d::span:3:4' % (d, p))
+                cls.session.add_all([sentence, a, b, Pair(a=a, b=b, split=0)])
+        cls.session.commit()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.session.close()
+        shutil.rmtree(DB_DIR)
+
+    def test_apply_lfs_isolated(self):
+        c = self.session.query(Pair).first()
+        self.assertEqual(c.a.sentence.position, 0)
+        handler = signal.getsignal(signal.SIGALRM)
+
+        # Exceptions are caught only if fault tolerant
+        labels = apply_lfs_isolated([lf_odd, lf_raise, lf_doc], c)
+        self.assertEqual([name for name, _ in labels], ['lf_odd', 'lf_raise', 'lf_doc'])
+        self.assertEqual(labels[0][1], 0)
+        self.assertIsInstance(labels[1][1], FailedAnnotation)
+        self.assertFalse(labels[1][1].timeout)
+        self.assertIsNone(labels[2][1])
+        self.assertRaises(ValueError, apply_lfs_isolated, [lf_odd, lf_raise], c, fault_tolerant=False)
+
+        # The LF running when the budget expires and those after it fail, even if they catch exceptions
+        for lf in (lf_sleep, lf_swallow):
+            t = time.time()
+            labels = apply_lfs_isolated([lf_odd, lf, lf_doc], c, timeout=0.1)
+            self.assertLess(time.time() - t, 0.9)
+            self.assertEqual(labels[0], ('lf_odd', 0))
+            for _, label in labels[1:]:
+                self.assertIsInstance(label, FailedAnnotation)
+                self.assertTrue(label.timeout)
+
+        # The timer is disarmed and the previous handler restored
+        labels = apply_lfs_isolated([lf_odd, lf_doc], c, timeout=0.1)
+        self.assertEqual(labels, [('lf_odd', 0), ('lf_doc', None)])
+        self.assertEqual(signal.getitimer(signal.ITIMER_REAL), (0.0, 0.0))
+        self.assertEqual(signal.getsignal(signal.SIGALRM), handler)
+
+    def test_fault_tolerant(self):
+        labeler = LabelAnnotator(lfs=[lf_odd, lf_raise, lf_sleep], fault_tolerant=True, timeout=0.1)
+        L = labeler.apply(split=0)
+        self.assertEqual(L.shape, (6, 3))
+        self.assertEqual(dict(labeler.error_counts), {'lf_raise': 2, 'lf_sleep': 2})
+
+        # Failed annotations are stored as abstains
+        positions = np.array([self.session.query(Pair).get(L.row_index[i]).a.sentence.position for i in range(6)])
+        np.testing.assert_array_equal(L.toarray(), np.column_stack((positions % 2, np.where(positions == 0, 0, 1),
+            np.where(positions == 0, 0, -1))))
+
+        # Counts are reset by each apply, and without fault tolerance failures are raised
+        labeler = LabelAnnotator(lfs=[lf_odd, lf_doc], fault_tolerant=True)
+        labeler.apply(split=0)
+        self.assertEqual(dict(labeler.error_counts), {})
+        self.assertRaises(ValueError, LabelAnnotator(lfs=[lf_odd, lf_raise]).apply, split=0)
+        self.assertRaises(ValueError, LabelAnnotator, label_generator=lambda c: [], fault_tolerant=True)
+
+    def test_persist(self):
+        labeler = LabelAnnotator(lfs=[lf_odd, lf_doc, lf_raise], fault_tolerant=True)
+        L = labeler.apply(split=0)
+        self.assertEqual((L != load_label_matrix(self.session, split=0)).nnz, 0)
+
+        # The matrix computed in memory matches the one loaded from the DB
+        for L_memory in (labeler.apply(split=0, persist=False), labeler.apply_existing(split=0, persist=False)):
+            self.assertEqual(L_memory.shape, L.shape)
+            self.assertEqual((L_memory != L).nnz, 0)
+            self.assertEqual(L_memory.row_index, L.row_index)
+            self.assertEqual(L_memory.candidate_index, L.candidate_index)
+            for j in range(L.shape[1]):
+                key = L.get_key(self.session, j)
+                self.assertEqual(L_memory.get_key(self.session, j).name, key.name)
+                self.assertEqual(L_memory.get_col_index(key), j)
+                self.assertEqual(L.get_col_index(key), j)
+                self.assertEqual(L_memory.get_col_index(L_memory.get_key(self.session, j)), j)
+            for i in range(L.shape[0]):
+                c = L.get_candidate(self.session, i)
+                self.assertEqual(L_memory.get_candidate(self.session, i), c)
+                self.assertEqual(L_memory.get_row_index(c), i)
+
+        # Nothing was written to the DB
+        self.assertEqual((L != load_label_matrix(self.session, split=0)).nnz, 0)
+
+    def test_iter_matrix_chunks(self):
+        LabelAnnotator(lfs=[lf_odd, lf_doc]).apply(split=0)
+        for zero_one in (False, True):
+            L = load_label_matrix(self.session, split=0, zero_one=zero_one)
+            chunks = list(iter_label_matrix_chunks(self.session, chunk_size=4, split=0, zero_one=zero_one))
+            self.assertEqual([chunk.shape for chunk in chunks], [(4, 2), (2, 2)])
+            np.testing.assert_array_equal(np.vstack([chunk.toarray() for chunk in chunks]), L.toarray())
+            for chunk in chunks:
+                self.assertEqual(chunk.key_index, L.key_index)
+                self.assertEqual(chunk.col_index, L.col_index)
+            self.assertEqual([cid for chunk in chunks for _, cid in sorted(chunk.row_index.items())],
+                [L.row_index[i] for i in range(6)])
+
+        # Restricting the keys restricts the columns
+        L = load_label_matrix(self.session, split=0, key_names=['lf_doc'])
+        self.assertEqual(L.shape, (6, 1))
+        self.assertEqual(L.get_key(self.session, 0).name, 'lf_doc')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,36 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+# Runs against a fresh SQLite DB, which must be configured before importing snorkel
+DB_DIR = tempfile.mkdtemp()
+os.environ['SNORKELDB'] = 'sqlite:///' + os.path.join(DB_DIR, 'snorkel.db')
+
+from snorkel.benchmark import benchmark_pipeline
+from snorkel.learning.benchmark import read_benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(DB_DIR)
+
+    def test_benchmark_pipeline(self):
+        path = os.path.join(DB_DIR, 'results.json')
+        results = benchmark_pipeline(n_docs=2, sentences_per_doc=2, n_lfs=2, coverage=1.0, epochs=1, output=path)
+        self.assertEqual(list(results['operation']), ['parse', 'extract', 'label', 'load_label_matrix', 'train',
+            'marginals', 'save_marginals'])
+        self.assertTrue((results['db'] == 'sqlite').all())
+        self.assertTrue((results['items'] > 0).all())
+        self.assertTrue((results['throughput'] > 0).all())
+        self.assertEqual(list(read_benchmark(path)['operation']), list(results['operation']))
+
+        # Existing contexts and candidates are cleared, so reruns give the same items
+        rerun = benchmark_pipeline(n_docs=2, sentences_per_doc=2, n_lfs=2, coverage=1.0, epochs=1)
+        self.assertEqual(list(rerun['items']), list(results['items']))
+
+
+if __name__ == '__main__':
+    unittest.main()